@@ -1,33 +1,134 @@
-import yaml
-
-with open("./data/config.yaml","r") as f:
-    config = yaml.safe_load(f)
-    
-follow_watches = config["follow_watches"]
-print("Active follow watches:", len(follow_watches))
-
-user_watches = config["user_watches"]
-unique_watchers = []
-unique_subjects = []
-watch_counts=[]
-
-for watch in user_watches:
-    if watch["subject-handle"] not in unique_subjects:
-        unique_subjects.append(watch["subject-handle"])
-        
-    if watch["receiver-handle"] not in unique_watchers:
-        unique_watchers.append(watch["receiver-handle"])
-        watch_counts.append(1)
+import sys
+import json
+import argparse
+from collections import Counter
+
+import skyalert_store
+
+# Capacity report for the watch store, printed as JSON. Watches are streamed from the store and counted in
+# hash maps, so the report runs in one pass over any number of watches.
+#
+# With --events, the report also estimates how many DMs per hour the post service would send, by replaying
+# a recorded sample of Jetstream events (one JSON message per line) against the current watches, e.g.:
+#   websocat "wss://jetstream2.us-east.bsky.network/subscribe?wantedCollections=app.bsky.feed.post&wantedCollections=app.bsky.feed.repost" > sample.jsonl
+
+TOP_COUNT = 20
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0
+    return sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)]
+
+def distribution(counter):
+    values = sorted(counter.values())
+    return {
+        'count': len(values),
+        'p50': percentile(values, 0.50),
+        'p90': percentile(values, 0.90),
+        'p99': percentile(values, 0.99),
+        'max': values[-1] if values else 0,
+        'mean': round(sum(values) / len(values), 2) if values else 0,
+    }
+
+def count_watches():
+    replies_allowed = {did for did, allowed in skyalert_store.iter_reply_settings() if allowed}
+    counts = {
+        'watchers': Counter(), # subject did -> watches
+        'repost_watchers': Counter(), # subject did -> watches with reposts allowed
+        'reply_watchers': Counter(), # subject did -> watches whose receiver allows replies
+        'receivers': Counter(), # receiver did -> watches
+        'handles': {},
+        'total': 0,
+    }
+    for watch in skyalert_store.iter_user_watches():
+        subject_did = watch['subject-did']
+        receiver_did = watch['receiver-did']
+        counts['total'] += 1
+        counts['watchers'][subject_did] += 1
+        counts['receivers'][receiver_did] += 1
+        if watch['reposts-allowed']:
+            counts['repost_watchers'][subject_did] += 1
+        if receiver_did in replies_allowed:
+            counts['reply_watchers'][subject_did] += 1
+        counts['handles'][subject_did] = watch['subject-handle']
+        counts['handles'][receiver_did] = watch['receiver-handle']
+    return counts
+
+# Replays the event sample: each post DMs every watcher of its author (only those allowing replies if it
+# is a reply), each repost DMs the watchers that allow reposts.
+def estimate_dm_volume(events_path, counts):
+    first_time = last_time = None
+    events = matched_events = dms = 0
+    dms_by_subject = Counter()
+    with open(events_path, 'r') as f:
+        for line in f:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            commit = event.get('commit')
+            if not commit or commit.get('operation', 'create') != 'create':
+                continue
+            event_time = event.get('time_us')
+            if event_time is not None:
+                first_time = event_time if first_time is None else min(first_time, event_time)
+                last_time = event_time if last_time is None else max(last_time, event_time)
+            events += 1
+            did = event.get('did')
+            if commit.get('collection') == 'app.bsky.feed.post':
+                if (commit.get('record') or {}).get('reply'):
+                    sent = counts['reply_watchers'][did]
+                else:
+                    sent = counts['watchers'][did]
+            elif commit.get('collection') == 'app.bsky.feed.repost':
+                sent = counts['repost_watchers'][did]
+            else:
+                continue
+            if sent:
+                matched_events += 1
+                dms += sent
+                dms_by_subject[did] += sent
+    duration = (last_time - first_time) / 1_000_000 if first_time is not None and last_time > first_time else 0
+    return {
+        'sample_events': events,
+        'sample_seconds': round(duration, 1),
+        'matched_events': matched_events,
+        'dms_in_sample': dms,
+        'dms_per_hour': round(dms * 3600 / duration, 1) if duration else None,
+        'busiest_subjects': [{'did': did, 'handle': counts['handles'].get(did), 'dms': sent} for did, sent in dms_by_subject.most_common(TOP_COUNT)],
+    }
+
+def build_report(events_path=None, full=False):
+    counts = count_watches()
+    top_receiver = counts['receivers'].most_common(1)
+    report = {
+        'follow_watches': len(skyalert_store.get_follow_watches()),
+        'user_watches': counts['total'],
+        'unique_watchers': len(counts['receivers']),
+        'unique_subjects': len(counts['watchers']),
+        'user_with_most_watches': {'did': top_receiver[0][0], 'handle': counts['handles'].get(top_receiver[0][0]), 'watches': top_receiver[0][1]} if top_receiver else None,
+        'watchers_per_subject': distribution(counts['watchers']),
+        'watches_per_receiver': distribution(counts['receivers']),
+        'hottest_subjects': [{'did': did, 'handle': counts['handles'].get(did), 'watchers': watchers} for did, watchers in counts['watchers'].most_common(TOP_COUNT)],
+        'top_receivers': [{'did': did, 'handle': counts['handles'].get(did), 'watches': watches} for did, watches in counts['receivers'].most_common(TOP_COUNT)],
+    }
+    if full:
+        report['receiver_watch_counts'] = dict(counts['receivers'])
+    if events_path:
+        report['dm_volume'] = estimate_dm_volume(events_path, counts)
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report watch counts and DM volume for SkyAlert.")
+    parser.add_argument('--events', help="recorded Jetstream events (JSON lines) to estimate DMs per hour from")
+    parser.add_argument('--full', action='store_true', help="include the watch count of every receiver")
+    parser.add_argument('--output', help="write the report to this file instead of stdout")
+    args = parser.parse_args()
+
+    report = build_report(args.events, args.full)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
     else:
-        watch_counts[unique_watchers.index(watch["receiver-handle"])] += 1
-
-# Calculate the user with the most watches
-if unique_watchers:
-    max_watches = max(watch_counts)
-    user_with_most_watches = unique_watchers[watch_counts.index(max_watches)]
-    print("User with most watches: ", user_with_most_watches, "(with", max_watches, "watches)")
-else:
-    print("No watchers found.")
-        
-print("Unique watchers:", len(unique_watchers))
-print("Unique subjects:", len(unique_subjects))
\ No newline at end of file
+        json.dump(report, sys.stdout, indent=2)
+        print()
@@ -0,0 +1,95 @@
+import sys
+import random
+import hashlib
+import datetime
+
+import libipld
+from atproto import models
+
+from common import SEED, per_call, report
+import skyalert_commits
+
+# Commit decoding benchmark: skyalert_commits.get_ops_by_type on synthetic firehose commits, built locally
+# as real CAR files. Each commit mixes posts, reposts, likes (decoded but not interesting) and deletions,
+# like the firehose does.
+# Run with: python benchmarks/bench_commits.py [ops per commit...]
+
+DEFAULT_OP_COUNTS = [1, 10, 100]
+QUICK_OP_COUNTS = [1, 10]
+COMMITS = 200
+CREATED_AT = "2024-01-01T00:00:00.000Z"
+
+def varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+# CIDv1, dag-cbor, sha2-256
+def cid_for(data):
+    return b'\x01\x71\x12\x20' + hashlib.sha256(data).digest()
+
+def car_file(blocks):
+    root = blocks[0][0]
+    # {"roots": [root], "version": 1}, with the root as a tag 42 CID link
+    header = b'\xa2\x65roots\x81\xd8\x2a\x58\x25\x00' + root + b'\x67version\x01'
+    parts = [varint(len(header)), header]
+    for cid, data in blocks:
+        parts.append(varint(len(cid) + len(data)))
+        parts.append(cid)
+        parts.append(data)
+    return b''.join(parts)
+
+def make_record(rng, repo, collection):
+    if collection == 'app.bsky.feed.post':
+        record = {'$type': collection, 'text': ' '.join(rng.choice(['hello', 'bluesky', '🦋', 'skyalert', 'post']) for _ in range(rng.randint(3, 40))), 'createdAt': CREATED_AT, 'langs': ['en']}
+    else:
+        subject_cid = libipld.encode_cid(cid_for(rng.randbytes(16)))
+        record = {'$type': collection, 'subject': {'uri': f"at://{repo}/app.bsky.feed.post/{rng.randrange(10**12)}", 'cid': subject_cid}, 'createdAt': CREATED_AT}
+    return libipld.encode_dag_cbor(record)
+
+def make_commit(rng, seq, op_count):
+    repo = f"did:plc:{rng.randrange(10**12):024d}"
+    blocks = []
+    ops = []
+    for _ in range(op_count):
+        roll = rng.random()
+        collection = 'app.bsky.feed.post' if roll < 0.4 else 'app.bsky.feed.repost' if roll < 0.6 else 'app.bsky.feed.like'
+        path = f"{collection}/{rng.randrange(10**12)}"
+        if rng.random() < 0.1:
+            ops.append(models.ComAtprotoSyncSubscribeRepos.RepoOp(action='delete', path=path, cid=None))
+            continue
+        data = make_record(rng, repo, collection)
+        cid = cid_for(data)
+        blocks.append((cid, data))
+        ops.append(models.ComAtprotoSyncSubscribeRepos.RepoOp(action='create', path=path, cid=libipld.encode_cid(cid)))
+    if not blocks:
+        data = libipld.encode_dag_cbor({'did': repo, 'version': 3})
+        blocks.append((cid_for(data), data))
+    return models.ComAtprotoSyncSubscribeRepos.Commit(
+        blobs=[], blocks=car_file(blocks), commit=libipld.encode_cid(blocks[0][0]), ops=ops, rebase=False,
+        repo=repo, rev=f"rev{seq}", seq=seq, time=datetime.datetime(2024, 1, 1).isoformat(), too_big=False)
+
+def check(commit):
+    ops = skyalert_commits.get_ops_by_type(commit)
+    created = sum(1 for op in commit.ops if op.action == 'create' and not op.path.startswith('app.bsky.feed.like'))
+    found = len(ops[models.ids.AppBskyFeedPost]['created']) + len(ops[models.ids.AppBskyFeedRepost]['created'])
+    assert found == created, (found, created)
+
+def run(quick=False, op_counts=None):
+    results = {}
+    for op_count in op_counts or (QUICK_OP_COUNTS if quick else DEFAULT_OP_COUNTS):
+        rng = random.Random(SEED + op_count)
+        commits = [make_commit(rng, seq, op_count) for seq in range(COMMITS)]
+        for commit in commits[:10]:
+            check(commit)
+        results[f"commits.get_ops_by_type.{op_count}"] = per_call(skyalert_commits.get_ops_by_type, commits)
+    return results
+
+if __name__ == "__main__":
+    report(run(op_counts=[int(arg) for arg in sys.argv[1:]] or None), file=sys.stdout)
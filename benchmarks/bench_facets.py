@@ -0,0 +1,71 @@
+import re
+import sys
+import random
+
+from common import SEED, per_call, report
+import skyalert_facets
+
+# Facet builder benchmark: the single-pass builder against the previous search-and-rebuild loop, on
+# messages with many markdown links, bare links and emoji.
+# Run with: python benchmarks/bench_facets.py [links per message...]
+
+DEFAULT_LINK_COUNTS = [1, 10, 100]
+MESSAGES = 200
+EMOJI = ["🔔", "✨", "🦋", "👀", "🎉", "❤️", "🇺🇸"]
+
+# The builder the scripts used before skyalert_facets, kept here as the baseline. Its offsets are
+# character positions, so they are only compared for speed, not correctness.
+def legacy_facets_from_markdown(text):
+    pattern = r'\[([^\]]+)\]\((https?://[^\s]+)\)'
+    facets = []
+    filtered_text = text
+    match = re.search(pattern, filtered_text)
+    while match:
+        link_text, link_url = match.groups()
+        start_index = match.start()
+        filtered_text = filtered_text[:start_index] + link_text + filtered_text[match.end():]
+        facets.append({"index": {"byteStart": start_index, "byteEnd": start_index + len(link_text)}, "features": [{"$type": "app.bsky.richtext.facet#link", "uri": link_url}]})
+        match = re.search(pattern, filtered_text)
+    for link in re.findall(r'(https?://[^\s]+)', filtered_text):
+        start_index = filtered_text.index(link)
+        facets.append({"index": {"byteStart": start_index, "byteEnd": start_index + len(link)}, "features": [{"$type": "app.bsky.richtext.facet#link", "uri": link}]})
+    return {"facets": facets, "filtered_text": filtered_text}
+
+def make_message(rng, links):
+    parts = []
+    for i in range(links):
+        parts.append(" ".join(rng.choice(EMOJI) + "word" for _ in range(rng.randint(1, 6))))
+        url = f"https://bsky.app/profile/did:plc:{rng.randrange(10**12):012d}/post/{rng.randrange(10**9)}"
+        parts.append(f"[{rng.choice(EMOJI)} post {i}]({url})" if rng.random() < 0.7 else url)
+    return " ".join(parts)
+
+def check(message):
+    result = skyalert_facets.get_facets_from_markdown(message)
+    encoded = result["filtered_text"].encode('utf-8')
+    for facet in result["facets"]:
+        shown = encoded[facet["index"]["byteStart"]:facet["index"]["byteEnd"]].decode('utf-8')
+        uri = facet["features"][0]["uri"]
+        assert shown == uri or f"[{shown}]({uri})" in message, (shown, uri)
+
+def bench_links(links):
+    rng = random.Random(SEED + links)
+    messages = [make_message(rng, links) for _ in range(MESSAGES)]
+    for message in messages[:10]:
+        check(message)
+    legacy = per_call(legacy_facets_from_markdown, messages)
+    single_pass = per_call(skyalert_facets.get_facets_from_markdown, messages)
+    print(f"{links:>5} links: legacy {legacy * 1e6:9.1f}us  single pass {single_pass * 1e6:9.1f}us  ({legacy / single_pass:.1f}x)", file=sys.stderr)
+    return {
+        f"facets.legacy.{links}": legacy,
+        f"facets.markdown.{links}": single_pass,
+        f"facets.links.{links}": per_call(skyalert_facets.get_facets_from_links, messages),
+    }
+
+def run(quick=False, link_counts=None):
+    results = {}
+    for links in link_counts or DEFAULT_LINK_COUNTS:
+        results.update(bench_links(links))
+    return results
+
+if __name__ == "__main__":
+    report(run(link_counts=[int(arg) for arg in sys.argv[1:]] or None), file=sys.stdout)
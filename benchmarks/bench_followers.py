@@ -0,0 +1,60 @@
+import os
+import sys
+import random
+import string
+import tempfile
+import time
+
+from common import SEED, report
+import skyalert_followers
+
+# Follower snapshot benchmark: save, load and diff snapshots of 1k/100k/1M followers.
+# Run with: python benchmarks/bench_followers.py [sizes...]
+
+DEFAULT_SIZES = [1_000, 100_000, 1_000_000]
+QUICK_SIZES = [1_000, 100_000]
+CHURN = 0.01 # fraction of followers replaced between the two snapshots
+
+def make_dids(rng, count):
+    alphabet = string.ascii_lowercase + "234567"
+    return [f"did:plc:{''.join(rng.choices(alphabet, k=24))}" for _ in range(count)]
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+def bench_size(count):
+    rng = random.Random(SEED + count)
+    previous = make_dids(rng, count)
+    churned = int(count * CHURN)
+    current = previous[churned:] + make_dids(rng, churned)
+    rng.shuffle(current)
+
+    _, save_time = timed(skyalert_followers.save_snapshot, "did:plc:bench", previous)
+    file_size = os.path.getsize(skyalert_followers.snapshot_file("did:plc:bench"))
+    loaded, load_time = timed(skyalert_followers.load_snapshot, "did:plc:bench")
+    (unfollowed, _), diff_time = timed(skyalert_followers.diff_followers, loaded, current)
+    assert len(unfollowed) == churned
+    current_sorted = sorted(current)
+    streamed, stream_time = timed(skyalert_followers.diff_sorted, skyalert_followers.iter_snapshot("did:plc:bench"), current_sorted)
+    assert len(streamed) == churned
+
+    print(f"{count:>9} followers | save {save_time * 1000:8.1f} ms | load {load_time * 1000:8.1f} ms | diff {diff_time * 1000:8.1f} ms | stream diff {stream_time * 1000:8.1f} ms | {file_size / 1024:9.1f} KiB", file=sys.stderr)
+    return {
+        f"followers.save.{count}": save_time,
+        f"followers.load.{count}": load_time,
+        f"followers.diff.{count}": diff_time,
+        f"followers.stream_diff.{count}": stream_time,
+    }
+
+def run(quick=False, sizes=None):
+    results = {}
+    with tempfile.TemporaryDirectory() as cache_dir:
+        skyalert_followers.CACHE_DIR = cache_dir
+        for size in sizes or (QUICK_SIZES if quick else DEFAULT_SIZES):
+            results.update(bench_size(size))
+    return results
+
+if __name__ == '__main__':
+    report(run(sizes=[int(size) for size in sys.argv[1:]] or None), file=sys.stdout)
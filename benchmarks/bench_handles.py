@@ -0,0 +1,58 @@
+import sys
+import random
+import string
+
+from common import SEED, per_call, report
+from skyalert_handles import bridgy_to_fed, fed_to_bridgy, post_url_from_at_uri
+
+# Handle conversion benchmark: bridgy_to_fed and fed_to_bridgy on a mix of bsky.social, custom domain and
+# Bridgy Fed handles, and post_url_from_at_uri on post URIs.
+# Run with: python benchmarks/bench_handles.py
+
+HANDLES = 10_000
+DOMAINS = ["mastodon.social", "fosstodon.org", "hachyderm.io", "mas.to", "example.com", "littlebitstudios.com"]
+
+def make_name(rng):
+    return ''.join(rng.choices(string.ascii_lowercase + string.digits, k=rng.randint(3, 16)))
+
+def make_handles(rng):
+    handles = []
+    for _ in range(HANDLES):
+        roll = rng.random()
+        if roll < 0.6:
+            handles.append(f"{make_name(rng)}.bsky.social")
+        elif roll < 0.85:
+            handles.append(f"{make_name(rng)}.{rng.choice(DOMAINS)}")
+        else:
+            handles.append(f"{make_name(rng)}.{rng.choice(DOMAINS)}.ap.brid.gy")
+    return handles
+
+# what users type into commands: bare names, @handles, full handles and Fediverse addresses
+def make_inputs(rng):
+    inputs = []
+    for _ in range(HANDLES):
+        roll = rng.random()
+        if roll < 0.3:
+            inputs.append(make_name(rng))
+        elif roll < 0.6:
+            inputs.append(f"@{make_name(rng)}.bsky.social")
+        elif roll < 0.8:
+            inputs.append(f"{make_name(rng)}.{rng.choice(DOMAINS)}")
+        else:
+            inputs.append(f"@{make_name(rng)}@{rng.choice(DOMAINS)}")
+    return inputs
+
+def run(quick=False):
+    rng = random.Random(SEED)
+    handles = make_handles(rng)
+    inputs = make_inputs(rng)
+    uris = [f"at://did:plc:{make_name(rng)}/app.bsky.feed.post/{rng.randrange(10**12)}" for _ in range(HANDLES)]
+    assert fed_to_bridgy("@user@mastodon.social") == "user.mastodon.social.ap.brid.gy"
+    return {
+        f"handles.bridgy_to_fed.{HANDLES}": per_call(bridgy_to_fed, handles),
+        f"handles.fed_to_bridgy.{HANDLES}": per_call(fed_to_bridgy, inputs),
+        f"handles.post_url_from_at_uri.{HANDLES}": per_call(post_url_from_at_uri, uris),
+    }
+
+if __name__ == "__main__":
+    report(run(), file=sys.stdout)
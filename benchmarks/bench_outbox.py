@@ -0,0 +1,82 @@
+import sys
+import random
+from collections import deque
+
+from common import SEED, per_call, report
+from skyalert_outbox import Digest, FairQueue
+
+# Outbound DM scheduling under skewed load: one receiver watching busy accounts gets a burst of DMs on
+# top of steady notifications for everyone else, and one DM goes out per SEND_TIME seconds (the chat send
+# rate limit). Reports the p99 wait of the ordinary receivers' DMs in simulated seconds, for a plain FIFO
+# and for the FairQueue the dispatchers use, and how long put and pop take.
+# Run with: python benchmarks/bench_outbox.py
+
+RECEIVERS = 200
+BURST = 500 # DMs for the busy receiver, arriving BURST_RATE per second
+BURST_RATE = 10
+ORDINARY_RATE = 0.5 # DMs per second for everyone else together
+DURATION = 300 # seconds of arrivals
+SEND_TIME = 1.0
+QUEUE_ITEMS = 100_000
+
+class Fifo:
+    def __init__(self):
+        self.items = deque()
+
+    def put(self, receiver, item, urgent=False):
+        self.items.append(item)
+
+    def pop(self):
+        return self.items.popleft() if self.items else None
+
+def make_arrivals(rng):
+    arrivals = [(index / BURST_RATE, "busy") for index in range(BURST)]
+    moment = 0.0
+    while moment < DURATION:
+        moment += rng.expovariate(ORDINARY_RATE)
+        arrivals.append((moment, f"receiver-{rng.randrange(RECEIVERS)}"))
+    arrivals.sort()
+    return arrivals
+
+# p99 of how long ordinary receivers' DMs waited before they were sent
+def simulate(queue, arrivals):
+    waits = []
+    pending = deque(arrivals)
+    now = 0.0
+    while True:
+        while pending and pending[0][0] <= now:
+            arrived, receiver = pending.popleft()
+            queue.put(receiver, (arrived, receiver))
+        item = queue.pop()
+        if item is None:
+            if not pending:
+                break
+            now = pending[0][0]
+            continue
+        for arrived, receiver in (item.deliveries if isinstance(item, Digest) else [item]):
+            if receiver != "busy":
+                waits.append(now - arrived)
+        now += SEND_TIME
+    waits.sort()
+    return waits[int(len(waits) * 0.99)]
+
+def run(quick=False):
+    rng = random.Random(SEED)
+    arrivals = make_arrivals(rng)
+    fifo = simulate(Fifo(), arrivals)
+    fair = simulate(FairQueue(), arrivals)
+    assert fair < fifo
+
+    queue = FairQueue(cap=None) # uncapped, so every pop returns one of the items put
+    receivers = [f"receiver-{rng.randrange(RECEIVERS)}" for _ in range(QUEUE_ITEMS)]
+    put = per_call(lambda receiver: queue.put(receiver, receiver), receivers, repeat=1)
+    pop = per_call(lambda _: queue.pop(), receivers, repeat=1)
+    return {
+        f"outbox.fifo_p99_wait.{RECEIVERS}": fifo,
+        f"outbox.fair_p99_wait.{RECEIVERS}": fair,
+        f"outbox.fair_put.{QUEUE_ITEMS}": put,
+        f"outbox.fair_pop.{QUEUE_ITEMS}": pop,
+    }
+
+if __name__ == "__main__":
+    report(run(), file=sys.stdout)
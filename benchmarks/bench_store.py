@@ -0,0 +1,69 @@
+import sys
+import random
+import string
+
+from common import SEED, per_call, once, report, temp_store
+import skyalert_store
+
+# Watch store benchmark at 1k/100k/1M watches. Covers what the firehose does per event (match the author
+# against the watches through the store snapshot, mostly for accounts nobody watches), what the command
+# service does per command (single-row saves), and loading the snapshot after a change.
+# Run with: python benchmarks/bench_store.py [watch counts...]
+
+DEFAULT_SIZES = [1_000, 100_000, 1_000_000]
+QUICK_SIZES = [1_000, 100_000]
+EVENTS = 20_000
+HIT_RATE = 0.01 # share of firehose events from a watched account
+WRITES = 500
+
+def make_did(rng):
+    return f"did:plc:{''.join(rng.choices(string.ascii_lowercase + '234567', k=24))}"
+
+# A few popular subjects and many with one or two watchers, spread over a receiver base a tenth the size.
+def make_watches(rng, count):
+    subjects = [make_did(rng) for _ in range(max(count // 4, 1))]
+    receivers = [make_did(rng) for _ in range(max(count // 10, 1))]
+    watches = set()
+    while len(watches) < count:
+        subject = subjects[min(int(rng.paretovariate(1.1)) - 1, len(subjects) - 1)] if rng.random() < 0.3 else rng.choice(subjects)
+        watches.add((rng.choice(receivers), subject))
+    return sorted(watches), subjects
+
+def fill(watches, rng):
+    with skyalert_store.transaction() as conn:
+        conn.executemany(f"INSERT INTO user_watches ({skyalert_store.WATCH_COLUMNS}) VALUES (?, ?, ?, ?, ?)",
+            ((receiver, subject, "receiver.bsky.social", "subject.bsky.social", rng.random() < 0.5) for receiver, subject in watches))
+        conn.executemany("INSERT OR REPLACE INTO reply_settings (did, replies_allowed) VALUES (?, ?)",
+            ((receiver, rng.random() < 0.5) for receiver, _ in watches[::7]))
+
+def match(did):
+    return skyalert_store.snapshot().watches_for_subject(did)
+
+def bench_size(count):
+    rng = random.Random(SEED + count)
+    with temp_store():
+        watches, subjects = make_watches(rng, count)
+        fill(watches, rng)
+
+        events = [rng.choice(subjects) if rng.random() < HIT_RATE else make_did(rng) for _ in range(EVENTS)]
+        snapshot, load_time = once(skyalert_store.Snapshot, skyalert_store._connect(), repeat=3)
+        assert len(snapshot.subjects) == len({subject for _, subject in watches})
+        results = {
+            f"store.snapshot_load.{count}": load_time,
+            f"store.match.{count}": per_call(match, events),
+            f"store.match_uncached.{count}": per_call(skyalert_store.watches_for_subject, events),
+        }
+
+        new_watches = [{'receiver-did': make_did(rng), 'subject-did': rng.choice(subjects), 'receiver-handle': 'new.bsky.social', 'subject-handle': 'subject.bsky.social', 'reposts-allowed': False} for _ in range(WRITES)]
+        results[f"store.save_watch.{count}"] = per_call(skyalert_store.add_user_watch, new_watches, repeat=1)
+        results[f"store.remove_watch.{count}"] = per_call(lambda watch: skyalert_store.remove_user_watch(watch['receiver-did'], watch['subject-did']), new_watches, repeat=1)
+        return results
+
+def run(quick=False, sizes=None):
+    results = {}
+    for count in sizes or (QUICK_SIZES if quick else DEFAULT_SIZES):
+        results.update(bench_size(count))
+    return results
+
+if __name__ == "__main__":
+    report(run(sizes=[int(arg) for arg in sys.argv[1:]] or None), file=sys.stdout)
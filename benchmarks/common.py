@@ -0,0 +1,63 @@
+import os
+import sys
+import time
+import tempfile
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Shared pieces of the benchmark suite. Every benchmark module has a run(quick) function returning a dict
+# of result name -> seconds per operation, named "<benchmark>.<case>.<size>"; run_all.py collects them.
+# Timings are the best of several repeats, which is the figure least disturbed by the rest of the machine.
+
+SEED = 672
+REPEAT = 3
+
+# Seconds per item for calling func on every item, best of REPEAT passes.
+def per_call(func, items, repeat=REPEAT):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for item in items:
+            func(item)
+        elapsed = (time.perf_counter() - start) / len(items)
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+# Seconds for one call of func(*args), best of repeat calls; returns the last result too.
+def once(func, *args, repeat=1):
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+def format_seconds(seconds):
+    if seconds >= 1:
+        return f"{seconds:.2f} s"
+    if seconds >= 1e-3:
+        return f"{seconds * 1e3:.2f} ms"
+    return f"{seconds * 1e6:.2f} us"
+
+def report(results, file=sys.stderr):
+    for name, seconds in results.items():
+        print(f"  {name:<40} {format_seconds(seconds):>12}", file=file)
+
+# Points skyalert_store at a fresh database in a temporary directory while in use, for benchmarks that
+# need one.
+@contextmanager
+def temp_store():
+    import skyalert_store
+    with tempfile.TemporaryDirectory(prefix="skyalert-bench-") as directory:
+        skyalert_store.STORE_FILE = os.path.join(directory, "skyalert.db")
+        skyalert_store.CONFIG_FILE = os.path.join(directory, "config.yaml")
+        skyalert_store._local.conn = None # reconnect to the new file on next use
+        try:
+            yield directory
+        finally:
+            if skyalert_store._local.conn is not None:
+                skyalert_store._local.conn.close()
+                skyalert_store._local.conn = None
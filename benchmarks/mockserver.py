@@ -0,0 +1,518 @@
+import re
+import sys
+import json
+import time
+import base64
+import random
+import asyncio
+import argparse
+import datetime
+from collections import OrderedDict, Counter, deque
+
+import libipld
+from aiohttp import web
+
+from common import SEED
+from bench_commits import cid_for, car_file
+import skyalert_ratelimit
+import skyalert_store
+
+# Local stand-in for the parts of Bluesky SkyAlert talks to, for load testing the services end to end
+# without touching the live network. It serves the XRPC endpoints the services call (sessions, profiles,
+# followers, posts, chat), a synthetic firehose (com.atproto.sync.subscribeRepos) and a synthetic Jetstream
+# (/subscribe) at configurable event rates, and can add latency and emulate rate limits.
+#
+# Events come from the accounts watched in the local store (skyalert_store) for --watched-fraction of
+# them, the rest from made up accounts nobody watches, so a copy of a real skyalert.db gives a realistic
+# load. Every post the mock emits is remembered, and when a DM linking to it arrives through sendMessage
+# the time between the two is recorded: GET /mock/stats reports DM throughput and notification latency.
+# POST /mock/messages {"sender": did or handle, "text": "!help"} delivers a DM to the bot, for the
+# command services.
+#
+# Point the services at it with data/endpoints.yaml (see example-endpoints.yaml), then e.g.:
+#   python benchmarks/mockserver.py --firehose-rate 500 --watched-fraction 0.05 --latency-ms 40 \
+#       --rate-limits chat-send=20/1,profile=3000/300
+
+DEFAULT_PORT = 2583
+MOCK_HANDLE_SUFFIX = ".mock.test"
+TID_ALPHABET = "234567abcdefghijklmnopqrstuvwxyz"
+MAX_REMEMBERED = 1_000_000 # posts remembered for getPosts/getPostThread and latency matching
+MAX_LATENCIES = 100_000
+POST_LINK = re.compile(r'/post/([2-7a-z]{13})')
+TICK = 0.01 # seconds between event batches on the streams
+
+def tid(counter):
+    chars = []
+    for _ in range(13):
+        chars.append(TID_ALPHABET[counter & 31])
+        counter >>= 5
+    return ''.join(reversed(chars))
+
+def now_iso():
+    return datetime.datetime.now(datetime.timezone.utc).isoformat().replace('+00:00', 'Z')
+
+def _b64(data):
+    return base64.urlsafe_b64encode(json.dumps(data).encode()).rstrip(b'=').decode()
+
+# Unsigned, but shaped like the tokens the PDS hands out, so the client can read the expiry.
+def make_jwt(did, scope, lifetime):
+    issued = int(time.time())
+    return f"{_b64({'typ': 'at+jwt', 'alg': 'ES256K'})}.{_b64({'scope': scope, 'sub': did, 'iat': issued, 'exp': issued + lifetime, 'aud': 'did:web:mock.test'})}.c2ln"
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)]
+
+class XrpcError(Exception):
+    def __init__(self, status, error, message=None, headers=None):
+        super().__init__(message or error)
+        self.status = status
+        self.error = error
+        self.message = message or error
+        self.headers = headers or {}
+
+# Fixed window limits per skyalert_ratelimit endpoint class, answered with the same ratelimit-* headers the
+# real services send.
+class RateLimits:
+    def __init__(self, limits):
+        self.limits = limits # class -> (calls per window, window seconds)
+        self.windows = {} # class -> [window start, calls]
+        self.rejected = Counter()
+
+    def check(self, nsid):
+        name = skyalert_ratelimit.endpoint_class(f"/xrpc/{nsid}")
+        if name not in self.limits:
+            return {}
+        limit, window = self.limits[name]
+        now = time.time()
+        start, calls = self.windows.get(name, (now, 0))
+        if now - start >= window:
+            start, calls = now, 0
+        headers = {'ratelimit-limit': str(limit), 'ratelimit-reset': str(int(start + window)), 'ratelimit-policy': f"{limit};w={window:g}"}
+        if calls >= limit:
+            self.rejected[name] += 1
+            headers['ratelimit-remaining'] = '0'
+            raise XrpcError(429, 'RateLimitExceeded', 'Rate Limit Exceeded', headers)
+        self.windows[name] = (start, calls + 1)
+        headers['ratelimit-remaining'] = str(limit - calls - 1)
+        return headers
+
+def parse_rate_limits(text):
+    limits = {}
+    for part in (text or '').split(','):
+        if not part.strip():
+            continue
+        name, _, spec = part.partition('=')
+        calls, _, window = spec.partition('/')
+        limits[name.strip()] = (int(calls), float(window or 1))
+    return limits
+
+class MockNetwork:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.started = time.time()
+        self.counter = int(time.time() * 1_000_000) << 10 # TIDs start from the current time, like real ones
+        self.seq = 0
+        self.handles = {} # did -> handle
+        self.dids = {} # handle -> did
+        self.subjects = []
+        self.posts = OrderedDict() # at uri -> post view
+        self.emitted = OrderedDict() # rkey -> time the post was emitted
+        self.convos = {} # convo id -> {'id', 'rev', 'members', 'messages'}
+        self.convos_by_members = {}
+        self.log = [] # (rev, convo id, message) in rev order
+        self.rate_limits = RateLimits(parse_rate_limits(args.rate_limits))
+        self.calls = Counter()
+        self.events = Counter()
+        self.dms = 0
+        self.latencies = deque(maxlen=MAX_LATENCIES)
+        self.bot_did = None
+        self.load_watches()
+        self.others = [self.make_did() for _ in range(args.accounts)]
+
+    def next_tid(self):
+        self.counter += 1
+        return tid(self.counter)
+
+    def make_did(self):
+        return f"did:plc:{''.join(self.rng.choices(TID_ALPHABET, k=24))}"
+
+    def load_watches(self):
+        subjects = set()
+        for watch in skyalert_store.iter_user_watches():
+            subjects.add(watch['subject-did'])
+            for did, handle in ((watch['subject-did'], watch['subject-handle']), (watch['receiver-did'], watch['receiver-handle'])):
+                if handle:
+                    self.handles[did] = handle
+                    self.dids[handle] = did
+        self.subjects = sorted(subjects)
+        print(f"Loaded {len(self.subjects)} watched accounts from the store.", file=sys.stderr)
+
+    # identities
+
+    def handle_for(self, did):
+        handle = self.handles.get(did)
+        if handle is None:
+            handle = did.rsplit(':', 1)[-1][:12] + MOCK_HANDLE_SUFFIX
+            self.handles[did] = handle
+            self.dids[handle] = did
+        return handle
+
+    def did_for(self, actor, create=False):
+        if actor.startswith('did:'):
+            return actor
+        actor = actor.lstrip('@')
+        if actor in self.dids:
+            return self.dids[actor]
+        if actor.endswith(MOCK_HANDLE_SUFFIX) and not create:
+            raise XrpcError(400, 'InvalidRequest', 'Profile not found')
+        # any other handle gets an account of its own, so commands naming new users work
+        did = self.make_did()
+        self.handles[did] = actor
+        self.dids[actor] = did
+        return did
+
+    def profile(self, did):
+        handle = self.handle_for(did)
+        return {'did': did, 'handle': handle, 'displayName': handle.split('.')[0]}
+
+    # events
+
+    def remember(self, mapping, key, value):
+        mapping[key] = value
+        if len(mapping) > MAX_REMEMBERED:
+            mapping.popitem(last=False)
+
+    def make_post(self, author, rkey):
+        text = ' '.join(self.rng.choice(['hello', 'bluesky', 'skyalert', 'load', 'test', '🦋']) for _ in range(self.rng.randint(3, 30)))
+        record = {'$type': 'app.bsky.feed.post', 'text': text, 'createdAt': now_iso(), 'langs': ['en']}
+        if self.rng.random() < self.args.reply_fraction:
+            parent = f"at://{self.rng.choice(self.others)}/app.bsky.feed.post/{self.next_tid()}"
+            parent_ref = {'uri': parent, 'cid': libipld.encode_cid(cid_for(parent.encode()))}
+            record['reply'] = {'root': parent_ref, 'parent': parent_ref}
+        return record
+
+    # One event: a post or repost by a watched account (--watched-fraction of the time) or by anybody else.
+    def make_event(self):
+        if self.subjects and self.rng.random() < self.args.watched_fraction:
+            author = self.rng.choice(self.subjects)
+        else:
+            author = self.rng.choice(self.others)
+        rkey = self.next_tid()
+        emitted_at = time.time()
+        if self.rng.random() < self.args.repost_fraction:
+            # the DM for a repost links to the reposted post, so that is the one timed
+            subject_author = self.rng.choice(self.others)
+            subject_rkey = self.next_tid()
+            subject = self.add_post(subject_author, subject_rkey, self.make_post(subject_author, subject_rkey), emitted_at)
+            record = {'$type': 'app.bsky.feed.repost', 'subject': {'uri': subject['uri'], 'cid': subject['cid']}, 'createdAt': now_iso()}
+            collection = 'app.bsky.feed.repost'
+        else:
+            record = self.make_post(author, rkey)
+            self.add_post(author, rkey, record, emitted_at)
+            collection = 'app.bsky.feed.post'
+        return {'did': author, 'collection': collection, 'rkey': rkey, 'record': record}
+
+    def add_post(self, author, rkey, record, emitted_at):
+        uri = f"at://{author}/app.bsky.feed.post/{rkey}"
+        post = {'uri': uri, 'cid': libipld.encode_cid(cid_for(uri.encode())), 'author': self.profile(author), 'record': record, 'indexedAt': now_iso()}
+        self.remember(self.posts, uri, post)
+        self.remember(self.emitted, rkey, emitted_at)
+        return post
+
+    def post_view(self, uri):
+        post = self.posts.get(uri)
+        if post is None:
+            author = uri.split('/')[2]
+            rkey = uri.rsplit('/', 1)[-1]
+            post = {'uri': uri, 'cid': libipld.encode_cid(cid_for(uri.encode())), 'author': self.profile(author), 'record': self.make_post(author, rkey), 'indexedAt': now_iso()}
+        return post
+
+    def firehose_frame(self, event):
+        data = libipld.encode_dag_cbor(event['record'])
+        cid = cid_for(data)
+        self.seq += 1
+        body = {
+            'seq': self.seq, 'rebase': False, 'tooBig': False, 'repo': event['did'], 'commit': cid, 'rev': event['rkey'],
+            'since': None, 'blocks': car_file([(cid, data)]), 'blobs': [], 'time': now_iso(),
+            'ops': [{'action': 'create', 'path': f"{event['collection']}/{event['rkey']}", 'cid': cid}],
+        }
+        return libipld.encode_dag_cbor({'op': 1, 't': '#commit'}) + libipld.encode_dag_cbor(body)
+
+    def jetstream_message(self, event):
+        return json.dumps({
+            'did': event['did'], 'time_us': int(time.time() * 1_000_000), 'kind': 'commit',
+            'commit': {'rev': event['rkey'], 'operation': 'create', 'collection': event['collection'], 'rkey': event['rkey'],
+                'record': event['record'], 'cid': libipld.encode_cid(cid_for(json.dumps(event['record']).encode()))},
+        })
+
+    # chat
+
+    def convo_for(self, members):
+        key = frozenset(members)
+        convo = self.convos_by_members.get(key)
+        if convo is None:
+            convo = {'id': self.next_tid(), 'rev': self.next_tid(), 'members': sorted(key), 'messages': []}
+            self.convos[convo['id']] = convo
+            self.convos_by_members[key] = convo
+        return convo
+
+    def convo_view(self, convo):
+        view = {'id': convo['id'], 'rev': convo['rev'], 'members': [self.profile(did) for did in convo['members']], 'muted': False, 'unreadCount': 0}
+        if convo['messages']:
+            view['lastMessage'] = convo['messages'][-1]
+        return view
+
+    def add_message(self, convo, sender, text, facets=None):
+        rev = self.next_tid()
+        message = {'$type': 'chat.bsky.convo.defs#messageView', 'id': rev, 'rev': rev, 'text': text, 'sender': {'did': sender}, 'sentAt': now_iso()}
+        if facets:
+            message['facets'] = facets
+        convo['messages'].append(message)
+        convo['rev'] = rev
+        self.log.append((rev, convo['id'], message))
+        return message
+
+    def record_dm(self, text):
+        self.dms += 1
+        for rkey in POST_LINK.findall(text):
+            emitted_at = self.emitted.get(rkey)
+            if emitted_at is not None:
+                self.latencies.append(time.time() - emitted_at)
+                break
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        uptime = time.time() - self.started
+        return {
+            'uptime': round(uptime, 1),
+            'events': dict(self.events),
+            'calls': dict(self.calls),
+            'rate_limited': dict(self.rate_limits.rejected),
+            'dms_sent': self.dms,
+            'dms_per_second': round(self.dms / uptime, 2) if uptime else 0,
+            'notification_latency': {
+                'count': len(latencies),
+                'p50': percentile(latencies, 0.50),
+                'p90': percentile(latencies, 0.90),
+                'p99': percentile(latencies, 0.99),
+                'max': latencies[-1] if latencies else None,
+            },
+        }
+
+    def reset_stats(self):
+        self.started = time.time()
+        self.calls.clear()
+        self.events.clear()
+        self.rate_limits.rejected.clear()
+        self.dms = 0
+        self.latencies.clear()
+
+# XRPC methods: nsid -> handler(network, params, body) returning the response JSON.
+
+def create_session(network, params, body):
+    identifier = body.get('identifier', 'skyalert' + MOCK_HANDLE_SUFFIX)
+    did = network.did_for(identifier, create=True)
+    network.bot_did = did
+    return session_response(network, did)
+
+def refresh_session(network, params, body):
+    return session_response(network, network.bot_did or network.make_did())
+
+def session_response(network, did):
+    return {
+        'accessJwt': make_jwt(did, 'com.atproto.appPass', network.args.token_lifetime),
+        'refreshJwt': make_jwt(did, 'com.atproto.refresh', 90 * 24 * 3600),
+        'handle': network.handle_for(did), 'did': did, 'active': True,
+    }
+
+def get_profile(network, params, body):
+    return network.profile(network.did_for(params['actor']))
+
+def get_profiles(network, params, body):
+    return {'profiles': [network.profile(network.did_for(actor)) for actor in params.getall('actors', [])]}
+
+def resolve_handle(network, params, body):
+    return {'did': network.did_for(params['handle'])}
+
+# Followers are made up per account from the seed, so repeated sweeps see the same list.
+def get_followers(network, params, body):
+    did = network.did_for(params['actor'])
+    rng = random.Random(f"{network.args.seed}-{did}")
+    count = rng.randint(0, network.args.max_followers)
+    start = int(params.get('cursor') or 0)
+    limit = int(params.get('limit') or 50)
+    followers = []
+    for index in range(start, min(start + limit, count)):
+        follower = f"did:plc:{''.join(random.Random(f'{did}-{index}').choices(TID_ALPHABET, k=24))}"
+        followers.append(network.profile(follower))
+    response = {'subject': network.profile(did), 'followers': followers}
+    if start + limit < count:
+        response['cursor'] = str(start + limit)
+    return response
+
+def get_post_thread(network, params, body):
+    return {'thread': {'$type': 'app.bsky.feed.defs#threadViewPost', 'post': network.post_view(params['uri'])}}
+
+def get_posts(network, params, body):
+    return {'posts': [network.post_view(uri) for uri in params.getall('uris', [])]}
+
+def get_convo_for_members(network, params, body):
+    return {'convo': network.convo_view(network.convo_for(params.getall('members', [])))}
+
+def send_message(network, params, body):
+    convo = network.convos.get(body.get('convoId'))
+    if convo is None:
+        raise XrpcError(400, 'InvalidConvo', 'Convo not found')
+    message = body.get('message') or {}
+    network.record_dm(message.get('text', ''))
+    return network.add_message(convo, network.bot_did, message.get('text', ''), message.get('facets'))
+
+def list_convos(network, params, body):
+    convos = sorted(network.convos.values(), key=lambda convo: convo['rev'], reverse=True)
+    return {'convos': [network.convo_view(convo) for convo in convos]}
+
+def get_messages(network, params, body):
+    convo = network.convos.get(params.get('convoId'))
+    if convo is None:
+        raise XrpcError(400, 'InvalidConvo', 'Convo not found')
+    return {'messages': list(reversed(convo['messages']))}
+
+def get_log(network, params, body):
+    cursor = params.get('cursor') or ''
+    logs = [{'$type': 'chat.bsky.convo.defs#logCreateMessage', 'rev': rev, 'convoId': convo_id, 'message': message}
+        for rev, convo_id, message in network.log if rev > cursor][:100]
+    return {'logs': logs, 'cursor': logs[-1]['rev'] if logs else cursor or None}
+
+METHODS = {
+    'com.atproto.server.createSession': create_session,
+    'com.atproto.server.refreshSession': refresh_session,
+    'com.atproto.identity.resolveHandle': resolve_handle,
+    'app.bsky.actor.getProfile': get_profile,
+    'app.bsky.actor.getProfiles': get_profiles,
+    'app.bsky.graph.getFollowers': get_followers,
+    'app.bsky.feed.getPostThread': get_post_thread,
+    'app.bsky.feed.getPosts': get_posts,
+    'chat.bsky.convo.getConvoForMembers': get_convo_for_members,
+    'chat.bsky.convo.sendMessage': send_message,
+    'chat.bsky.convo.listConvos': list_convos,
+    'chat.bsky.convo.getMessages': get_messages,
+    'chat.bsky.convo.getLog': get_log,
+}
+UNAUTHENTICATED = {'com.atproto.server.createSession', 'com.atproto.identity.resolveHandle'}
+
+async def handle_xrpc(request):
+    network = request.app['network']
+    nsid = request.match_info['nsid']
+    network.calls[nsid] += 1
+    args = network.args
+    if args.latency_ms or args.jitter_ms:
+        await asyncio.sleep(max(args.latency_ms + network.rng.uniform(-args.jitter_ms, args.jitter_ms), 0) / 1000)
+    headers = {}
+    try:
+        method = METHODS.get(nsid)
+        if method is None:
+            raise XrpcError(501, 'MethodNotImplemented', f"{nsid} is not implemented by the mock server")
+        if nsid not in UNAUTHENTICATED and not request.headers.get('Authorization'):
+            raise XrpcError(401, 'AuthMissing', 'Authentication Required')
+        headers = network.rate_limits.check(nsid)
+        body = await request.json() if request.method == 'POST' and request.can_read_body else {}
+        try:
+            result = method(network, request.query, body)
+        except KeyError as e:
+            raise XrpcError(400, 'InvalidRequest', f"missing parameter {e}")
+        return web.json_response(result, headers=headers)
+    except XrpcError as e:
+        return web.json_response({'error': e.error, 'message': e.message}, status=e.status, headers={**headers, **e.headers})
+
+# Sends events to one stream subscriber at the given rate until it disconnects.
+async def stream_events(request, rate, encode, name):
+    network = request.app['network']
+    websocket = web.WebSocketResponse()
+    await websocket.prepare(request)
+
+    async def send():
+        due = 0.0
+        last = time.monotonic()
+        while not websocket.closed:
+            await asyncio.sleep(TICK)
+            now = time.monotonic()
+            due += (now - last) * rate
+            last = now
+            while due >= 1 and not websocket.closed:
+                due -= 1
+                event = network.make_event()
+                network.events[name] += 1
+                if name == 'firehose':
+                    await websocket.send_bytes(encode(event))
+                else:
+                    await websocket.send_str(encode(event))
+
+    sender = asyncio.create_task(send())
+    try:
+        # reading is what answers the subscriber's close frame
+        async for _ in websocket:
+            pass
+    finally:
+        sender.cancel()
+        try:
+            await sender
+        except (asyncio.CancelledError, ConnectionError):
+            pass
+    return websocket
+
+async def handle_firehose(request):
+    network = request.app['network']
+    return await stream_events(request, network.args.firehose_rate, network.firehose_frame, 'firehose')
+
+async def handle_jetstream(request):
+    network = request.app['network']
+    return await stream_events(request, network.args.jetstream_rate, network.jetstream_message, 'jetstream')
+
+async def handle_stats(request):
+    return web.json_response(request.app['network'].stats())
+
+async def handle_reset_stats(request):
+    request.app['network'].reset_stats()
+    return web.json_response({})
+
+async def handle_inject_message(request):
+    network = request.app['network']
+    body = await request.json()
+    if network.bot_did is None:
+        return web.json_response({'error': 'the bot has not logged in yet'}, status=409)
+    sender = network.did_for(body['sender'])
+    convo = network.convo_for([sender, network.bot_did])
+    return web.json_response(network.add_message(convo, sender, body['text']))
+
+def make_app(args):
+    app = web.Application()
+    app['network'] = MockNetwork(args)
+    app.router.add_get('/xrpc/com.atproto.sync.subscribeRepos', handle_firehose)
+    app.router.add_get('/subscribe', handle_jetstream)
+    app.router.add_route('*', '/xrpc/{nsid}', handle_xrpc)
+    app.router.add_get('/mock/stats', handle_stats)
+    app.router.add_post('/mock/stats/reset', handle_reset_stats)
+    app.router.add_post('/mock/messages', handle_inject_message)
+    return app
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the Bluesky and chat APIs SkyAlert uses.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--seed', type=int, default=SEED)
+    parser.add_argument('--firehose-rate', type=float, default=100, help="firehose events per second, per subscriber")
+    parser.add_argument('--jetstream-rate', type=float, default=100, help="Jetstream events per second, per subscriber")
+    parser.add_argument('--watched-fraction', type=float, default=0.01, help="share of events from accounts watched in the store")
+    parser.add_argument('--repost-fraction', type=float, default=0.2)
+    parser.add_argument('--reply-fraction', type=float, default=0.1)
+    parser.add_argument('--accounts', type=int, default=10_000, help="made up accounts posting besides the watched ones")
+    parser.add_argument('--max-followers', type=int, default=500, help="most followers a made up account has")
+    parser.add_argument('--latency-ms', type=float, default=0, help="added to every XRPC call")
+    parser.add_argument('--jitter-ms', type=float, default=0, help="random +/- on top of --latency-ms")
+    parser.add_argument('--rate-limits', help="per endpoint class (see skyalert_ratelimit), e.g. chat-send=20/1,profile=3000/300")
+    parser.add_argument('--token-lifetime', type=int, default=2 * 3600, help="seconds until access tokens expire")
+    args = parser.parse_args()
+    web.run_app(make_app(args), host=args.host, port=args.port)
@@ -0,0 +1,89 @@
+import os
+import sys
+import json
+import argparse
+import platform
+import datetime
+
+from common import SEED, report
+import bench_commits
+import bench_facets
+import bench_followers
+import bench_handles
+import bench_outbox
+import bench_store
+
+# Runs the whole benchmark suite offline and writes the results as JSON: seconds per operation for every
+# "<benchmark>.<case>.<size>". Results are checked against the ceilings in thresholds.json, and with
+# --baseline against an earlier results file, so a change that slows a hot path fails the run (exit 1).
+#   python benchmarks/run_all.py --output before.json
+#   (make a change)
+#   python benchmarks/run_all.py --baseline before.json
+# --quick skips the 1M sizes. Progress and a summary go to stderr.
+
+BENCHMARKS = {
+    'commits': bench_commits,
+    'store': bench_store,
+    'facets': bench_facets,
+    'handles': bench_handles,
+    'followers': bench_followers,
+    'outbox': bench_outbox,
+}
+THRESHOLDS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'thresholds.json')
+
+def load_json(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+# Returns a list of failure messages: results over their ceiling, and results slower than the baseline
+# by more than the tolerance. Results that only exist on one side are skipped.
+def check(results, thresholds, baseline=None, tolerance=None):
+    failures = []
+    for name, limit in thresholds.get('limits', {}).items():
+        if name in results and results[name] > limit:
+            failures.append(f"{name}: {results[name]:.3g}s is over the {limit:.3g}s limit")
+    if baseline is not None:
+        tolerance = tolerance or thresholds.get('tolerance', 1.5)
+        for name, seconds in results.items():
+            previous = baseline.get(name)
+            if previous and seconds > previous * tolerance:
+                failures.append(f"{name}: {seconds:.3g}s vs {previous:.3g}s in the baseline ({seconds / previous:.2f}x)")
+    return failures
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the SkyAlert benchmarks and check them for regressions.")
+    parser.add_argument('--quick', action='store_true', help="skip the largest sizes")
+    parser.add_argument('--only', help="comma separated benchmarks to run: " + ", ".join(BENCHMARKS))
+    parser.add_argument('--output', help="write the results to this file instead of stdout")
+    parser.add_argument('--baseline', help="earlier results file to compare against")
+    parser.add_argument('--tolerance', type=float, help="slowdown allowed against the baseline (default from thresholds.json)")
+    args = parser.parse_args()
+
+    selected = args.only.split(',') if args.only else list(BENCHMARKS)
+    results = {}
+    for name in selected:
+        print(f"{name}:", file=sys.stderr)
+        benchmark_results = BENCHMARKS[name].run(quick=args.quick)
+        report(benchmark_results)
+        results.update(benchmark_results)
+
+    output = {
+        'seed': SEED,
+        'quick': args.quick,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'time': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+    else:
+        json.dump(output, sys.stdout, indent=2)
+        print()
+
+    baseline = load_json(args.baseline)['results'] if args.baseline else None
+    failures = check(results, load_json(THRESHOLDS_FILE), baseline, args.tolerance)
+    for failure in failures:
+        print(f"REGRESSION {failure}", file=sys.stderr)
+    sys.exit(1 if failures else 0)
@@ -1,135 +1,40 @@
-from atproto import Client, IdResolver, models, SessionEvent
+from atproto import models
 import atproto_client
 import json
 import atproto_client.exceptions
-import yaml
 import os
 import datetime
 import time
-import re
 import tenacity
+import skyalert_chatlog
+import skyalert_facets
+import skyalert_identity
+import skyalert_latency
+import skyalert_outbox
+from skyalert_handles import post_url_from_at_uri, bridgy_to_fed, fed_to_bridgy
+import skyalert_commands
+import skyalert_followers
+import skyalert_sweep
+import skyalert_profiles
+import skyalert_profiling
+import skyalert_watches
+import skyalert_scheduler
+import skyalert_ratelimit
+import skyalert_session
+import skyalert_store
 
 DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
-CONFIG_FILE = os.path.join(DATA_DIR, 'config.yaml')
 CACHE_DIR = os.path.join(DATA_DIR, 'cache')
 LAST_RUN_FILE = os.path.join(DATA_DIR, 'last_run.txt')
 VERBOSE_PRINTING = True
 MAINTAINER_DIDS = ["did:plc:big6e357j2bbrlkyms5vjkgf"]
 
 global client
-client = Client()
+client = skyalert_session.SharedSessionClient(request=skyalert_ratelimit.RateLimitedRequest())
 
-@client.on_session_change
-def on_session_change(event: atproto_client.SessionEvent,session: atproto_client.Session):
-    if event==SessionEvent.CREATE or event==SessionEvent.REFRESH:
-        with open(os.path.join(DATA_DIR, 'login-info.yaml'), 'r') as f1:
-            login_info = yaml.safe_load(f1)
-            with open(os.path.join(DATA_DIR, 'login-info.yaml'), 'w') as f2:
-                new_login_info = {
-                    'username': login_info['username'],
-                    'password': login_info['password'],
-                    'session-key-firehose': session.export(),
-                    'session-key-cmds': login_info['session-key-cmds'] if 'session-key-cmds' in login_info else ""
-                }
-                yaml.dump(new_login_info, f2)
+# tokens come from the session shared by all SkyAlert services; logged in when run as a service, while
+# skyalert-unified.py hands this module its own client
 
-with open(os.path.join(DATA_DIR, 'login-info.yaml'), 'r') as f:
-    login_info = yaml.safe_load(f)
-
-    if 'session-key-firehose' in login_info and login_info['session-key-firehose']:
-        client.login(session_string=login_info['session-key-firehose'])
-    else:
-        client.login(login=login_info['username'], password=login_info['password'])
-
-# Link detection by latchk3y on the Bluesky API Discord server
-def get_facets_from_links(text):
-    pattern = r'(https?://[^\s]+)'
-    links = re.findall(pattern, text)
-
-    facets = []
-    
-    for link in links:
-        start_index = text.index(link)
-        end_index = start_index + len(link)
-        
-        facets.append({
-            "index": {
-                "byteStart": start_index,
-                "byteEnd": end_index              },
-            "features": [
-                {
-                    "$type": "app.bsky.richtext.facet#link",
-                    "uri": link
-                }
-            ]
-        })  
-
-    return facets
-
-def get_facets_from_markdown(text):
-    pattern = r'\[([^\]]+)\]\((https?://[^\s]+)\)'
-    facets = []
-    filtered_text = text
-
-    match = re.search(pattern, filtered_text)
-    while match:
-        link_text, link_url = match.groups()
-        start_index = match.start()
-        end_index = match.end()
-
-        filtered_text = filtered_text[:start_index] + link_text + filtered_text[end_index:]
-        new_start_index = start_index
-        new_end_index = new_start_index + len(link_text)
-
-        facets.append({
-            "index": {
-                "byteStart": new_start_index,
-                "byteEnd": new_end_index
-            },
-            "features": [
-                {
-                    "$type": "app.bsky.richtext.facet#link",
-                    "uri": link_url
-                }
-            ]
-        })
-
-        match = re.search(pattern, filtered_text)
-
-    # Extract links from the filtered text
-    link_pattern = r'(https?://[^\s]+)'
-    links = re.findall(link_pattern, filtered_text)
-
-    for link in links:
-        start_index = filtered_text.index(link)
-        end_index = start_index + len(link)
-        
-        facets.append({
-            "index": {
-                "byteStart": start_index,
-                "byteEnd": end_index
-            },
-            "features": [
-                {
-                    "$type": "app.bsky.richtext.facet#link",
-                    "uri": link
-                }
-            ]
-        })
-
-    return {"facets": facets, "filtered_text": filtered_text}
-
-def get_config():
-    if not os.path.exists(CONFIG_FILE):
-        return {'user_watches': [], 'follow_watches': []}
-    with open(CONFIG_FILE, 'r') as f:
-        config = yaml.safe_load(f)
-        return config
-    
-def save_config(config):
-    with open(CONFIG_FILE, 'w') as f:
-        yaml.dump(config, f)
-        
 def get_last_run():
     if not os.path.exists(LAST_RUN_FILE):
         return None
@@ -149,52 +54,16 @@ def firehose_check():
             else:
                 return False
     
-def post_url_from_at_uri(at_uri):
-    # Split the AT URI to extract the DID and the random string
-    parts = at_uri.split('/')
-    did = parts[2]
-    random_string = parts[-1]
-    
-    # Construct the Bluesky URL
-    url = f"https://bsky.app/profile/{did}/post/{random_string}"
-    return url
+# restarts post notifications; skyalert-unified.py replaces this to restart its own event reader
+def restart_post_service():
+    os.system("systemctl restart skyalert-firehose")
 
-def bridgy_to_fed(handle: str):
-    if handle.endswith("ap.brid.gy"):
-        parts = handle.split('.')
-        if len(parts) >= 3:
-            username = parts[0]
-            domain = '.'.join(parts[1:-3])
-            return f"@{username}@{domain} (Bridgy)"
-        else:
-            return f"@{handle}"
-    else:
-        if handle.endswith("bsky.social"):
-            handle = handle[:-12]  # Remove ".bsky.social" from the end
-        return handle
-    
-def fed_to_bridgy(handle: str):
-    if "@" in handle:
-        parts = handle.split('@')
-        if len(parts) >= 3:  # If given a Fediverse handle, output the Bridgy handle
-            username = parts[1]
-            domain = '.'.join(parts[2:])
-            return f"{username}.{domain}.ap.brid.gy"
-        else:  # If given a normal Bluesky handle, output the handle ensuring there is no @ at the beginning
-            return handle.lstrip('@')
-    else:
-        if not handle.endswith("bsky.social") and '.' not in handle:
-            handle += ".bsky.social"
-        return handle
-
-def send_dm(to,message):
+def deliver_dm(to,message):
     dm_client = client.with_bsky_chat_proxy()
     dm = dm_client.chat.bsky.convo
     
-    # create resolver instance with in-memory cache
-    id_resolver = IdResolver()
-    # resolve DID
-    chat_to = to if "did:plc:" in to else id_resolver.handle.resolve(to)
+    # resolve DID through the shared identity cache
+    chat_to = to if "did:plc:" in to else skyalert_identity.resolve_handle(to)
 
     # create or get conversation with chat_to
     convo = dm.get_convo_for_members(
@@ -202,7 +71,7 @@ def send_dm(to,message):
     ).convo
     
     # filter markdown links from text and get facets
-    content = get_facets_from_markdown(message)
+    content = skyalert_facets.get_facets_from_markdown(message)
     
     # send a message to the conversation
     dm.send_message(
@@ -217,274 +86,233 @@ def send_dm(to,message):
 
     if VERBOSE_PRINTING: print('\nMessage sent!')
 
+# every DM is written to the outbox before it is sent, and retried from there if sending fails; only a DM
+# the chat API refuses outright raises, so callers can send something else instead. Replies are urgent:
+# where they share a dispatcher with notifications (skyalert-unified.py), they go first.
+outbox = skyalert_outbox.Outbox('commands', deliver_dm, urgent=True)
+# Unfollow and watch validation notices aren't replies: a dispatcher sends them in turns with everyone
+# else's DMs (folding a pile of them into digests), so the sweeps hand them over and move on.
+notices = skyalert_outbox.Outbox('notices', deliver_dm)
+
+def send_dm(to,message):
+    outbox.send(to, message, raise_permanent=True)
+
+def send_notice(to, message):
+    notices.send(to, message)
+
 # logic for handling bot commands
+router = skyalert_commands.CommandRouter()
+
+@router.register("!help")
+def help_command(command):
+    if VERBOSE_PRINTING: print(f"Sending help message to {command.sender_handle}...")
+    message = "SkyAlert is a bot that can notify you if someone unfollows you. To set up the bot, send me a DM with the following command:\n\n!followwatch <true/false> - Enable or disable notifications for unfollows. You will be notified when someone unfollows you.\n\nIf you used SkyAlert for post notifications, please use !mywatches to see who you're watching so you can enable notifications for them."
+    send_dm(command.sender_did, message)
+
+@router.register("!watch")
+@router.register("!unwatch")
+@router.register("!repost-default")
+@router.register("!replies")
+def discontinued_command(command):
+    if VERBOSE_PRINTING: print(f"Processing {command.name[1:]} command from {command.sender_handle}...")
+    message = "SkyAlert's post notifications functionality is discontinued because the official Bluesky app can now do post notifications on its own. If you need to see who you were watching, use !mywatches."
+    send_dm(command.sender_did, message)
+
+@router.register("!mywatches")
+def mywatches_command(command):
+    if VERBOSE_PRINTING: print(f"Processing mywatches command from {command.sender_handle}...")
+    # Check follow watch status
+    follow_watch_status = "enabled" if skyalert_store.has_follow_watch(command.sender_did) else "disabled"
+    message = f"Follow watch notifications are {follow_watch_status}.\n\n"
+
+    # List user watches
+    user_watch_list = skyalert_store.watches_for_receiver(command.sender_did)
+    if user_watch_list:
+        message += "You are watching the following subjects:\n"
+        lines = []
+        for watch in user_watch_list:
+            lines.append(f"- {bridgy_to_fed(watch['subject-handle'])} (Reposts allowed: {watch['reposts-allowed']})")
+        message += "\n".join(lines)
+    else:
+        message += "You are not watching any subjects."
+
+    send_dm(command.sender_did, message)
+
+@router.register("!followwatch")
+def followwatch_command(command):
+    if VERBOSE_PRINTING: print(f"Processing followwatch command from {command.sender_handle}...")
+    if len(command.args) != 1 or command.args[0] == "":
+        message = "Not enough arguments. Usage: !followwatch <true/false>"
+        send_dm(command.sender_did, message)
+        return
+    
+    followwatch = command.args[0].lower() == "true"
+    if followwatch:
+        if skyalert_store.add_follow_watch(command.sender_did, command.sender_handle):
+            message = "Notifications enabled for unfollows."
+        else:
+            message = "Notifications already enabled for unfollows."
+    else:
+        if skyalert_store.remove_follow_watch(command.sender_did):
+            message = "Notifications disabled for unfollows."
+        else:
+            message = "Notifications already disabled for unfollows."
+    send_dm(command.sender_did, message)
+
+@router.register("!post-restart")
+def post_restart_command(command):
+    if VERBOSE_PRINTING: print(f"Processing post-restart command from {command.sender_handle}...")
+    if command.sender_did in MAINTAINER_DIDS:
+        restart_post_service()
+        message = "Post service restarted."
+        send_dm(command.sender_did, message)
+    else:
+        message = "You are not LittleBit or someone he trusts. If post notifications have stopped, DM or ping @littlebitstudios.com."
+        send_dm(command.sender_did, message)
+
+@router.register("!profile")
+def profile_command(command):
+    if VERBOSE_PRINTING: print(f"Processing profile command from {command.sender_handle}...")
+    if command.sender_did in MAINTAINER_DIDS:
+        send_dm(command.sender_did, skyalert_profiling.summary(command.args[0] if command.args and command.args[0] else None))
+
+@router.register("!latency")
+def latency_command(command):
+    if VERBOSE_PRINTING: print(f"Processing latency command from {command.sender_handle}...")
+    if command.sender_did in MAINTAINER_DIDS:
+        send_dm(command.sender_did, skyalert_latency.report())
+
+@router.register("!ratelimits")
+def ratelimits_command(command):
+    if VERBOSE_PRINTING: print(f"Processing ratelimits command from {command.sender_handle}...")
+    if command.sender_did in MAINTAINER_DIDS:
+        send_dm(command.sender_did, skyalert_ratelimit.usage_report())
+
+# look up the sender's handle once per command; commands from accounts whose profile can't be loaded are skipped
+def prepare_command(command):
+    try:
+        command.sender_handle = skyalert_identity.get_handle(client, command.sender_did)
+    except atproto_client.exceptions.BadRequestError as e:
+        if VERBOSE_PRINTING: 
+            print("Could not obtain profile information from conversation. Skipping.")
+            print("Faulty DID:", command.sender_did)
+        return False
+    return True
+
 def bot_commands_handler():
     dm_client = client.with_bsky_chat_proxy()
     dm = dm_client.chat.bsky.convo
     
     if VERBOSE_PRINTING: print("Checking for bot commands...")
-    # check for commands sent to the bot
-    dmconvos_objs = dm.list_convos().model_dump()
-    dmconvos = []
-    dmconvos.extend(dmconvos_objs['convos'])
-    while True:
-        if "cursor" not in dmconvos_objs or dmconvos_objs["cursor"] is None:
-            break
-        dmconvos.extend(dmconvos_objs['convos'])
-        dmconvos_objs = dm.list_convos(cursor=dmconvos_objs['cursor']).model_dump()
+    # only unprocessed messages sent to the bot since the last check are returned, oldest first
+    ledger = skyalert_chatlog.get_processed_ledger()
+    new_messages, log_cursor = skyalert_chatlog.fetch_new_messages(dm, client.me.did, ledger)
     
-    for convo in dmconvos:
-        if convo['last_message']['sender']['did'] == client.me.did:
-            continue # The bot sent the last message, skip
-        else:
-            senderprofile = client.get_profile(convo['last_message']['sender']['did']).model_dump()
-            senderhandle = senderprofile['handle']
-            
-            if convo['last_message']['text'].lower() == "!help":
-                if VERBOSE_PRINTING: print(f"Sending help message to {senderhandle}...")
-                message = "SkyAlert is a bot that can notify you if someone unfollows you. To set up the bot, send me a DM with the following command:\n\n!followwatch <true/false> - Enable or disable notifications for unfollows. You will be notified when someone unfollows you.\n\nIf you used SkyAlert for post notifications, please use !mywatches to see who you're watching so you can enable notifications for them."
-                send_dm(convo['last_message']['sender']['did'], message)
-            elif convo['last_message']['text'].lower().startswith("!watch"):
-                if VERBOSE_PRINTING: print(f"Processing watch command from {senderhandle}...")
-                message = "SkyAlert's post notifications functionality is discontinued because the official Bluesky app can now do post notifications on its own. If you need to see who you were watching, use !mywatches."
-                send_dm(convo['last_message']['sender']['did'], message)
-            elif convo['last_message']['text'].lower().startswith("!unwatch"):
-                if VERBOSE_PRINTING: print(f"Processing unwatch command from {senderhandle}...")
-                message = "SkyAlert's post notifications functionality is discontinued because the official Bluesky app can now do post notifications on its own. If you need to see who you were watching, use !mywatches."
-                send_dm(convo['last_message']['sender']['did'], message)
-            elif convo['last_message']['text'].lower() == "!mywatches":
-                if VERBOSE_PRINTING: print(f"Processing mywatches command from {senderhandle}...")
-                config = get_config()
-                follow_watches = config.get('follow_watches', [])
-                user_watches = config.get('user_watches', [])
-
-                # Check follow watch status
-                follow_watch_status = "disabled"
-                for watch in follow_watches:
-                    if watch['did'] == convo['last_message']['sender']['did']:
-                        follow_watch_status = "enabled"
-                        break
-                message = f"Follow watch notifications are {follow_watch_status}.\n\n"
-
-                # List user watches
-                user_watch_list = [watch for watch in user_watches if watch['receiver-handle'] == senderhandle]
-                if user_watch_list:
-                    message += "You are watching the following subjects:\n"
-                    lines = []
-                    for watch in user_watch_list:
-                        lines.append(f"- {bridgy_to_fed(watch['subject-handle'])} (Reposts allowed: {watch['reposts-allowed']})")
-                    message += "\n".join(lines)
-                else:
-                    message += "You are not watching any subjects."
-
-                send_dm(convo['last_message']['sender']['did'], message)
-            elif convo['last_message']['text'].lower().startswith("!repost-default"):
-                if VERBOSE_PRINTING: print(f"Processing repost-default command from {senderhandle}...")
-                message = "SkyAlert's post notifications functionality is discontinued because the official Bluesky app can now do post notifications on its own. If you need to see who you were watching, use !mywatches."
-                send_dm(convo['last_message']['sender']['did'], message)
-            elif convo['last_message']['text'].lower().startswith("!followwatch"):
-                if VERBOSE_PRINTING: print(f"Processing followwatch command from {senderhandle}...")
-                parts = convo['last_message']['text'].split(' ')
-                if len(parts) != 2 or parts[1] == "":
-                    message = "Not enough arguments. Usage: !followwatch <true/false>"
-                    send_dm(convo['last_message']['sender']['did'], message)
-                else:
-                    config = get_config()
-                    followwatch = parts[1].lower() == "true"
-                    follow_watches = config.get('follow_watches', [])
-                    
-                    if followwatch:
-                        if not any(watch['did'] == convo['last_message']['sender']['did'] for watch in follow_watches):
-                            follow_watches.append({'did': convo['last_message']['sender']['did'], 'handle': senderhandle})
-                            message = "Notifications enabled for unfollows."
-                        else:
-                            message = "Notifications already enabled for unfollows."
-                    else:
-                        if any(watch['did'] == convo['last_message']['sender']['did'] for watch in follow_watches):
-                            follow_watches = [watch for watch in follow_watches if watch['did'] != convo['last_message']['sender']['did']]
-                            message = "Notifications disabled for unfollows."
-                        else:
-                            message = "Notifications already disabled for unfollows."
-                    
-                    config['follow_watches'] = follow_watches
-                    save_config(config)
-                    send_dm(convo['last_message']['sender']['did'], message)
-            elif convo['last_message']['text'].lower().startswith("!replies"):
-                if VERBOSE_PRINTING: print(f"Processing replies command from {senderhandle}...")
-                message = "SkyAlert's post notifications functionality is discontinued because the official Bluesky app can now do post notifications on its own. If you need to see who you were watching, use !mywatches."
-                send_dm(convo['last_message']['sender']['did'], message)
-            elif convo['last_message']['text'].lower() == "!post-restart":
-                if VERBOSE_PRINTING: print(f"Processing post-restart command from {senderhandle}...")
-                if convo['last_message']['sender']['did'] in MAINTAINER_DIDS:
-                    os.system("systemctl restart skyalert-firehose")
-                    message = "Post service restarted."
-                    send_dm(convo['last_message']['sender']['did'], message)
-                else:
-                    message = "You are not LittleBit or someone he trusts. If post notifications have stopped, DM or ping @littlebitstudios.com."
-                    send_dm(convo['last_message']['sender']['did'], message)
+    commands = []
+    for last_message in new_messages:
+        # recorded before the command runs so a failed reply or a restart never executes it twice
+        skyalert_chatlog.mark_processed(ledger, last_message)
+        command = skyalert_commands.parse_command(last_message)
+        if command is not None:
+            commands.append(command)
+    
+    try:
+        skyalert_commands.run_commands(router, commands, prepare=prepare_command)
+    finally:
+        skyalert_chatlog.save_chat_log_cursor(log_cursor)
+        skyalert_identity.save_identity_cache(force=True)
+    return len(new_messages)
                 
 # dangling cache check; if someone has disabled follow watching, remove their followers cache
 def dangling_cache_check():
     if VERBOSE_PRINTING: print("Checking for dangling caches...")
-    cached_files = [f for f in os.listdir(CACHE_DIR) if f.startswith("followers-") and f.endswith(".yaml")]
-    valid_dids = {watch['did'] for watch in get_config().get('follow_watches', [])}
+    valid_dids = {watch['did'] for watch in skyalert_store.get_follow_watches()}
     
-    for cached_file in cached_files:
-        cached_did = cached_file[len("followers-"):-len(".yaml")]
+    for cached_did in skyalert_followers.list_snapshot_dids():
         if cached_did not in valid_dids:
-            if VERBOSE_PRINTING: print(f"Deleting dangling cache file: {cached_file}")
-            os.remove(os.path.join(CACHE_DIR, cached_file))
+            if VERBOSE_PRINTING: print(f"Deleting dangling follower cache for {cached_did}")
+            skyalert_followers.delete_snapshot(cached_did)
 
 # main logic
 def main():
     # restart the post notifications module if it hasn't been responding for 10 minutes
     if firehose_check():
-        os.system("systemctl restart skyalert-firehose")
+        restart_post_service()
     
-    # verify user watch validity
+    # verify user watch validity: one pass over the watches, one write transaction
     if VERBOSE_PRINTING: print("Checking user watches...")
-    for watch in get_config().get('user_watches'):
-        if VERBOSE_PRINTING: print(f"Checking watch for {watch.get('subject')} with receiver {watch.get('receiver')}...")
-        if VERBOSE_PRINTING: print("Verifying DIDs...")
-        receiver_did = watch.get('receiver-did')
-        subject_did = watch.get('subject-did')
-        receiver_handle = watch.get('receiver-handle')
-        subject_handle = watch.get('subject-handle')
-            
-        if receiver_did == None or receiver_did == "":
-            if VERBOSE_PRINTING: print("Invalid receiver, all watches for this receiver will be removed...")
-            config = get_config()
-            config['user_watches'] = [w for w in config['user_watches'] if w['receiver'] != watch.get('receiver')]
-            save_config(config)
-            continue
-            
-        if subject_did == None or subject_did == "":
-            if VERBOSE_PRINTING: print("Invalid subject, the watch will be removed...")
-            send_dm(receiver_did, f"You're no longer watching {watch.get('subject-handle')} because the handle is invalid.")
-            config = get_config()
-            config['user_watches'] = [w for w in config['user_watches'] if not (w['subject'] == watch.get('subject') and w['receiver'] == watch.get('receiver'))]
-            save_config(config)
-            continue
+    # every subject and receiver is fetched once, 25 per request, no matter how many watches share them
+    profiles = skyalert_profiles.ProfileLookup(client)
+    profiles.prefetch(did for watch in skyalert_store.iter_user_watches() for did in (watch.get('subject-did'), watch.get('receiver-did')))
+    validation = skyalert_watches.plan_validation(skyalert_store.iter_user_watches(), profiles)
+    
+    if validation.changed:
+        if VERBOSE_PRINTING: print(f"Updating {len(validation.handle_updates)} handles, removing watches for {len(validation.dropped_subjects)} subjects and {len(validation.dropped_receivers)} receivers...")
+        skyalert_watches.apply_validation(validation)
+    for receiver_did, message in validation.notifications:
+        send_notice(receiver_did, message)
+    for did in validation.dropped_subjects | validation.dropped_receivers:
+        skyalert_identity.forget_identity(did)
+    
+    skyalert_identity.save_identity_cache(force=True)
+    
+# logic for follow watches (user is notified when someone unfollows them)
+# this does not need to be real-time, so it can run by polling; each user is checked on their own schedule
+def check_follow_watch(user, profiles):
+    if VERBOSE_PRINTING: print(f"Checking watch for {user}...")
+    if VERBOSE_PRINTING: print("Verifying DID...")
+    user_did = user['did']
+    
+    if user_did == None or user_did == "":
+        if VERBOSE_PRINTING: print("Invalid user, watch will be removed...")
+        skyalert_store.remove_follow_watch(user_did)
+        return None
+    
+    # the batched profile read gives both the validity check and the follower count used to skip full fetches
+    user_profile = profiles.get(user_did)
+    if user_profile is skyalert_profiles.MISSING:
+        if VERBOSE_PRINTING: print(f"Could not load profile for user {user_did}, watch will be removed...")
+        skyalert_store.remove_follow_watch(user_did)
+        return None
+    
+    if VERBOSE_PRINTING: print("Checking for unfollows...")
+    unfollowed_dids, commit_followers = skyalert_followers.sync_followers(client, user_did, user_profile.followers_count)
+    
+    if unfollowed_dids:
+        message = "These users have unfollowed you:\n"
+        profile_lines = []
+        profile_fail = False
+        profiles.prefetch(unfollowed_dids)
+        for did in unfollowed_dids:
+            unfollower_handle = profiles.get_handle(did)
+            if unfollower_handle is not None:
+                profile_lines.append(f"- [{unfollower_handle}](https://bsky.app/profile/{did})")
+            else:
+                profile_lines.append(f"- {did}")
+                profile_fail = True
         
-        try:
-            subject_profile = client.get_profile(subject_did).model_dump()
-            if subject_profile['handle'] != subject_handle:
-                config = get_config()
-                for watch in config['user_watches']:
-                    if watch['subject-did'] == subject_did:
-                        watch['subject-handle'] = subject_profile['handle']
-                save_config(config)
-        except atproto_client.exceptions.BadRequestError as e:
-            if VERBOSE_PRINTING: print(f"Bad HTTP request when processing subject {subject_did}: {e}")
-            config = get_config()
-            receivers_to_notify = [
-                watch['receiver-did'] for watch in config['user_watches'] if watch['subject-did'] == subject_did
-            ]
-            config['user_watches'] = [
-                watch for watch in config['user_watches'] if watch['subject-did'] != subject_did
-            ]
-            save_config(config)
-            for receiver_did in receivers_to_notify:
-                send_dm(receiver_did, f"You are no longer watching {subject_handle} because the handle could not be verified. This usually happens when an account is deleted/deactivated by its user or suspended by Bluesky.")
-            
-        try:
-            receiver_profile = client.get_profile(receiver_did).model_dump()
-            if receiver_profile['handle'] != receiver_handle:
-                config = get_config()
-                for watch in config['user_watches']:
-                    if watch['receiver-did'] == receiver_did:
-                        watch['receiver-handle'] = receiver_profile['handle']
-                save_config(config)
-        except atproto_client.exceptions.BadRequestError as e:
-            if VERBOSE_PRINTING: print(f"Exception occurred while processing receiver {receiver_did}: {e}")
-            config = get_config()
-            config['user_watches'] = [
-            watch for watch in config['user_watches'] if watch['receiver-did'] != receiver_did
-            ]
-            save_config(config)
+        message += "\n".join(profile_lines)
+        if profile_fail: message += "\n\nSome profiles could not be loaded, so their handles are replaced by a DID. This usually happens when someone deletes their account or their account was suspended by the Bluesky team."
+        # notices are sent in the background, so a DM the chat API would refuse as too long is caught here
+        if len(skyalert_facets.get_facets_from_markdown(message)["filtered_text"]) > skyalert_outbox.MAX_MESSAGE_LENGTH:
+            message = "I found that some people unfollowed you, but there were so many that I couldn't fit it in one message."
+        send_notice(user_did, message)
     
-    # logic for follow watches (user is notified when someone unfollows them)
-    # this does not need to be real-time, so it can run by polling
+    if VERBOSE_PRINTING: print("Saving follower cache...")
+    commit_followers()
+    return user_profile.followers_count, bool(unfollowed_dids)
+
+def follow_watch_sweep():
     if VERBOSE_PRINTING: print("Checking follow watches...")
-    for user in get_config().get('follow_watches'):
-        if VERBOSE_PRINTING: print(f"Checking watch for {user}...")
-        if VERBOSE_PRINTING: print("Verifying DID...")
-        user_did = user['did']
-        user_handle = user['handle']
-        
-        if user_did == None or user_did == "":
-            if VERBOSE_PRINTING: print("Invalid user, watch will be removed...")
-            config = get_config()
-            config['follow_watches'] = [w for w in config['follow_watches'] if w != user]
-            save_config(config)
-            continue
-        
-        try:
-            client.get_profile(user_did)
-        except atproto_client.exceptions.BadRequestError as e:
-            if VERBOSE_PRINTING: print(f"Exception occurred while processing user {user_did}: {e}")
-            config = get_config()
-            config['follow_watches'] = [w for w in config['follow_watches'] if w['did'] != user_did]
-            save_config(config)
-            continue
-        
-        if VERBOSE_PRINTING: print("Loading cached followers...")
-        cached_followers = []
-        if not os.path.exists(f"{CACHE_DIR}/followers-{user_did}.yaml"):
-            with open(f"{CACHE_DIR}/followers-{user_did}.yaml", 'w') as f:
-                cached_followers = []
-                yaml.dump(cached_followers, f)
-        else:
-            with open(f"{CACHE_DIR}/followers-{user_did}.yaml", 'r') as f:
-                cached_followers = yaml.safe_load(f)
-        
-        if VERBOSE_PRINTING: print("Pulling current followers...")
-        # Retrieve all current followers
-        current_followers_objs = []
-        current_followers_objs.append(client.get_followers(user_did).model_dump())
-        while True:
-            if "cursor" not in current_followers_objs[-1] or current_followers_objs[-1]["cursor"] is None:
-                break
-            current_followers_objs.append(client.get_followers(user_did, cursor=current_followers_objs[-1]['cursor']).model_dump())
-        
-        if VERBOSE_PRINTING: print("Getting DIDs of current followers...")
-        # Separate the DIDs from the API objects
-        current_followers_dids = []
-        for obj in current_followers_objs:
-            for follower in obj['followers']:
-                current_followers_dids.append(follower['did'])
-                
-        if VERBOSE_PRINTING: print("Checking for unfollows...")
-        # Check for unfollowers
-        unfollowed_dids = []
-        for cached_did in cached_followers:
-            if cached_did not in current_followers_dids:
-                unfollowed_dids.append(cached_did)
-        
-        if unfollowed_dids:
-            message = "These users have unfollowed you:\n"
-            profile_lines = []
-            profile_fail = False
-            for did in unfollowed_dids:
-                try:    
-                    profile = client.get_profile(did).model_dump()
-                    profile_lines.append(f"- [{profile['handle']}](https://bsky.app/profile/{did})")
-                except:
-                    profile_lines.append(f"- {did}")
-                    profile_fail = True
-            
-            message += "\n".join(profile_lines)
-            if profile_fail: message += "\n\nSome profiles could not be loaded, so their handles are replaced by a DID. This usually happens when someone deletes their account or their account was suspended by the Bluesky team."
-            try:
-                send_dm(user_did, message)
-            except atproto_client.exceptions.BadRequestError as e:
-                message = "I found that some people unfollowed you, but there were so many that I couldn't fit it in one message."
-                send_dm(user_did, message)
-        
-        if VERBOSE_PRINTING: print("Saving follower cache...")
-        # Update the cached followers list
-        with open(f"{CACHE_DIR}/followers-{user_did}.yaml", 'w') as f:
-            yaml.dump(current_followers_dids, f)
+    profiles = skyalert_profiles.ProfileLookup(client)
+    skyalert_sweep.run_sweep(
+        skyalert_store.get_follow_watches(),
+        lambda user: check_follow_watch(user, profiles),
+        prepare=lambda users: profiles.prefetch([user['did'] for user in users]),
+        followers_count=lambda user: getattr(profiles.get(user['did']), 'followers_count', None),
+    )
+    skyalert_identity.save_identity_cache(force=True)
+    if VERBOSE_PRINTING: print("API budget usage:\n" + skyalert_ratelimit.usage_report())
     
     # # last run time was only needed for user watching, so it is not needed anymore
     # if VERBOSE_PRINTING: print("Saving last run time...")
@@ -496,7 +324,7 @@ def main():
     retry=tenacity.retry_if_exception_type(atproto_client.exceptions.RequestException)
 )
 def bot_commands_handler_with_retry():
-    bot_commands_handler()
+    return bot_commands_handler()
 
 @tenacity.retry(
     wait=tenacity.wait_exponential(multiplier=1, min=4, max=60),  # Exponential backoff
@@ -505,19 +333,49 @@ def bot_commands_handler_with_retry():
 )
 def main_with_retry():
     main()
+
+@tenacity.retry(
+    wait=tenacity.wait_exponential(multiplier=1, min=4, max=60),  # Exponential backoff
+    stop=tenacity.stop_after_attempt(5),  # Stop after 5 attempts
+    retry=tenacity.retry_if_exception_type(atproto_client.exceptions.RequestException)
+)
+def follow_watch_sweep_with_retry():
+    follow_watch_sweep()
     
-time_waited = 0
-cmd_check_interval = 30
+# handles bot commands on the scheduler thread, returning the delay until the next check
+cmd_check_interval = skyalert_chatlog.CMD_CHECK_MIN_INTERVAL
+def scheduled_bot_commands():
+    global cmd_check_interval
+    handled_count = bot_commands_handler_with_retry()
+    cmd_check_interval = skyalert_chatlog.next_cmd_check_interval(cmd_check_interval, handled_count)
+    return cmd_check_interval
+
+def scheduled_main():
+    dangling_cache_check()
+    main_with_retry()
+
+# checks the latency histograms of the post services against the SLO
+def latency_slo_check():
+    breach = skyalert_latency.check_slo()
+    if breach is not None:
+        stage, p99 = breach
+        print(f"Notification latency p99 is {p99:.1f}s, over the {skyalert_latency.SLO_P99:.0f}s SLO; most time goes to {stage}.")
+
 main_interval = 3600
-while True:
-    if time_waited % cmd_check_interval == 0: # this script continues to handle bot commands
-        bot_commands_handler_with_retry()
-    if time_waited % main_interval == 0: # this only handles follow watches
-        dangling_cache_check()
-        main_with_retry()
-        
-    if time_waited == main_interval:
-        time_waited = 0
-        
-    time.sleep(1)
-    time_waited += 1
\ No newline at end of file
+follow_sweep_interval = skyalert_sweep.MIN_INTERVAL # users are only checked when their own interval is up
+
+if __name__ == "__main__":
+    skyalert_profiling.install("cmdsv2")
+    skyalert_session.login(client)
+    outbox.start()
+    notices.start(skyalert_outbox.Dispatcher().start())
+    scheduler = skyalert_scheduler.Scheduler()
+    scheduler.add("bot-commands", scheduled_bot_commands, cmd_check_interval)
+    # the hourly jobs run on their own threads so command intake stays responsive while they work
+    scheduler.add("validate-watches", scheduled_main, main_interval, jitter=60, background=True, budget=main_interval / 2)
+    scheduler.add("follow-sweep", follow_watch_sweep_with_retry, follow_sweep_interval, jitter=30, background=True, budget=follow_sweep_interval)
+    # warn when post notifications (sent by the firehose and jetstream services) get slow
+    scheduler.add("latency-slo", latency_slo_check, 300, background=True)
+    # refresh the shared session ahead of expiry, for this and the other services
+    scheduler.add("session-refresh", lambda: skyalert_session.keep_fresh(client), 300, background=True)
+    scheduler.run_forever()
@@ -1,25 +1,33 @@
 import multiprocessing
 import signal
 import time
-from collections import defaultdict
+import traceback
 from types import FrameType
 from typing import Any
-from atproto import CAR, AtUri, FirehoseSubscribeReposClient, firehose_models, models, parse_subscribe_repos_message, Client, IdResolver, SessionEvent
+from atproto import FirehoseSubscribeReposClient, firehose_models, models, parse_subscribe_repos_message
 import atproto_client
 import json
 import atproto_client.exceptions
-import yaml
 import os
 import datetime
-import re
 import tenacity
 from urllib.parse import urlparse
+import skyalert_commits
+import skyalert_endpoints
+import skyalert_facets
+import skyalert_profiling
+import skyalert_identity
+import skyalert_latency
+import skyalert_outbox
+from skyalert_handles import post_url_from_at_uri, bridgy_to_fed, fed_to_bridgy
+import skyalert_ratelimit
+import skyalert_session
+import skyalert_store
 
 # code from original skyalert file, now skyalert-cmds.py
 
 # global variables
 DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
-CONFIG_FILE = os.path.join(DATA_DIR, 'config.yaml')
 CACHE_DIR = os.path.join(DATA_DIR, 'cache')
 LAST_RUN_FILE = os.path.join(DATA_DIR, 'last_run-firehose.txt')
 VERBOSE_PRINTING = False
@@ -28,118 +36,11 @@ global terminate_event
 terminate_event = multiprocessing.Event()
 
 global client
-client = Client()
-
-@client.on_session_change
-def on_session_change(event: atproto_client.SessionEvent,session: atproto_client.Session):
-    if event==SessionEvent.CREATE or event==SessionEvent.REFRESH:
-        dm_client = client.with_bsky_chat_proxy()
-        with open(os.path.join(DATA_DIR, 'login-info.yaml'), 'r') as f1:
-            login_info = yaml.safe_load(f1)
-            with open(os.path.join(DATA_DIR, 'login-info.yaml'), 'w') as f2:
-                new_login_info = {
-                    'username': login_info['username'],
-                    'password': login_info['password'],
-                    'session-key-firehose': session.export(),
-                    'session-key-cmds': login_info['session-key-cmds'] if 'session-key-cmds' in login_info else ""
-                }
-                yaml.dump(new_login_info, f2)
-
-with open(os.path.join(DATA_DIR, 'login-info.yaml'), 'r') as f:
-    login_info = yaml.safe_load(f)
-
-    if 'session-key-firehose' in login_info and login_info['session-key-firehose']:
-        client.login(session_string=login_info['session-key-firehose'])
-        dm_client = client.with_bsky_chat_proxy()
-    else:
-        client.login(login=login_info['username'], password=login_info['password'])
-        dm_client = client.with_bsky_chat_proxy()
-
-# Link detection by latchk3y on the Bluesky API Discord server
-def get_facets_from_links(text):
-    pattern = r'(https?://[^\s]+)'
-    links = re.findall(pattern, text)
-
-    facets = []
-    
-    for link in links:
-        start_index = text.index(link)
-        end_index = start_index + len(link)
-        
-        facets.append({
-            "index": {
-                "byteStart": start_index,
-                "byteEnd": end_index              },
-            "features": [
-                {
-                    "$type": "app.bsky.richtext.facet#link",
-                    "uri": link
-                }
-            ]
-        })  
-
-    return facets
-
-def get_facets_from_markdown(text):
-    pattern = r'\[([^\]]+)\]\((https?://[^\s]+)\)'
-    facets = []
-    filtered_text = text
-
-    match = re.search(pattern, filtered_text)
-    while match:
-        link_text, link_url = match.groups()
-        start_index = match.start()
-        end_index = match.end()
-
-        filtered_text = filtered_text[:start_index] + link_text + filtered_text[end_index:]
-        new_start_index = start_index
-        new_end_index = new_start_index + len(link_text)
-
-        facets.append({
-            "index": {
-                "byteStart": new_start_index,
-                "byteEnd": new_end_index
-            },
-            "features": [
-                {
-                    "$type": "app.bsky.richtext.facet#link",
-                    "uri": link_url
-                }
-            ]
-        })
-
-        match = re.search(pattern, filtered_text)
-
-    # Extract links from the filtered text
-    link_pattern = r'(https?://[^\s]+)'
-    links = re.findall(link_pattern, filtered_text)
-
-    for link in links:
-        start_index = filtered_text.index(link)
-        end_index = start_index + len(link)
-        
-        facets.append({
-            "index": {
-                "byteStart": start_index,
-                "byteEnd": end_index
-            },
-            "features": [
-                {
-                    "$type": "app.bsky.richtext.facet#link",
-                    "uri": link
-                }
-            ]
-        })
-
-    return {"facets": facets, "filtered_text": filtered_text}
-
-def get_config():
-    if not os.path.exists(CONFIG_FILE):
-        return {'user_watches': [], 'follow_watches': []}
-    with open(CONFIG_FILE, 'r') as f:
-        config = yaml.safe_load(f)
-        return config
-    
+client = skyalert_session.SharedSessionClient(request=skyalert_ratelimit.RateLimitedRequest())
+
+# tokens come from the session shared by all SkyAlert services; logged in by the main process before
+# the workers fork, or by skyalert-unified.py, which hands the firehose its own client
+
 def get_followers_cache(did):
     cache_file = os.path.join(CACHE_DIR, f'followers-{did}.json')
     if not os.path.exists(cache_file):
@@ -152,10 +53,6 @@ def save_followers_cache(did, new_cache):
     with open(cache_file, 'w') as f:
         json.dump(new_cache, f)
     
-def save_config(config):
-    with open(CONFIG_FILE, 'w') as f:
-        yaml.dump(config, f)
-        
 def get_last_run():
     if not os.path.exists(LAST_RUN_FILE):
         return None
@@ -166,52 +63,12 @@ def save_last_run():
     with open(LAST_RUN_FILE, 'w') as f:
         f.write(datetime.datetime.now(datetime.timezone.utc).isoformat())
     
-def post_url_from_at_uri(at_uri):
-    # Split the AT URI to extract the DID and the random string
-    parts = at_uri.split('/')
-    did = parts[2]
-    random_string = parts[-1]
-    
-    # Construct the Bluesky URL
-    url = f"https://bsky.app/profile/{did}/post/{random_string}"
-    return url
-
-def bridgy_to_fed(handle: str):
-    if handle.endswith("ap.brid.gy"):
-        parts = handle.split('.')
-        if len(parts) >= 3:
-            username = parts[0]
-            domain = '.'.join(parts[1:-3])
-            return f"@{username}@{domain} (Bridgy)"
-        else:
-            return f"@{handle}"
-    else:
-        if handle.endswith("bsky.social"):
-            handle = handle[:-12]  # Remove ".bsky.social" from the end
-        return handle
-    
-def fed_to_bridgy(handle: str):
-    if "@" in handle:
-        parts = handle.split('@')
-        if len(parts) >= 3:  # If given a Fediverse handle, output the Bridgy handle
-            username = parts[1]
-            domain = '.'.join(parts[2:])
-            return f"{username}.{domain}.ap.brid.gy"
-        else:  # If given a normal Bluesky handle, output the handle ensuring there is no @ at the beginning
-            return handle.lstrip('@')
-    else:
-        if not handle.endswith("bsky.social") and '.' not in handle:
-            handle += ".bsky.social"
-        return handle
-
-def send_dm(to,message):
+def deliver_dm(to,message):
     dm_client = client.with_bsky_chat_proxy()
     dm = dm_client.chat.bsky.convo
     
-    # create resolver instance with in-memory cache
-    id_resolver = IdResolver()
-    # resolve DID
-    chat_to = to if "did:plc:" in to else id_resolver.handle.resolve(to)
+    # resolve DID through the cache shared with the other services
+    chat_to = to if "did:plc:" in to else skyalert_identity.resolve_handle(to)
 
     # create or get conversation with chat_to
     convo = dm.get_convo_for_members(
@@ -219,7 +76,7 @@ def send_dm(to,message):
     ).convo
     
     # filter markdown links from text and get facets
-    content = get_facets_from_markdown(message)
+    content = skyalert_facets.get_facets_from_markdown(message)
     
     # send a message to the conversation
     dm.send_message(
@@ -234,133 +91,118 @@ def send_dm(to,message):
 
     if VERBOSE_PRINTING: print('\nMessage sent!')
 
-# from the atproto python repo examples
-
-_INTERESTED_RECORDS = {
-    models.ids.AppBskyFeedPost: models.AppBskyFeedPost,
-    models.ids.AppBskyFeedRepost: models.AppBskyFeedRepost
-}
-
-def _get_ops_by_type(commit: models.ComAtprotoSyncSubscribeRepos.Commit) -> defaultdict:
-    operation_by_type = defaultdict(lambda: {'created': [], 'deleted': []})
-
-    car = CAR.from_bytes(commit.blocks)
-    for op in commit.ops:
-        if op.action == 'update':
-            # not supported yet
-            continue
-
-        uri = AtUri.from_str(f'at://{commit.repo}/{op.path}')
-
-        if op.action == 'create':
-            if not op.cid:
-                continue
-
-            create_info = {'uri': str(uri), 'cid': str(op.cid), 'author': commit.repo}
-
-            record_raw_data = car.blocks.get(op.cid)
-            if not record_raw_data:
-                continue
-
-            record = models.get_or_create(record_raw_data, strict=False)
-            record_type = _INTERESTED_RECORDS.get(uri.collection)
-            if record_type and models.is_record_type(record, record_type):
-                operation_by_type[uri.collection]['created'].append({'record': record, **create_info})
-
-        if op.action == 'delete':
-            operation_by_type[uri.collection]['deleted'].append({'uri': str(uri)})
-
-    return operation_by_type
+# every DM is written to the outbox before it is sent, and retried from there if sending fails
+outbox = skyalert_outbox.Outbox('firehose', deliver_dm)
 
+def send_dm(to,message,trace=None):
+    outbox.send(to, message, trace)
 
 def worker_main(cursor_value: multiprocessing.Value, pool_queue: multiprocessing.Queue) -> None:
     signal.signal(signal.SIGINT, signal.SIG_IGN)  # we handle it in the main process
+    skyalert_profiling.install("firehose-worker")
+    if client.me is None:
+        skyalert_session.login(client) # started by spawn rather than fork, so the login didn't carry over
+    # DMs are sent by the dispatcher's threads, taking turns between receivers, while this one moves on
+    outbox.start(skyalert_outbox.Dispatcher().start())
 
     while not terminate_event.is_set():
         try:
-            message = pool_queue.get()
+            received_at, message = pool_queue.get()
+            skyalert_identity.save_identity_cache() # written every SAVE_INTERVAL at most
+
+            if message.type == '#identity':
+                # handle changes take effect right away instead of when the cached one expires
+                identity = skyalert_commits.decode_identity(message)
+                if identity is not None:
+                    skyalert_identity.refresh_identity(*identity)
+                continue
 
-            commit = parse_subscribe_repos_message(message)
-            if not isinstance(commit, models.ComAtprotoSyncSubscribeRepos.Commit):
+            decoded = skyalert_commits.decode_message(message)
+            if decoded is None:
                 continue
 
-            if commit.seq % 20 == 0:
-                cursor_value.value = commit.seq
+            seq, commit_time, ops = decoded
+            if seq % 20 == 0:
+                cursor_value.value = seq
 
-            if not commit.blocks:
+            if ops is None:
                 continue
 
-            ops = _get_ops_by_type(commit)
-            for created_post in ops[models.ids.AppBskyFeedPost]['created']:
-                for watch in get_config()['user_watches']:
-                    if watch['subject-did'] == created_post['author']:
-                        post = created_post['record']
-                        profile = client.get_profile(created_post['author'])
-                        post_url = post_url_from_at_uri(created_post['uri'])
-                        message1 = f"[{bridgy_to_fed(profile.handle)}](https://bsky.app/profile/{profile.did}) said - [click to view]({post_url}): \"{post['text'].replace("\n", " ")}\""
+            notify_ops(ops, skyalert_latency.Trace(skyalert_latency.commit_time(commit_time), received_at))
+            save_last_run()
+        except Exception as e:
+            exception_handler(e)
+
+# sends the notifications for the posts and reposts of one commit
+def notify_ops(ops, event_trace):
+    for created_post in ops[models.ids.AppBskyFeedPost]['created']:
+        watches = skyalert_store.snapshot().watches_for_subject(created_post['author'])
+        event_trace.mark('match')
+        for watch in watches:
+            trace = event_trace.copy(created_post['author'])
+            post = created_post['record']
+            profile = client.get_profile(created_post['author'])
+            post_url = post_url_from_at_uri(created_post['uri'])
+            message1 = f"[{bridgy_to_fed(profile.handle)}](https://bsky.app/profile/{profile.did}) said - [click to view]({post_url}): \"{post['text'].replace("\n", " ")}\""
                         
-                        if post.reply is not None: 
-                            message1 += f" [is a reply]"
-                            reply_settings = get_config().get('reply_settings', [])
-                            reply_allowed = False  # Default to blocking replies if no entry exists
-
-                            for reply_setting in reply_settings:
-                                if reply_setting['did'] == watch['receiver-did']:
-                                    reply_allowed = reply_setting['replies-allowed']
-                                    break
-
-                            if not reply_allowed:
-                                if VERBOSE_PRINTING: print(f"Skipping sending reply to {watch['receiver-did']} as replies are disabled.")
-                                continue
+            if post.reply is not None: 
+                message1 += f" [is a reply]"
+                # Default to blocking replies if no entry exists
+                reply_allowed = skyalert_store.snapshot().get_reply_setting(watch['receiver-did']) or False
+
+                if not reply_allowed:
+                    if VERBOSE_PRINTING: print(f"Skipping sending reply to {watch['receiver-did']} as replies are disabled.")
+                    continue
                         
-                        if post.labels is not None: message1 += f" [content warning]"
+            if post.labels is not None: message1 += f" [content warning]"
                         
-                        if post.embed is not None:
-                            if post.embed.py_type == "app.bsky.embed.images": message1 += f" [has images]"
-                            if post.embed.py_type == "app.bsky.embed.video": message1 += f" [has video]"
-                            if post.embed.py_type == "app.bsky.embed.external":
-                                parsed_uri = urlparse(post.embed.external.uri)
-                                if parsed_uri.hostname == "tenor.com": message1 += f" [has GIF]"
-                                else: message1 += f" [link preview]"
-                            if post.embed.py_type == "app.bsky.embed.record": message1 += f" [quote repost]"
+            if post.embed is not None:
+                if post.embed.py_type == "app.bsky.embed.images": message1 += f" [has images]"
+                if post.embed.py_type == "app.bsky.embed.video": message1 += f" [has video]"
+                if post.embed.py_type == "app.bsky.embed.external":
+                    parsed_uri = urlparse(post.embed.external.uri)
+                    if parsed_uri.hostname == "tenor.com": message1 += f" [has GIF]"
+                    else: message1 += f" [link preview]"
+                if post.embed.py_type == "app.bsky.embed.record": message1 += f" [quote repost]"
                             
-                        #message2 = f"Link to post: {post_url}"
-                        send_dm(watch['receiver-did'], message1)
-                        #send_dm(watch['receiver-did'], message2)
+            #message2 = f"Link to post: {post_url}"
+            trace.mark('render')
+            send_dm(watch['receiver-did'], message1, trace)
+            #send_dm(watch['receiver-did'], message2)
                         
-            for created_repost in ops[models.ids.AppBskyFeedRepost]['created']:
-                for watch in get_config()['user_watches']:
-                    if watch['subject-did'] == created_repost['author'] and watch['reposts-allowed']:
-                        if VERBOSE_PRINTING: print(f"Processing repost from {created_repost['author']} for watcher {watch['receiver-did']}")
-                        post = created_repost['record']
-                        reposter_handle = watch['subject-handle']
-                        reposted_profile = client.get_profile(post['subject'].uri.split('/')[2])
-                        post_url = post_url_from_at_uri(post['subject'].uri)
-                        post = client.get_post_thread(post['subject'].uri)
-                        message1 = f"[{bridgy_to_fed(reposter_handle)}](https://bsky.app/profile/{watch['subject-did']}) reposted [{bridgy_to_fed(reposted_profile.handle)}]([https://bsky.app/profile/{reposted_profile.did}]) saying - [click to view]({post_url}): {post.thread.post.record.text.replace('\n', ' ')}"
+    for created_repost in ops[models.ids.AppBskyFeedRepost]['created']:
+        watches = skyalert_store.snapshot().watches_for_subject(created_repost['author'])
+        event_trace.mark('match')
+        for watch in watches:
+            if watch['reposts-allowed']:
+                trace = event_trace.copy(created_repost['author'])
+                if VERBOSE_PRINTING: print(f"Processing repost from {created_repost['author']} for watcher {watch['receiver-did']}")
+                post = created_repost['record']
+                reposter_handle = watch['subject-handle']
+                reposted_profile = client.get_profile(post['subject'].uri.split('/')[2])
+                post_url = post_url_from_at_uri(post['subject'].uri)
+                post = client.get_post_thread(post['subject'].uri)
+                message1 = f"[{bridgy_to_fed(reposter_handle)}](https://bsky.app/profile/{watch['subject-did']}) reposted [{bridgy_to_fed(reposted_profile.handle)}]([https://bsky.app/profile/{reposted_profile.did}]) saying - [click to view]({post_url}): {post.thread.post.record.text.replace('\n', ' ')}"
                         
-                        if post.thread.post.embed is not None:
-                            if post.thread.post.embed.images is not None:
-                                message1 += f" [has images]"
-                            if post.thread.post.embed.py_type.startswith("app.bsky.embed.video"):
-                                message1 += f" [has video]"
-                            if post.thread.post.embed.external is not None:
-                                parsed_uri = urlparse(post.thread.post.embed.external.uri)
-                                if parsed_uri.hostname == "tenor.com":
-                                    message1 += f" [has GIF]"
-                                else:
-                                    message1 += f" [link preview]"
-                        if post.thread.post.labels:
-                            message1 += f" [content warning]"
+                if post.thread.post.embed is not None:
+                    if post.thread.post.embed.images is not None:
+                        message1 += f" [has images]"
+                    if post.thread.post.embed.py_type.startswith("app.bsky.embed.video"):
+                        message1 += f" [has video]"
+                    if post.thread.post.embed.external is not None:
+                        parsed_uri = urlparse(post.thread.post.embed.external.uri)
+                        if parsed_uri.hostname == "tenor.com":
+                            message1 += f" [has GIF]"
+                        else:
+                            message1 += f" [link preview]"
+                if post.thread.post.labels:
+                    message1 += f" [content warning]"
                         
-                        #message2 = f"Link to post: {post_url}"
-                        send_dm(watch['receiver-did'], message1)
-                        #send_dm(watch['receiver-did'], message2)
-                        if VERBOSE_PRINTING: print(f"Successfully sent messages to {watch['receiver-did']}")
-            
-            save_last_run()
-        except Exception as e:
-            exception_handler(e)
+                #message2 = f"Link to post: {post_url}"
+                trace.mark('render')
+                send_dm(watch['receiver-did'], message1, trace)
+                #send_dm(watch['receiver-did'], message2)
+                if VERBOSE_PRINTING: print(f"Successfully sent messages to {watch['receiver-did']}")
                     
         
 def get_firehose_params(cursor_value: multiprocessing.Value) -> models.ComAtprotoSyncSubscribeRepos.Params:
@@ -403,15 +245,18 @@ def signal_handler(_: int, __: FrameType) -> None:
 
     exit(0)
     
+# one commit that can't be handled (a profile that won't load, an odd record) must not stop the others;
+# DMs that fail to send are already kept by the outbox
 def exception_handler(e: Exception) -> None:
-    print('Exception thrown. The script will shut down.')
-    print(f"Exception: {e}")
-    terminate_event.set()
+    print(f"Exception while handling a commit: {e}")
+    traceback.print_exc()
 
 if __name__ == '__main__':
     global firehose
     
     signal.signal(signal.SIGINT, signal_handler)
+    skyalert_profiling.install("firehose")
+    skyalert_session.login(client)
 
     start_cursor = None
 
@@ -421,7 +266,7 @@ if __name__ == '__main__':
         cursor = multiprocessing.Value('i', start_cursor)
         params = get_firehose_params(cursor)
 
-    firehose = FirehoseSubscribeReposClient(params)
+    firehose = FirehoseSubscribeReposClient(params, base_uri=skyalert_endpoints.FIREHOSE_URL)
 
     workers_count = int(multiprocessing.cpu_count() / 2) - 1
     max_queue_size = 10000
@@ -442,6 +287,6 @@ if __name__ == '__main__':
         if terminate_event.is_set():
             exit(1)
 
-        queue.put(message)
+        queue.put((time.time(), message)) # received time, for the latency traces
 
     firehose.start(on_message_handler)
\ No newline at end of file
@@ -1,98 +1,41 @@
 import asyncio
-from atproto import Client, IdResolver, models, SessionEvent, AsyncClient
+from atproto import models
 import atproto_client
 import json
 import atproto_client.exceptions
 import websockets
-import yaml
 import os
 import datetime
 import time
-import re
+import traceback
 import aiohttp
 import aiofiles
 from urllib.parse import urlparse
+import skyalert_endpoints
+import skyalert_facets
+import skyalert_profiling
+import skyalert_identity
+import skyalert_latency
+import skyalert_outbox
+from skyalert_handles import post_url_from_at_uri, bridgy_to_fed, fed_to_bridgy
+import skyalert_ratelimit
+import skyalert_session
+import skyalert_store
 
 DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
-CONFIG_FILE = os.path.join(DATA_DIR, 'config.yaml')
 CACHE_DIR = os.path.join(DATA_DIR, 'cache')
 LAST_RUN_FILE = os.path.join(DATA_DIR, 'last_run.txt')
 VERBOSE_PRINTING = False
 
 global client
-client = AsyncClient()
-
-async def on_session_change(event: atproto_client.SessionEvent, session: atproto_client.Session):
-    if VERBOSE_PRINTING: print(f"Session change event: {event}")
-    if event == SessionEvent.CREATE or event == SessionEvent.REFRESH:
-        async with aiofiles.open(os.path.join(DATA_DIR, 'login-info.yaml'), 'r') as f1:
-            login_info = yaml.safe_load(await f1.read())
-            async with aiofiles.open(os.path.join(DATA_DIR, 'login-info.yaml'), 'w') as f2:
-                new_login_info = {
-                    'username': login_info['username'],
-                    'password': login_info['password'],
-                    'session-key-firehose': session.export(),
-                    'session-key-cmds': login_info['session-key-cmds'] if 'session-key-cmds' in login_info else ""
-                }
-                await f2.write(yaml.dump(new_login_info))
-
-client.on_session_change = on_session_change
+client = skyalert_session.SharedSessionAsyncClient(request=skyalert_ratelimit.RateLimitedAsyncRequest())
 
+# tokens come from the session shared by all SkyAlert services
 async def load_login_info():
-    if VERBOSE_PRINTING: print("Loading login info...")
-    async with aiofiles.open(os.path.join(DATA_DIR, 'login-info.yaml'), 'r') as f:
-        login_info = yaml.safe_load(await f.read())
-        if 'session-key-firehose' in login_info and login_info['session-key-firehose']:
-            await client.login(session_string=login_info['session-key-firehose'])
-        else:
-            await client.login(login=login_info['username'], password=login_info['password'])
+    if VERBOSE_PRINTING: print("Loading shared session...")
+    await skyalert_session.login_async(client)
     if VERBOSE_PRINTING: print("Login info loaded.")
 
-# Link detection by latchk3y on the Bluesky API Discord server
-def get_facets(text):
-    if VERBOSE_PRINTING: print(f"Extracting facets from text: {text}")
-    pattern = r'(https?://[^\s]+)'
-    links = re.findall(pattern, text)
-
-    facets = []
-    
-    for link in links:
-        start_index = text.index(link)
-        end_index = start_index + len(link)
-        
-        facets.append({
-            "index": {
-                "byteStart": start_index,
-                "byteEnd": end_index              },
-            "features": [
-                {
-                    "$type": "app.bsky.richtext.facet#link",
-                    "uri": link
-                }
-            ]
-        })
-
-    if not facets:
-        return None  
-
-    if VERBOSE_PRINTING: print(f"Facets extracted: {facets}")
-    return facets
-
-async def get_config():
-    if VERBOSE_PRINTING: print("Loading config...")
-    if not os.path.exists(CONFIG_FILE):
-        return {'user_watches': [], 'follow_watches': []}
-    async with aiofiles.open(CONFIG_FILE, 'r') as f:
-        config = yaml.safe_load(await f.read())
-        if VERBOSE_PRINTING: print("Config loaded.")
-        return config
-    
-async def save_config(config):
-    if VERBOSE_PRINTING: print("Saving config...")
-    async with aiofiles.open(CONFIG_FILE, 'w') as f:
-        await f.write(yaml.dump(config))
-    if VERBOSE_PRINTING: print("Config saved.")
-
 async def get_last_run():
     if VERBOSE_PRINTING: print("Getting last run time...")
     if not os.path.exists(LAST_RUN_FILE):
@@ -108,128 +51,128 @@ async def save_last_run():
         await f.write(datetime.datetime.now(datetime.timezone.utc).isoformat())
     if VERBOSE_PRINTING: print("Last run time saved.")
     
-def post_url_from_at_uri(at_uri):
-    if VERBOSE_PRINTING: print(f"Generating post URL from AT URI: {at_uri}")
-    # Split the AT URI to extract the DID and the random string
-    parts = at_uri.split('/')
-    did = parts[2]
-    random_string = parts[-1]
-    
-    # Construct the Bluesky URL
-    url = f"https://bsky.app/profile/{did}/post/{random_string}"
-    if VERBOSE_PRINTING: print(f"Generated post URL: {url}")
-    return url
-
-def bridgy_to_fed(handle: str):
-    if VERBOSE_PRINTING: print(f"Converting Bridgy handle to Fediverse handle: {handle}")
-    if handle.endswith("ap.brid.gy"):
-        parts = handle.split('.')
-        if len(parts) >= 3:
-            username = parts[0]
-            domain = '.'.join(parts[1:-3])
-            converted_handle = f"@{username}@{domain} (Bridgy)"
-        else:
-            converted_handle = f"@{handle}"
-    else:
-        if handle.endswith("bsky.social"):
-            handle = handle[:-12]  # Remove ".bsky.social" from the end
-        converted_handle = handle
-    if VERBOSE_PRINTING: print(f"Converted handle: {converted_handle}")
-    return converted_handle
-    
-def fed_to_bridgy(handle: str):
-    if VERBOSE_PRINTING: print(f"Converting Fediverse handle to Bridgy handle: {handle}")
-    if "@" in handle:
-        parts = handle.split('@')
-        if len(parts) >= 3:  # If given a Fediverse handle, output the Bridgy handle
-            username = parts[1]
-            domain = '.'.join(parts[2:])
-            converted_handle = f"{username}.{domain}.ap.brid.gy"
-        else:  # If given a normal Bluesky handle, output the handle ensuring there is no @ at the beginning
-            converted_handle = handle.lstrip('@')
-    else:
-        if not handle.endswith("bsky.social") and '.' not in handle:
-            handle += ".bsky.social"
-        converted_handle = handle
-    if VERBOSE_PRINTING: print(f"Converted handle: {converted_handle}")
-    return converted_handle
-
-async def send_dm(to, message):
+async def deliver_dm(to, message):
     if VERBOSE_PRINTING: print(f"Sending DM to {to}: {message}")
     dm_client = client.with_bsky_chat_proxy()
     dm = dm_client.chat.bsky.convo
     
-    id_resolver = IdResolver()
-    chat_to = to if "did:plc:" in to else await id_resolver.handle.resolve(to)
+    chat_to = to if "did:plc:" in to else await asyncio.to_thread(skyalert_identity.resolve_handle, to)
 
-    convo = await dm.get_convo_for_members(
+    convo = (await dm.get_convo_for_members(
         models.ChatBskyConvoGetConvoForMembers.Params(members=[chat_to, client.me.did]),
-    ).convo
+    )).convo
     
     await dm.send_message(
         models.ChatBskyConvoSendMessage.Data(
             convo_id=convo.id,
             message=models.ChatBskyConvoDefs.MessageInput(
                 text=message,
-                facets=get_facets(message)
+                facets=skyalert_facets.get_facets_from_links(message) or None
             ),
         )
     )
 
     if VERBOSE_PRINTING: print("DM sent.")
-    
+
+# every DM is written to the outbox before it is sent; failed ones stay there for retry_pending_dms(). The
+# outbox writes wait for the disk, so they run on threads instead of holding up the stream.
+async def deliver_entry(entry):
+    try:
+        await deliver_dm(entry.receiver, entry.message)
+    except Exception as e:
+        return await asyncio.to_thread(skyalert_outbox.settle, entry, e)
+    return await asyncio.to_thread(skyalert_outbox.settle, entry)
+
+# A failed pass (a locked database, an unexpected error) is printed and the next one tries again, so the
+# outbox is never left without retries.
+async def retry_pending_dms():
+    released = False
+    while True:
+        try:
+            if not released:
+                await asyncio.to_thread(skyalert_outbox.release_orphans, 'jetstream')
+                released = True
+            for entry in await asyncio.to_thread(skyalert_outbox.claim_due, 'jetstream'):
+                await deliver_entry(entry)
+            # the identities this process learned go to the shared cache file from here, every SAVE_INTERVAL at most
+            await asyncio.to_thread(skyalert_identity.save_identity_cache)
+        except Exception:
+            print("Retrying jetstream DMs failed:")
+            traceback.print_exc()
+        await asyncio.sleep(skyalert_outbox.RETRY_POLL)
+
+def record_dms(to, messages, trace):
+    entries = [skyalert_outbox.record('jetstream', to, message) for message in messages[:-1]]
+    entries.append(skyalert_outbox.record('jetstream', to, messages[-1], trace))
+    return entries
+
+# a notification is the pair of DMs, so its trace rides on the second and ends when that one is accepted
+async def send_traced_dms(to, messages, trace):
+    trace.mark('render')
+    entries = await asyncio.to_thread(record_dms, to, messages, trace)
+    for entry in entries:
+        await deliver_entry(entry)
+
 # main logic
 async def main(uri):
     if VERBOSE_PRINTING: print("Starting main logic...")
     if VERBOSE_PRINTING: print("Signing into Bluesky...")
     await load_login_info()
+    retry_task = asyncio.create_task(retry_pending_dms()) # also sends what was left over from the last run
     
     if VERBOSE_PRINTING: print(f"Connecting to WebSocket URI: {uri}")
     async with websockets.connect(uri) as websocket:
         while True:
             message = await websocket.recv()
+            received_at = time.time()
             if VERBOSE_PRINTING: print(f"Received message: {message}")
             message_dict = json.loads(message)
+            identity = message_dict.get("identity")
+            if message_dict.get("kind") == "identity" and identity:
+                # handle changes take effect right away instead of when the cached one expires
+                await asyncio.to_thread(skyalert_identity.refresh_identity, identity.get("did"), identity.get("handle"))
+                continue
             commit = message_dict.get("commit")
             if commit:
                 if VERBOSE_PRINTING: print("Processing commit...")
-                config = await get_config()
-                for watch in config['user_watches']:
-                    if watch['subject-did'] in message_dict['did']:
-                        if commit.get("collection") == "app.bsky.feed.post":
-                            message1 = f"{bridgy_to_fed(watch['subject-handle'])} said:\n{commit.get('record').get('text')}"
+                event_trace = skyalert_latency.Trace(skyalert_latency.jetstream_time(message_dict.get('time_us')), received_at, message_dict['did'])
+                watches = skyalert_store.snapshot().watches_for_subject(message_dict['did'])
+                event_trace.mark('match')
+                for watch in watches:
+                    trace = event_trace.copy()
+                    if commit.get("collection") == "app.bsky.feed.post":
+                        message1 = f"{bridgy_to_fed(watch['subject-handle'])} said:\n{commit.get('record').get('text')}"
                             
-                            embed = commit.get("record").get("embed")
+                        embed = commit.get("record").get("embed")
                             
-                            if commit.get("record").get("labels"):
-                                message1 += " [content warning]"
+                        if commit.get("record").get("labels"):
+                            message1 += " [content warning]"
                             
-                            if embed:
-                                if embed.get("$type") == "app.bsky.embed.images":
-                                    message1 += " [has images]"
-                                if embed.get("$type") == "app.bsky.embed.video":
-                                    message1 += " [has video]"
-                                if embed.get("$type") == "app.bsky.embed.external":
-                                    parsed_uri = urlparse(embed.get("external").get("uri"))
-                                    if parsed_uri.hostname == "tenor.com":
-                                        message1 += " [has GIF]"
-                                    else:
-                                        message1 += " [link preview]"
-                                if embed.get("$type") == "app.bsky.embed.record":
-                                    message1 += " [quote repost]"
+                        if embed:
+                            if embed.get("$type") == "app.bsky.embed.images":
+                                message1 += " [has images]"
+                            if embed.get("$type") == "app.bsky.embed.video":
+                                message1 += " [has video]"
+                            if embed.get("$type") == "app.bsky.embed.external":
+                                parsed_uri = urlparse(embed.get("external").get("uri"))
+                                if parsed_uri.hostname == "tenor.com":
+                                    message1 += " [has GIF]"
+                                else:
+                                    message1 += " [link preview]"
+                            if embed.get("$type") == "app.bsky.embed.record":
+                                message1 += " [quote repost]"
                                     
-                            post_url = f"https://bsky.app/profile/{message_dict.get('did')}/post/{commit.get('rkey')}"
-                            message2 = f"Link to post: {post_url}"
-                            await send_dm(watch['receiver-did'], message1)
-                            await send_dm(watch['receiver-did'], message2)
-                        elif commit.get("collection") == "app.bsky.feed.repost":
-                            post = (await client.get_posts([commit.get("record").get("uri")]))[0]
-                            message1 = f"{bridgy_to_fed(watch['subject-handle'])} reposted {post.author.handle} saying:\n{post.text}"
-                            message2 = f"Link to post: {post_url_from_at_uri(post.uri)}"
-                            await send_dm(watch['receiver-did'], message1)
-                            await send_dm(watch['receiver-did'], message2)
+                        post_url = f"https://bsky.app/profile/{message_dict.get('did')}/post/{commit.get('rkey')}"
+                        message2 = f"Link to post: {post_url}"
+                        await send_traced_dms(watch['receiver-did'], [message1, message2], trace)
+                    elif commit.get("collection") == "app.bsky.feed.repost":
+                        post = (await client.get_posts([commit.get("record").get("subject").get("uri")])).posts[0]
+                        message1 = f"{bridgy_to_fed(watch['subject-handle'])} reposted {post.author.handle} saying:\n{post.record.text}"
+                        message2 = f"Link to post: {post_url_from_at_uri(post.uri)}"
+                        await send_traced_dms(watch['receiver-did'], [message1, message2], trace)
                 if VERBOSE_PRINTING: print("Commit processed.")
 
 if __name__ == "__main__":
-    uri = "wss://jetstream2.us-east.bsky.network/subscribe"  # Replace with your WebSocket URI
+    skyalert_profiling.install("jetstream")
+    uri = skyalert_endpoints.JETSTREAM_URL # set in data/endpoints.yaml, see example-endpoints.yaml
     asyncio.run(main(uri))
\ No newline at end of file
@@ -0,0 +1,222 @@
+import argparse
+import asyncio
+import concurrent.futures
+import importlib.util
+import multiprocessing
+import os
+import random
+import signal
+import sys
+import time
+import traceback
+from atproto import AsyncFirehoseSubscribeReposClient, firehose_models, models
+import skyalert_commits
+import skyalert_endpoints
+import skyalert_identity
+import skyalert_latency
+import skyalert_outbox
+import skyalert_profiling
+import skyalert_ratelimit
+import skyalert_session
+import skyalert_store
+
+# SkyAlert in one process, as an alternative to running skyalert-firehose and skyalert-cmds (or cmdsv2)
+# as separate units; skyalert-jetstream stays a unit of its own. Everything runs as tasks on one asyncio
+# loop and shares one login, one client (and so one connection pool and one chat proxy client), and the
+# in-process caches of the shared modules (store snapshot, identities, profiles):
+#   firehose   reads the relay; commits from watched accounts are decoded on a small process pool, the
+#              rest are skipped without decoding, and notify_ops() from skyalert-firehose.py renders them
+#   commands   command intake, watch validation and the follow-watch sweep from skyalert-cmds.py, on the
+#              intervals that script uses
+#   delivery   every DM, from notifications and commands alike, is written to the durable outbox of its
+#              service and sent by one skyalert_outbox.Dispatcher: a fixed number of senders taking turns
+#              between receivers, with command replies first; the outboxes retry failed DMs, and replay
+#              the ones a previous run left, on their own threads
+# The service code itself stays synchronous and runs on threads; the loop only schedules it. The separate
+# units keep working as before and remain the fallback: stop them before starting this one (the systemd
+# unit in systemd/skyalert-unified.service does that through Conflicts=).
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+VERBOSE_PRINTING = False
+
+DECODE_WORKERS = 2 # processes decoding commits from watched accounts
+NOTIFY_CONCURRENCY = 16 # commits being rendered at once; beyond that, reading the firehose waits
+CURSOR_INTERVAL = 20 # the firehose cursor is moved every this many events, like in skyalert-firehose.py
+LAST_RUN_INTERVAL = 10 # seconds between writes of last_run-firehose.txt, which the commands watch
+RECONNECT_DELAY = 5
+
+# The service scripts have hyphens in their names, so they are loaded from their files. Loading only
+# defines their functions; the parts that log in and start them run under __main__.
+def load_script(filename, name):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(os.path.dirname(__file__), filename))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+# The decode workers leave SIGINT to the main process. SIGUSR2 toggles profiling in them like in every
+# other process: "systemctl kill -s USR2" reaches them too, and unhandled it would kill them and break the pool.
+def init_decode_worker():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    skyalert_profiling.install("unified-decode")
+
+# Reads the firehose and hands commits from watched accounts to the firehose script's notify_ops().
+class FirehoseReader:
+    def __init__(self, firehose, decode_pool):
+        self.firehose = firehose
+        self.decode_pool = decode_pool
+        self.slots = asyncio.Semaphore(NOTIFY_CONCURRENCY)
+        self.tasks = set()
+        self.client = None
+        self.cursor = None
+        self.last_run_saved = 0
+        self.stopping = False
+
+    async def run(self):
+        while not self.stopping:
+            params = models.ComAtprotoSyncSubscribeRepos.Params(cursor=self.cursor) if self.cursor else None
+            self.client = AsyncFirehoseSubscribeReposClient(params, base_uri=skyalert_endpoints.FIREHOSE_URL)
+            try:
+                await self.client.start(self.on_message)
+            except Exception as e:
+                print(f"Firehose connection failed ({e}), reconnecting in {RECONNECT_DELAY}s.")
+                await asyncio.sleep(RECONNECT_DELAY)
+
+    # reconnects from the last saved cursor
+    async def restart(self):
+        if VERBOSE_PRINTING: print("Restarting the firehose reader...")
+        if self.client is not None:
+            await self.client.stop()
+
+    async def stop(self):
+        self.stopping = True
+        if self.client is not None:
+            await self.client.stop()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    async def on_message(self, message: firehose_models.MessageFrame) -> None:
+        received_at = time.time()
+        if message.type == '#identity':
+            identity = skyalert_commits.decode_identity(message)
+            if identity is not None:
+                await asyncio.to_thread(skyalert_identity.refresh_identity, *identity)
+            return
+        if message.type != '#commit':
+            return
+        seq = message.body.get('seq')
+        if seq and seq % CURSOR_INTERVAL == 0:
+            self.cursor = seq
+            self.client.update_params(models.ComAtprotoSyncSubscribeRepos.Params(cursor=seq))
+        if received_at - self.last_run_saved >= LAST_RUN_INTERVAL:
+            self.firehose.save_last_run()
+            self.last_run_saved = received_at
+        # most commits come from accounts nobody watches; those are never decoded
+        if not skyalert_store.snapshot().watches_for_subject(message.body.get('repo')):
+            return
+        await self.slots.acquire()
+        task = asyncio.create_task(self.notify(message, received_at))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def notify(self, message, received_at):
+        try:
+            decoded = await asyncio.get_running_loop().run_in_executor(self.decode_pool, skyalert_commits.decode_message, message)
+            if decoded is None or decoded[2] is None:
+                return
+            _, commit_time, ops = decoded
+            trace = skyalert_latency.Trace(skyalert_latency.commit_time(commit_time), received_at)
+            await asyncio.to_thread(self.firehose.notify_ops, ops, trace)
+        except Exception:
+            print("Failed to send notifications for a commit:")
+            traceback.print_exc()
+        finally:
+            self.slots.release()
+
+# Runs func on a thread every interval seconds, like skyalert_scheduler does for the command services:
+# a run that returns a number picks its own next delay, runs over budget are reported, and a failed run
+# is printed without stopping the next ones.
+async def every(name, func, interval, jitter=0.0, budget=None, delay=0.0):
+    await asyncio.sleep(delay)
+    while True:
+        started = time.monotonic()
+        result = None
+        try:
+            result = await asyncio.to_thread(func)
+        except Exception:
+            print(f"Task {name} failed:")
+            traceback.print_exc()
+        duration = time.monotonic() - started
+        if budget is not None and duration > budget:
+            print(f"Task {name} took {duration:.0f}s, over its {budget:.0f}s budget.")
+        if isinstance(result, (int, float)) and not isinstance(result, bool):
+            await asyncio.sleep(result)
+        else:
+            await asyncio.sleep(max(interval - duration, 0) + random.uniform(0, jitter))
+
+async def main(args):
+    loop = asyncio.get_running_loop()
+    # the hourly jobs hold a thread for as long as they run, next to the commits being rendered
+    loop.set_default_executor(concurrent.futures.ThreadPoolExecutor(NOTIFY_CONCURRENCY + 8, thread_name_prefix="skyalert"))
+    stop = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+
+    firehose = load_script('skyalert-firehose.py', 'skyalert_firehose')
+    commands = load_script(f'skyalert-{args.commands}.py', f'skyalert_{args.commands}')
+
+    client = skyalert_session.SharedSessionClient(request=skyalert_ratelimit.RateLimitedRequest())
+    await asyncio.to_thread(skyalert_session.login, client)
+    print(f"Logged in as {client.me.handle}.")
+    firehose.client = client
+    commands.client = client
+
+    dispatcher = skyalert_outbox.Dispatcher(args.dm_workers).start()
+    firehose.outbox.start(dispatcher)
+    commands.outbox.start(dispatcher)
+    commands.notices.start(dispatcher)
+
+    tasks = [
+        asyncio.create_task(every("bot-commands", commands.scheduled_bot_commands, commands.cmd_check_interval)),
+        asyncio.create_task(every("validate-watches", commands.scheduled_main, commands.main_interval, jitter=60, budget=commands.main_interval / 2)),
+        asyncio.create_task(every("follow-sweep", commands.follow_watch_sweep_with_retry, commands.follow_sweep_interval, jitter=30, budget=commands.follow_sweep_interval)),
+        asyncio.create_task(every("latency-slo", commands.latency_slo_check, 300)),
+        asyncio.create_task(every("session-refresh", lambda: skyalert_session.keep_fresh(client), 300)),
+    ]
+
+    reader = None
+    decode_pool = None
+    if not args.no_firehose:
+        # spawned rather than forked, since this process already runs threads
+        decode_pool = concurrent.futures.ProcessPoolExecutor(args.decode_workers, mp_context=multiprocessing.get_context('spawn'), initializer=init_decode_worker)
+        reader = FirehoseReader(firehose, decode_pool)
+        # the commands' stale-firehose check and !post-restart restart this reader instead of the firehose unit
+        commands.restart_post_service = lambda: asyncio.run_coroutine_threadsafe(reader.restart(), loop)
+        tasks.append(asyncio.create_task(reader.run()))
+    else:
+        # post notifications come from another unit; restarting that one from here would stop this process
+        commands.restart_post_service = lambda: print("Post notifications run outside this process, not restarting them.")
+
+    await stop.wait()
+    print("Stopping...")
+    if reader is not None:
+        await reader.stop()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    firehose.outbox.stop()
+    commands.outbox.stop()
+    commands.notices.stop()
+    # DMs still waiting in the dispatcher were already written to the outboxes, and are sent on the next start
+    if decode_pool is not None:
+        decode_pool.shutdown(cancel_futures=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run all SkyAlert services in one process.")
+    parser.add_argument('--commands', choices=['cmds', 'cmdsv2'], default='cmds', help="command service to host (default: cmds)")
+    parser.add_argument('--no-firehose', action='store_true', help="don't read the firehose, e.g. while skyalert-jetstream sends post notifications")
+    parser.add_argument('--decode-workers', type=int, default=DECODE_WORKERS, help=f"processes decoding commits (default: {DECODE_WORKERS})")
+    parser.add_argument('--dm-workers', type=int, default=skyalert_outbox.SENDERS, help=f"DMs sent at once (default: {skyalert_outbox.SENDERS})")
+    args = parser.parse_args()
+
+    skyalert_profiling.install("unified")
+    asyncio.run(main(args))
@@ -0,0 +1,150 @@
+import os
+import json
+import atproto_client.exceptions
+import skyalert_identity
+import skyalert_store
+
+# Incremental DM intake based on chat.bsky.convo.getLog, shared by skyalert-cmds.py and skyalert-cmdsv2.py.
+# Instead of paging through every conversation on every check, the bot remembers the last log cursor
+# and only asks the chat service for events that happened after it.
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+CHAT_LOG_CURSOR_FILE = os.path.join(DATA_DIR, 'chat_log_cursor.txt')
+PROCESSED_LEDGER_FILE = os.path.join(DATA_DIR, 'processed_messages.json')
+VERBOSE_PRINTING = False
+
+LOG_CREATE_MESSAGE = "chat.bsky.convo.defs#logCreateMessage"
+MESSAGE_VIEW = "chat.bsky.convo.defs#messageView"
+
+# poll interval bounds in seconds; the interval drops to the minimum when commands arrive
+# and backs off towards the maximum while the bot is idle
+CMD_CHECK_MIN_INTERVAL = 3
+CMD_CHECK_MAX_INTERVAL = 30
+MAX_LOG_PAGES = 50
+
+def get_chat_log_cursor():
+    if not os.path.exists(CHAT_LOG_CURSOR_FILE):
+        return None
+    with open(CHAT_LOG_CURSOR_FILE, 'r') as f:
+        cursor = f.read().strip()
+        return cursor if cursor else None
+
+# Once the cursor is saved, the log never returns the messages it has passed again, so the ledger entries
+# at or before it are no longer needed.
+def save_chat_log_cursor(cursor):
+    if cursor is None:
+        return
+    with open(CHAT_LOG_CURSOR_FILE, 'w') as f:
+        f.write(cursor)
+    skyalert_store.prune_processed_messages(cursor)
+
+# The ledger maps each convo id to the id and rev of the last message the bot handled there, so a command
+# is never executed twice even if the reply fails or the process restarts before the cursor is saved. It
+# lives in skyalert.db, one row per convo, so marking a message is a single-row write; it only holds the
+# convos with messages past the saved cursor. A processed_messages.json from older versions is imported once.
+def get_processed_ledger():
+    if os.path.exists(PROCESSED_LEDGER_FILE):
+        with open(PROCESSED_LEDGER_FILE, 'r') as f:
+            for convo_id, entry in json.load(f).items():
+                skyalert_store.mark_message_processed(convo_id, entry['id'], entry['rev'])
+        os.replace(PROCESSED_LEDGER_FILE, PROCESSED_LEDGER_FILE + '.migrated')
+        cursor = get_chat_log_cursor()
+        if cursor is not None:
+            skyalert_store.prune_processed_messages(cursor)
+    return skyalert_store.get_processed_messages()
+
+def mark_processed(ledger, message):
+    ledger[message['convo_id']] = {'id': message['id'], 'rev': message['rev']}
+    skyalert_store.mark_message_processed(message['convo_id'], message['id'], message['rev'])
+
+def is_processed(ledger, convo_id, rev):
+    entry = ledger.get(convo_id)
+    return entry is not None and rev <= entry['rev']
+
+def next_cmd_check_interval(current_interval, handled_count):
+    if handled_count > 0:
+        return CMD_CHECK_MIN_INTERVAL
+    return min(current_interval * 2, CMD_CHECK_MAX_INTERVAL)
+
+def _is_incoming_message(message, my_did):
+    return message.get('py_type') == MESSAGE_VIEW and message['sender']['did'] != my_did
+
+# Full sweep over the conversation list, used when there is no stored cursor yet (first start, or the
+# stored cursor was rejected). Log cursors are convo revs, so the newest rev seen becomes the starting cursor.
+# Convos the ledger has already caught up with are skipped without any further calls, and so are messages
+# at or before handled_through (a rejected cursor), since the ledger no longer lists the convos it passed.
+def _bootstrap_from_convos(dm, my_did, ledger, handled_through=None):
+    if VERBOSE_PRINTING: print("No chat log cursor, bootstrapping from conversation list...")
+    messages = []
+    newest_rev = None
+    cursor = None
+    while True:
+        dmconvos_objs = dm.list_convos({'cursor': cursor}).model_dump()
+        for convo in dmconvos_objs['convos']:
+            skyalert_identity.remember_profiles(convo['members'])
+            if newest_rev is None or convo['rev'] > newest_rev:
+                newest_rev = convo['rev']
+            last_message = convo.get('last_message')
+            if not last_message or not _is_incoming_message(last_message, my_did):
+                continue # The bot sent the last message, skip
+            if is_processed(ledger, convo['id'], last_message['rev']):
+                continue
+            if handled_through is not None and last_message['rev'] <= handled_through:
+                continue
+            if convo['id'] in ledger:
+                messages.extend(_get_unprocessed_messages(dm, convo['id'], my_did, ledger))
+            else:
+                # never seen this convo before, only its latest message is treated as a command
+                messages.append({**last_message, 'convo_id': convo['id']})
+        cursor = dmconvos_objs.get('cursor')
+        if cursor is None:
+            break
+
+    messages.sort(key=lambda message: message['rev'])
+    return messages, newest_rev
+
+# getMessages returns newest first, so paging stops at the first message the ledger already covers
+def _get_unprocessed_messages(dm, convo_id, my_did, ledger):
+    messages = []
+    cursor = None
+    for _ in range(MAX_LOG_PAGES):
+        messages_objs = dm.get_messages({'convo_id': convo_id, 'cursor': cursor}).model_dump()
+        for message in messages_objs['messages']:
+            if is_processed(ledger, convo_id, message['rev']):
+                return messages
+            if _is_incoming_message(message, my_did):
+                messages.append({**message, 'convo_id': convo_id})
+        cursor = messages_objs.get('cursor')
+        if cursor is None:
+            break
+    return messages
+
+# Returns the messages sent to the bot since the last saved cursor (oldest first) and the cursor to save
+# once they have been handled. Messages already recorded in the ledger are left out.
+def fetch_new_messages(dm, my_did, ledger):
+    cursor = get_chat_log_cursor()
+    if cursor is None:
+        return _bootstrap_from_convos(dm, my_did, ledger)
+
+    saved_cursor = cursor
+    messages = []
+    for _ in range(MAX_LOG_PAGES):
+        try:
+            log_objs = dm.get_log({'cursor': cursor}).model_dump()
+        except atproto_client.exceptions.BadRequestError as e:
+            if VERBOSE_PRINTING: print(f"Chat log cursor rejected ({e}), starting over.")
+            return _bootstrap_from_convos(dm, my_did, ledger, saved_cursor)
+        for log in log_objs['logs']:
+            if log.get('py_type') != LOG_CREATE_MESSAGE:
+                continue
+            skyalert_identity.remember_profiles(log.get('related_profiles'))
+            if is_processed(ledger, log['convo_id'], log['message']['rev']):
+                continue
+            if _is_incoming_message(log['message'], my_did):
+                messages.append({**log['message'], 'convo_id': log['convo_id']})
+        if not log_objs['logs'] or log_objs.get('cursor') is None or log_objs['cursor'] == cursor:
+            break
+        cursor = log_objs['cursor']
+
+    if VERBOSE_PRINTING: print(f"Chat log returned {len(messages)} new messages.")
+    return messages, cursor
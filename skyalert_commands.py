@@ -0,0 +1,72 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+# Command routing shared by skyalert-cmds.py and skyalert-cmdsv2.py. Each incoming DM is parsed once into a
+# Command, looked up in a CommandRouter and run on a small thread pool. Commands from the same sender run in
+# the order they were sent; commands from different senders run side by side.
+
+VERBOSE_PRINTING = False
+COMMAND_WORKERS = 4
+
+@dataclass
+class Command:
+    name: str # lowercased first word, e.g. "!watch"
+    args: list # remaining space separated words, original case
+    text: str
+    sender_did: str
+    sender_handle: str = None
+    message: dict = field(default=None, repr=False)
+
+def parse_command(message):
+    text = message.get('text') or ""
+    parts = text.split(' ')
+    if not parts[0].startswith("!"):
+        return None
+    return Command(name=parts[0].lower(), args=parts[1:], text=text, sender_did=message['sender']['did'], message=message)
+
+class CommandRouter:
+    def __init__(self):
+        self.handlers = {}
+
+    def register(self, name):
+        def decorator(func):
+            self.handlers[name] = func
+            return func
+        return decorator
+
+    def dispatch(self, command):
+        handler = self.handlers.get(command.name)
+        if handler is None:
+            if VERBOSE_PRINTING: print(f"Ignoring unknown command {command.name} from {command.sender_did}")
+            return
+        handler(command)
+
+# Runs the commands through the router, one task per sender on a bounded pool. prepare(command) is called in
+# the worker before dispatching and may return False to drop the command (e.g. the sender's profile failed
+# to load). A failing command does not stop the sender's later commands; the first exception is re-raised
+# once every sender has been served so the caller's retry/backoff still applies.
+def run_commands(router, commands, prepare=None, max_workers=COMMAND_WORKERS):
+    commands_by_sender = OrderedDict()
+    for command in commands:
+        commands_by_sender.setdefault(command.sender_did, []).append(command)
+    if not commands_by_sender:
+        return
+
+    errors = []
+    def run_sender(sender_commands):
+        for command in sender_commands:
+            try:
+                if prepare is not None and prepare(command) is False:
+                    continue
+                router.dispatch(command)
+            except Exception as e:
+                print(f"Command {command.name} from {command.sender_did} failed: {e}")
+                errors.append(e)
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(commands_by_sender))) as executor:
+        for sender_commands in commands_by_sender.values():
+            executor.submit(run_sender, sender_commands)
+
+    if errors:
+        raise errors[0]
@@ -0,0 +1,62 @@
+from collections import defaultdict
+from atproto import CAR, AtUri, models, parse_subscribe_repos_message
+
+# Commit decoding for the firehose: pulls the created posts and reposts (and deletions) out of a repo
+# commit's CAR blocks. Kept apart from skyalert-firehose.py so it can be benchmarked without a login.
+
+# from the atproto python repo examples
+
+INTERESTED_RECORDS = {
+    models.ids.AppBskyFeedPost: models.AppBskyFeedPost,
+    models.ids.AppBskyFeedRepost: models.AppBskyFeedRepost
+}
+
+def get_ops_by_type(commit: models.ComAtprotoSyncSubscribeRepos.Commit) -> defaultdict:
+    operation_by_type = defaultdict(lambda: {'created': [], 'deleted': []})
+
+    car = CAR.from_bytes(commit.blocks)
+    for op in commit.ops:
+        if op.action == 'update':
+            # not supported yet
+            continue
+
+        uri = AtUri.from_str(f'at://{commit.repo}/{op.path}')
+
+        if op.action == 'create':
+            if not op.cid:
+                continue
+
+            create_info = {'uri': str(uri), 'cid': str(op.cid), 'author': commit.repo}
+
+            record_raw_data = car.blocks.get(op.cid)
+            if not record_raw_data:
+                continue
+
+            record = models.get_or_create(record_raw_data, strict=False)
+            record_type = INTERESTED_RECORDS.get(uri.collection)
+            if record_type and models.is_record_type(record, record_type):
+                operation_by_type[uri.collection]['created'].append({'record': record, **create_info})
+
+        if op.action == 'delete':
+            operation_by_type[uri.collection]['deleted'].append({'uri': str(uri)})
+
+    return operation_by_type
+
+# (did, handle) for an #identity frame, else None. handle is None when the event doesn't carry one.
+def decode_identity(message):
+    event = parse_subscribe_repos_message(message)
+    if not isinstance(event, models.ComAtprotoSyncSubscribeRepos.Identity):
+        return None
+    return event.did, event.handle
+
+# Everything the firehose needs from one frame: (seq, time, ops) for a commit, None for other messages. ops
+# is None for commits without blocks, else a plain dict of the interested collections, so the result can
+# come back from a worker process (the firehose pool, or the decode pool of skyalert-unified.py).
+def decode_message(message):
+    commit = parse_subscribe_repos_message(message)
+    if not isinstance(commit, models.ComAtprotoSyncSubscribeRepos.Commit):
+        return None
+    if not commit.blocks:
+        return commit.seq, commit.time, None
+    ops = get_ops_by_type(commit)
+    return commit.seq, commit.time, {collection: ops[collection] for collection in INTERESTED_RECORDS}
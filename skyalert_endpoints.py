@@ -0,0 +1,35 @@
+import os
+
+import yaml
+
+# Where the SkyAlert services connect. Without configuration everything points at the live network. To
+# run against something else, such as the local mock server in benchmarks/mockserver.py, copy
+# example-endpoints.yaml to data/endpoints.yaml (or point SKYALERT_ENDPOINTS at another file) and set the
+# URLs to override; keys left out keep their defaults.
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+ENDPOINTS_FILE = os.environ.get('SKYALERT_ENDPOINTS') or os.path.join(DATA_DIR, 'endpoints.yaml')
+
+DEFAULTS = {
+    'service-url': 'https://bsky.social/xrpc', # PDS/AppView the clients call (chat goes through it too)
+    'firehose-url': 'wss://bsky.network/xrpc', # relay for com.atproto.sync.subscribeRepos
+    'jetstream-url': 'wss://jetstream2.us-east.bsky.network/subscribe',
+    'handle-resolver-url': None, # service to resolve handles with; None resolves them through DNS/HTTP
+}
+
+def load_endpoints(path=None):
+    path = path or ENDPOINTS_FILE
+    endpoints = dict(DEFAULTS)
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            endpoints.update({key: value for key, value in (yaml.safe_load(f) or {}).items() if key in DEFAULTS})
+    return endpoints
+
+_endpoints = load_endpoints()
+SERVICE_URL = _endpoints['service-url']
+FIREHOSE_URL = _endpoints['firehose-url']
+JETSTREAM_URL = _endpoints['jetstream-url']
+HANDLE_RESOLVER_URL = _endpoints['handle-resolver-url']
+
+def is_live():
+    return SERVICE_URL == DEFAULTS['service-url']
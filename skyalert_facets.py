@@ -0,0 +1,62 @@
+import re
+
+# Rich text facets for the DMs SkyAlert sends, shared by all four services. One scan over the message
+# turns markdown links ([text](url)) into their text and finds bare links, producing the filtered text
+# and the facets together. Facet positions are UTF-8 byte offsets into the filtered text, as Bluesky
+# expects, so emoji and other non-ASCII text before a link don't shift it.
+#
+# Link detection originally by latchk3y on the Bluesky API Discord server.
+
+MARKDOWN_LINK = r'\[(?P<text>[^\]]+)\]\((?P<url>https?://[^\s]+)\)'
+BARE_LINK = r'(?P<link>https?://[^\s]+)'
+
+_markdown_pattern = re.compile(f'{MARKDOWN_LINK}|{BARE_LINK}')
+_links_pattern = re.compile(BARE_LINK)
+
+def _link_facet(byte_start, byte_end, uri):
+    return {
+        "index": {
+            "byteStart": byte_start,
+            "byteEnd": byte_end
+        },
+        "features": [
+            {
+                "$type": "app.bsky.richtext.facet#link",
+                "uri": uri
+            }
+        ]
+    }
+
+def _utf8_length(text):
+    return len(text.encode('utf-8'))
+
+def build_facets(text, markdown=True):
+    pattern = _markdown_pattern if markdown else _links_pattern
+    # for ASCII text bytes and characters line up, so the pieces don't need encoding
+    byte_length = len if text.isascii() else _utf8_length
+    pieces = []
+    facets = []
+    byte_offset = 0
+    position = 0
+    for match in pattern.finditer(text):
+        before = text[position:match.start()]
+        pieces.append(before)
+        byte_offset += byte_length(before)
+        link = match.group('link')
+        if link is not None:
+            shown, uri = link, link
+        else:
+            shown, uri = match.group('text'), match.group('url')
+        pieces.append(shown)
+        shown_bytes = byte_length(shown)
+        facets.append(_link_facet(byte_offset, byte_offset + shown_bytes, uri))
+        byte_offset += shown_bytes
+        position = match.end()
+    pieces.append(text[position:])
+    return {"facets": facets, "filtered_text": "".join(pieces)}
+
+def get_facets_from_markdown(text):
+    return build_facets(text, markdown=True)
+
+def get_facets_from_links(text):
+    return build_facets(text, markdown=False)["facets"]
@@ -0,0 +1,373 @@
+import os
+import json
+import time
+import heapq
+import struct
+import tempfile
+import threading
+import zlib
+import yaml
+
+# Follower snapshots for follow watches. A snapshot is the sorted list of a user's follower DIDs, stored as
+# one zlib-compressed, newline separated block behind a small header:
+#   b'SKFS' | version (u8) | follower count (u32, little endian) | zlib(b'did1\ndid2\n...')
+# Loading a snapshot is a single decompress + split, and unfollows are computed with set operations.
+# Follow-watch syncs never load a whole snapshot: fetched DIDs are spilled to sorted run files, merged, and
+# diffed against the stored snapshot as two sorted streams, so memory stays flat however big the account is.
+# Next to each snapshot, a head file keeps the newest HEAD_SIZE followers (newest first) as of the last sync,
+# for the quick check of followers that arrived since.
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+CACHE_DIR = os.path.join(DATA_DIR, 'cache')
+VERBOSE_PRINTING = False
+
+SNAPSHOT_MAGIC = b'SKFS'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct('<4sBI')
+SNAPSHOT_EXTENSIONS = (".bin", ".yaml")
+
+SYNC_STATE_FILE = os.path.join(CACHE_DIR, 'follower-sync-state.json')
+FOLLOWERS_PAGE_SIZE = 100 # maximum page size accepted by app.bsky.graph.getFollowers
+FULL_RECONCILE_INTERVAL = 24 * 3600
+MAX_PREFIX_PAGES = 20 # more new followers than this and a full fetch is cheaper to reason about
+HEAD_SIZE = FOLLOWERS_PAGE_SIZE
+STREAM_CHUNK_SIZE = 100_000 # DIDs held in memory before a sorted run is spilled to disk
+STREAM_READ_SIZE = 64 * 1024
+
+_sync_state_lock = threading.Lock() # follow watches are checked from several threads
+
+def snapshot_file(did):
+    return os.path.join(CACHE_DIR, f'followers-{did}.bin')
+
+def _legacy_snapshot_file(did):
+    return os.path.join(CACHE_DIR, f'followers-{did}.yaml')
+
+def head_file(did):
+    return os.path.join(CACHE_DIR, f'followers-{did}.head')
+
+# The newest followers at the last sync, newest first; empty for snapshots written before head files.
+def load_head(did):
+    path = head_file(did)
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r') as f:
+        return f.read().split()
+
+def save_head(did, dids):
+    path = head_file(did)
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, 'w') as f:
+        f.write("\n".join(dids[:HEAD_SIZE]))
+    os.replace(temp_path, path)
+
+def encode_snapshot(dids):
+    dids = sorted(set(dids))
+    body = zlib.compress("\n".join(dids).encode('utf-8'), 1)
+    return SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(dids)) + body
+
+def decode_snapshot(data):
+    magic, version, count = SNAPSHOT_HEADER.unpack_from(data)
+    if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+        raise ValueError("not a SkyAlert follower snapshot")
+    if count == 0:
+        return []
+    dids = zlib.decompress(data[SNAPSHOT_HEADER.size:]).decode('utf-8').split("\n")
+    if len(dids) != count:
+        raise ValueError(f"follower snapshot is truncated ({len(dids)} of {count} DIDs)")
+    return dids
+
+def snapshot_count(did):
+    path = snapshot_file(did)
+    if not os.path.exists(path):
+        if load_snapshot(did) is None: # converts a legacy YAML cache if there is one
+            return None
+    with open(path, 'rb') as f:
+        _, _, count = SNAPSHOT_HEADER.unpack(f.read(SNAPSHOT_HEADER.size))
+        return count
+
+# Yields the stored follower DIDs in sorted order without holding the snapshot in memory.
+def iter_snapshot(did):
+    if snapshot_count(did) is None:
+        return
+    with open(snapshot_file(did), 'rb') as f:
+        magic, version, _ = SNAPSHOT_HEADER.unpack(f.read(SNAPSHOT_HEADER.size))
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError("not a SkyAlert follower snapshot")
+        decompressor = zlib.decompressobj()
+        pending = b''
+        while True:
+            block = f.read(STREAM_READ_SIZE)
+            if not block:
+                break
+            pending += decompressor.decompress(block)
+            lines = pending.split(b'\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line.decode('utf-8')
+        pending += decompressor.flush()
+        for line in pending.split(b'\n'):
+            if line:
+                yield line.decode('utf-8')
+
+# Writes a snapshot from DIDs that are already sorted and unique. Nothing replaces the stored snapshot
+# until commit() is called.
+class SnapshotWriter:
+    def __init__(self, did):
+        self.path = snapshot_file(did)
+        self.temp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        self.file = open(self.temp_path, 'wb')
+        self.file.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, 0))
+        self.compressor = zlib.compressobj(1)
+        self.count = 0
+
+    def write(self, did):
+        data = did.encode('utf-8') if self.count == 0 else b'\n' + did.encode('utf-8')
+        self.file.write(self.compressor.compress(data))
+        self.count += 1
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.file.write(self.compressor.flush())
+        self.file.seek(0)
+        self.file.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, self.count))
+        self.file.close()
+
+    def commit(self):
+        self.close()
+        os.replace(self.temp_path, self.path)
+
+    def discard(self):
+        self.close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+# Returns the stored follower DIDs (sorted), or None if this user has no snapshot yet. Snapshots written by
+# older versions as YAML lists are converted on first load.
+def load_snapshot(did):
+    path = snapshot_file(did)
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            return decode_snapshot(f.read())
+
+    legacy_path = _legacy_snapshot_file(did)
+    if os.path.exists(legacy_path):
+        if VERBOSE_PRINTING: print(f"Converting YAML follower cache for {did}...")
+        with open(legacy_path, 'r') as f:
+            dids = yaml.safe_load(f) or []
+        save_snapshot(did, dids)
+        os.remove(legacy_path)
+        return sorted(set(dids))
+
+    return None
+
+def save_snapshot(did, dids):
+    path = snapshot_file(did)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(encode_snapshot(dids))
+    os.replace(temp_path, path)
+
+def delete_snapshot(did):
+    for path in (snapshot_file(did), _legacy_snapshot_file(did), head_file(did)):
+        if os.path.exists(path):
+            os.remove(path)
+    with _sync_state_lock:
+        state = _get_sync_state()
+        if state.pop(did, None) is not None:
+            _save_sync_state(state)
+
+# DIDs of every user with a snapshot on disk, used by the dangling cache check
+def list_snapshot_dids():
+    dids = set()
+    for file_name in os.listdir(CACHE_DIR):
+        if not file_name.startswith("followers-"):
+            continue
+        for extension in SNAPSHOT_EXTENSIONS:
+            if file_name.endswith(extension):
+                dids.add(file_name[len("followers-"):-len(extension)])
+    return dids
+
+# Returns (unfollowed, new_followers), both sorted. O(n + m) instead of a list scan per cached DID.
+def diff_followers(previous_dids, current_dids):
+    previous = set(previous_dids)
+    current = set(current_dids)
+    return sorted(previous - current), sorted(current - previous)
+
+# Unfollows for two sorted, duplicate-free streams, in one pass without holding either of them in memory.
+# Every current DID is passed to on_current as it goes by, so the new snapshot can be written in the same pass.
+def diff_sorted(previous_dids, current_dids, on_current=None):
+    unfollowed = []
+    previous_iter = iter(previous_dids)
+    previous_did = next(previous_iter, None)
+    for current_did in current_dids:
+        if on_current is not None:
+            on_current(current_did)
+        while previous_did is not None and previous_did < current_did:
+            unfollowed.append(previous_did)
+            previous_did = next(previous_iter, None)
+        if previous_did == current_did:
+            previous_did = next(previous_iter, None)
+    while previous_did is not None:
+        unfollowed.append(previous_did)
+        previous_did = next(previous_iter, None)
+    return unfollowed
+
+def _write_run(dids, temp_dir):
+    run_file = tempfile.NamedTemporaryFile('w', dir=temp_dir, suffix='.run', delete=False, encoding='utf-8')
+    with run_file:
+        for did in dids:
+            run_file.write(did + '\n')
+    return run_file.name
+
+def _iter_run(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            yield line.rstrip('\n')
+
+# External sort: DIDs are collected in chunks of STREAM_CHUNK_SIZE, each chunk is sorted and spilled to a
+# run file in temp_dir, and the runs are merged back into one sorted, de-duplicated stream.
+def sorted_unique(dids, temp_dir):
+    runs = []
+    chunk = []
+    for did in dids:
+        chunk.append(did)
+        if len(chunk) >= STREAM_CHUNK_SIZE:
+            chunk.sort()
+            runs.append(_iter_run(_write_run(chunk, temp_dir)))
+            chunk = []
+    chunk.sort()
+    runs.append(iter(chunk))
+
+    last_did = None
+    for did in heapq.merge(*runs):
+        if did != last_did:
+            yield did
+            last_did = did
+
+def _get_sync_state():
+    if not os.path.exists(SYNC_STATE_FILE):
+        return {}
+    with open(SYNC_STATE_FILE, 'r') as f:
+        return json.load(f)
+
+def _save_sync_state(state):
+    temp_path = SYNC_STATE_FILE + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(temp_path, SYNC_STATE_FILE)
+
+def _record_full_sync(did):
+    with _sync_state_lock:
+        state = _get_sync_state()
+        state[did] = time.time()
+        _save_sync_state(state)
+
+def is_full_sync_due(did):
+    last_full_sync = _get_sync_state().get(did, 0)
+    return time.time() - last_full_sync > FULL_RECONCILE_INTERVAL
+
+# Yields follower DIDs page by page as they arrive, newest follower first. The first HEAD_SIZE go into
+# newest if given.
+def iter_all_followers(client, did, newest=None):
+    cursor = None
+    while True:
+        response = client.get_followers(did, cursor=cursor, limit=FOLLOWERS_PAGE_SIZE)
+        for follower in response.followers:
+            if newest is not None and len(newest) < HEAD_SIZE:
+                newest.append(follower.did)
+            yield follower.did
+        cursor = response.cursor
+        if cursor is None or not response.followers:
+            return
+
+def fetch_all_followers(client, did):
+    return list(iter_all_followers(client, did))
+
+# Which of the given DIDs are in the user's stored snapshot, found with one streaming pass.
+def known_followers(did, dids):
+    wanted = set(dids)
+    known = set()
+    for stored_did in iter_snapshot(did):
+        if stored_did in wanted:
+            known.add(stored_did)
+            if len(known) == len(wanted):
+                break
+    return known
+
+# getFollowers lists newest followers first, so everything before the first DID we already know is new.
+# The first known one is normally among the newest followers of the last sync, so pages are checked
+# against the head file; only when no head follower turns up (they all left, or there is no head yet) is
+# the snapshot scanned, once, for every DID fetched. Returns (new DIDs, or None if no known follower
+# turned up within MAX_PREFIX_PAGES pages; the newest HEAD_SIZE followers, for the next head).
+def fetch_new_followers(client, did):
+    head = set(load_head(did))
+    fetched = []
+    new_count = None
+    cursor = None
+    for _ in range(MAX_PREFIX_PAGES):
+        response = client.get_followers(did, cursor=cursor, limit=FOLLOWERS_PAGE_SIZE)
+        for follower in response.followers:
+            if new_count is None and follower.did in head:
+                new_count = len(fetched)
+            fetched.append(follower.did)
+        cursor = response.cursor
+        if new_count is not None or cursor is None or not response.followers:
+            break
+    newest = fetched[:HEAD_SIZE]
+    if new_count is not None:
+        return fetched[:new_count], newest
+    known = known_followers(did, fetched)
+    for index, follower_did in enumerate(fetched):
+        if follower_did in known:
+            return fetched[:index], newest
+    if cursor is None or not response.followers:
+        return fetched, newest
+    return None, newest
+
+# Works out which followers left since the last sync. Returns (unfollowed_dids, commit); call commit() once
+# the user has been notified to store the new snapshot, so a failed DM is retried on the next run.
+# When the profile's follower count equals the known followers plus the new prefix, nobody can have left,
+# so only the first page or two are fetched. Anything else, and a periodic safety pass, does a full fetch.
+def sync_followers(client, did, followers_count):
+    previous_count = snapshot_count(did)
+    full_sync_due = is_full_sync_due(did)
+
+    if previous_count is not None and not full_sync_due and followers_count is not None:
+        new_dids, newest = fetch_new_followers(client, did)
+        if new_dids is not None and previous_count + len(new_dids) == followers_count:
+            if VERBOSE_PRINTING: print(f"Follower count for {did} matches, {len(new_dids)} new followers and no unfollows.")
+            if not new_dids:
+                return [], lambda: None if newest == load_head(did) else save_head(did, newest)
+            writer = SnapshotWriter(did)
+            try:
+                last_did = None
+                for merged_did in heapq.merge(iter_snapshot(did), sorted(set(new_dids))):
+                    if merged_did != last_did:
+                        writer.write(merged_did)
+                        last_did = merged_did
+                writer.close()
+            except BaseException:
+                writer.discard()
+                raise
+            def commit_prefix():
+                writer.commit()
+                save_head(did, newest)
+            return [], commit_prefix
+
+    if VERBOSE_PRINTING: print(f"Running full follower reconciliation for {did}...")
+    writer = SnapshotWriter(did)
+    newest = []
+    try:
+        with tempfile.TemporaryDirectory(dir=CACHE_DIR) as temp_dir:
+            current = sorted_unique(iter_all_followers(client, did, newest), temp_dir)
+            unfollowed = diff_sorted(iter_snapshot(did), current, on_current=writer.write)
+        writer.close()
+    except BaseException:
+        writer.discard()
+        raise
+    def commit_full():
+        writer.commit()
+        save_head(did, newest)
+        _record_full_sync(did)
+    return unfollowed, commit_full
@@ -0,0 +1,40 @@
+# Handle and URL helpers shared by the SkyAlert services. Bridgy Fed accounts (*.ap.brid.gy) are shown and
+# accepted in their Fediverse form, and the .bsky.social suffix is left off in messages.
+
+def post_url_from_at_uri(at_uri):
+    # Split the AT URI to extract the DID and the random string
+    parts = at_uri.split('/')
+    did = parts[2]
+    random_string = parts[-1]
+    
+    # Construct the Bluesky URL
+    url = f"https://bsky.app/profile/{did}/post/{random_string}"
+    return url
+
+def bridgy_to_fed(handle: str):
+    if handle.endswith("ap.brid.gy"):
+        parts = handle.split('.')
+        if len(parts) >= 3:
+            username = parts[0]
+            domain = '.'.join(parts[1:-3])
+            return f"@{username}@{domain} (Bridgy)"
+        else:
+            return f"@{handle}"
+    else:
+        if handle.endswith("bsky.social"):
+            handle = handle[:-12]  # Remove ".bsky.social" from the end
+        return handle
+    
+def fed_to_bridgy(handle: str):
+    if "@" in handle:
+        parts = handle.split('@')
+        if len(parts) >= 3:  # If given a Fediverse handle, output the Bridgy handle
+            username = parts[1]
+            domain = '.'.join(parts[2:])
+            return f"{username}.{domain}.ap.brid.gy"
+        else:  # If given a normal Bluesky handle, output the handle ensuring there is no @ at the beginning
+            return handle.lstrip('@')
+    else:
+        if not handle.endswith("bsky.social") and '.' not in handle:
+            handle += ".bsky.social"
+        return handle
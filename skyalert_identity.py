@@ -0,0 +1,252 @@
+import os
+import json
+import time
+import fcntl
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+import httpx
+import dns.resolver
+
+import skyalert_endpoints
+
+# Shared DID <-> handle cache for the SkyAlert services. Entries expire after HANDLE_TTL seconds and
+# the cache is written to disk so a restarted service starts warm instead of re-resolving everyone.
+# Handles that don't resolve are remembered for NEGATIVE_TTL seconds, so a typo in !watch or a DM to a
+# dead handle doesn't hit DNS/HTTP again; lookups that merely failed (timeouts, 429, 5xx) are not. The
+# cache keeps at most MAX_ENTRIES identities, dropping the least recently refreshed ones, and every
+# service merges its entries into the same file when saving.
+# Lookups only mark the cache dirty; each service saves it from its own loop with save_identity_cache(),
+# which writes at most every SAVE_INTERVAL seconds unless forced.
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+CACHE_DIR = os.path.join(DATA_DIR, 'cache')
+IDENTITY_CACHE_FILE = os.path.join(CACHE_DIR, 'identities.json')
+LOCK_FILE = os.path.join(CACHE_DIR, 'identities.lock')
+VERBOSE_PRINTING = False
+
+HANDLE_TTL = 6 * 3600
+NEGATIVE_TTL = 15 * 60
+MAX_ENTRIES = 100_000
+SAVE_INTERVAL = 60
+RESOLVE_TIMEOUT = 10
+
+_handles_by_did = OrderedDict() # did -> {'handle': ..., 'fetched_at': ...}, least recently refreshed first
+_dids_by_handle = {} # handle -> did
+_unresolvable = {} # handle -> time the resolution failed
+_forgotten = {} # did -> time it was forgotten, so merging the file doesn't bring it back
+_loaded = False
+_dirty = False
+_last_save = 0.0
+_lock = threading.RLock() # the command handler looks up identities from several threads
+
+def _load():
+    global _loaded
+    with _lock:
+        if _loaded:
+            return
+        _loaded = True
+        _merge(_read_cache_file())
+        if VERBOSE_PRINTING: print(f"Loaded {len(_handles_by_did)} cached identities.")
+
+def _read_cache_file():
+    if not os.path.exists(IDENTITY_CACHE_FILE):
+        return {}
+    try:
+        with open(IDENTITY_CACHE_FILE, 'r') as f:
+            cache = json.load(f)
+    except (OSError, ValueError) as e:
+        if VERBOSE_PRINTING: print(f"Could not load identity cache, starting cold: {e}")
+        return {}
+    if 'identities' not in cache:
+        cache = {'identities': cache} # written before negative caching was added
+    return cache
+
+# Takes in entries saved by this or another service, keeping whichever side is newer.
+def _merge(cache):
+    now = time.time()
+    for did, entry in sorted(cache.get('identities', {}).items(), key=lambda item: item[1]['fetched_at']):
+        current = _handles_by_did.get(did)
+        if entry['fetched_at'] <= _forgotten.get(did, 0):
+            continue
+        if current is None or current['fetched_at'] < entry['fetched_at']:
+            _set_identity(did, entry)
+    for handle, failed_at in cache.get('unresolvable', {}).items():
+        if now - failed_at < NEGATIVE_TTL and failed_at > _unresolvable.get(handle, 0):
+            _unresolvable[handle] = failed_at
+    _evict()
+
+def _set_identity(did, entry):
+    old_entry = _handles_by_did.pop(did, None)
+    if old_entry is not None and _dids_by_handle.get(old_entry['handle']) == did:
+        del _dids_by_handle[old_entry['handle']]
+    _handles_by_did[did] = entry
+    _dids_by_handle[entry['handle']] = did
+    _unresolvable.pop(entry['handle'], None)
+
+def _evict():
+    while len(_handles_by_did) > MAX_ENTRIES:
+        did, entry = _handles_by_did.popitem(last=False)
+        if _dids_by_handle.get(entry['handle']) == did:
+            del _dids_by_handle[entry['handle']]
+    if len(_unresolvable) > MAX_ENTRIES:
+        cutoff = time.time() - NEGATIVE_TTL
+        for handle in [handle for handle, failed_at in _unresolvable.items() if failed_at < cutoff]:
+            del _unresolvable[handle]
+
+# Held across the read-merge-write of the cache file, so services saving at the same time don't drop
+# each other's entries.
+@contextmanager
+def _file_locked():
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(LOCK_FILE, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+# The in-memory cache is only locked while the file's entries are merged in and copied out, so lookups
+# on other threads don't wait for the file to be read and written.
+def save_identity_cache(force=False):
+    global _dirty, _last_save
+    if not _dirty:
+        return
+    if not force and time.time() - _last_save < SAVE_INTERVAL:
+        return
+    with _file_locked():
+        saved = _read_cache_file()
+        with _lock:
+            _merge(saved)
+            copied_at = time.time()
+            cache = {
+                'identities': dict(_handles_by_did),
+                'unresolvable': {handle: failed_at for handle, failed_at in _unresolvable.items() if failed_at > copied_at - NEGATIVE_TTL},
+            }
+            _dirty = False
+        try:
+            temp_file = f"{IDENTITY_CACHE_FILE}.{os.getpid()}.tmp"
+            with open(temp_file, 'w') as f:
+                json.dump(cache, f)
+            os.replace(temp_file, IDENTITY_CACHE_FILE)
+        except BaseException:
+            _dirty = True
+            raise
+    with _lock:
+        for did in [did for did, forgotten_at in _forgotten.items() if forgotten_at <= copied_at]:
+            del _forgotten[did]
+        _last_save = time.time()
+
+def remember_identity(did, handle):
+    global _dirty
+    with _lock:
+        _load()
+        if not did or not handle:
+            return
+        _set_identity(did, {'handle': handle, 'fetched_at': time.time()})
+        _evict()
+        _dirty = True
+
+def forget_identity(did):
+    global _dirty
+    with _lock:
+        _load()
+        entry = _handles_by_did.pop(did, None)
+        _forgotten[did] = time.time()
+        if entry is not None:
+            _dids_by_handle.pop(entry['handle'], None)
+            _dirty = True
+
+# Identity events (firehose #identity frames, Jetstream identity events) only refresh DIDs we already
+# know about, so watching the whole network does not fill the cache with strangers. An event without a
+# handle drops the entry, so the next lookup resolves it again.
+def refresh_identity(did, handle):
+    with _lock:
+        _load()
+        if did not in _handles_by_did:
+            return
+        if handle:
+            remember_identity(did, handle)
+        else:
+            forget_identity(did)
+
+def remember_profiles(profiles):
+    for profile in profiles or []:
+        remember_identity(profile['did'], profile['handle'])
+
+def get_cached_handle(did, max_age=HANDLE_TTL):
+    _load()
+    entry = _handles_by_did.get(did)
+    if entry is None or time.time() - entry['fetched_at'] > max_age:
+        return None
+    return entry['handle']
+
+def get_cached_did(handle, max_age=HANDLE_TTL):
+    _load()
+    did = _dids_by_handle.get(handle)
+    if did is None or get_cached_handle(did, max_age) != handle:
+        return None
+    return did
+
+# Returns the handle for a DID, asking the AppView only when the cached entry is missing or older than max_age.
+# A failed lookup (deleted or suspended account) raises the client's exception as get_profile would.
+def get_handle(client, did, max_age=HANDLE_TTL):
+    handle = get_cached_handle(did, max_age)
+    if handle is not None:
+        return handle
+    profile = client.get_profile(did)
+    remember_identity(profile.did, profile.handle)
+    return profile.handle
+
+# com.atproto.identity.resolveHandle on the configured service, used instead of DNS/HTTP when one is set.
+# The service answers 400 (InvalidHandle) for a handle it can't resolve; anything else that isn't a DID raises.
+def _resolve_with_service(handle):
+    response = httpx.get(f"{skyalert_endpoints.HANDLE_RESOLVER_URL.rstrip('/')}/com.atproto.identity.resolveHandle", params={'handle': handle}, timeout=RESOLVE_TIMEOUT)
+    if response.status_code == 400:
+        return None
+    response.raise_for_status()
+    return response.json().get('did')
+
+# The _atproto TXT record, then https://<handle>/.well-known/atproto-did, as atproto's HandleResolver does.
+# That one returns None for every failure, though, while this only does when the handle has no DID: a
+# missing record, no such host, a 4xx. DNS timeouts, unreachable name servers, 429 and 5xx raise.
+def _resolve_with_dns_and_http(handle):
+    try:
+        answers = dns.resolver.resolve(f"_atproto.{handle}", 'TXT', lifetime=RESOLVE_TIMEOUT)
+    except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+        answers = []
+    for answer in answers:
+        for item in answer.strings:
+            value = item.decode('UTF-8')
+            if value.startswith('did='):
+                return value[len('did='):]
+    try:
+        response = httpx.get(f"https://{handle}/.well-known/atproto-did", timeout=RESOLVE_TIMEOUT)
+    except httpx.ConnectError:
+        return None
+    if response.status_code == 429 or response.status_code >= 500:
+        response.raise_for_status()
+    lines = response.text.strip().splitlines() if response.status_code == 200 else []
+    return lines[0].strip() if lines and lines[0].startswith('did:') else None
+
+# Returns the DID for a handle, or None if the handle does not resolve. A lookup that couldn't be made
+# raises, so the caller (the outbox, a command) can try again instead of treating the handle as dead.
+def resolve_handle(handle):
+    global _dirty
+    did = get_cached_did(handle)
+    if did is not None:
+        return did
+    failed_at = _unresolvable.get(handle)
+    if failed_at is not None and time.time() - failed_at < NEGATIVE_TTL:
+        return None
+    if skyalert_endpoints.HANDLE_RESOLVER_URL:
+        did = _resolve_with_service(handle)
+    else:
+        did = _resolve_with_dns_and_http(handle)
+    if did:
+        remember_identity(did, handle)
+    else:
+        with _lock:
+            _unresolvable[handle] = time.time()
+            _dirty = True
+    return did
@@ -0,0 +1,207 @@
+import os
+import json
+import math
+import time
+import sqlite3
+import datetime
+import threading
+from collections import Counter
+
+# End-to-end latency of post notifications, from the subject posting to the chat API accepting the DM.
+# The event readers start a Trace per event with its creation time (the firehose commit time or the
+# Jetstream time_us) and when it was received, then mark each stage as the notification moves along:
+#   ingest   created -> received by the service (relay/Jetstream lag)
+#   match    received -> watches matched (queueing between firehose processes, decoding, the store lookup)
+#   render   matched -> DM text built (profile and post lookups)
+#   enqueue  rendered -> handed to send_dm
+#   send     handed to send_dm -> accepted by the chat API (conversation lookup, rate limit waits, sending)
+# Finished traces go into per-minute histograms in data/cache/latency.db, shared by all services, and
+# notifications slower than SLOW_THRESHOLD are logged with their stage timings to
+# data/logs/slow-notifications.jsonl. report() and check_slo() read the histograms back and name the stage
+# responsible when the p99 goes over SLO_P99.
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+CACHE_DIR = os.path.join(DATA_DIR, 'cache')
+LOGS_DIR = os.path.join(DATA_DIR, 'logs')
+STORE_FILE = os.path.join(CACHE_DIR, 'latency.db')
+SLOW_LOG_FILE = os.path.join(LOGS_DIR, 'slow-notifications.jsonl')
+VERBOSE_PRINTING = False
+
+STAGES = ['ingest', 'match', 'render', 'enqueue', 'send']
+SLOW_THRESHOLD = 10.0 # seconds; slower notifications are logged
+SLO_P99 = 10.0 # seconds; p99 of the total above this is an SLO breach
+REPORT_WINDOW = 60 * 60
+RETENTION = 7 * 24 * 3600
+BUCKETS_PER_DOUBLING = 4 # histogram buckets grow by 2^(1/4) (about 19%) from 1ms
+MAX_BUCKET = 24 * BUCKETS_PER_DOUBLING # about 4.6 hours; the last bucket holds everything slower
+
+class Trace:
+    def __init__(self, created, received=None, subject_did=None):
+        self.marks = {'created': created, 'ingest': received if received is not None else time.time()}
+        self.subject_did = subject_did
+
+    def mark(self, stage):
+        self.marks[stage] = time.time()
+
+    def copy(self, subject_did=None):
+        trace = Trace(self.marks['created'], subject_did=subject_did or self.subject_did)
+        trace.marks = dict(self.marks)
+        return trace
+
+    # seconds spent in each marked stage, and in total
+    def durations(self):
+        durations = {}
+        previous = self.marks['created']
+        for stage in STAGES:
+            if stage in self.marks:
+                durations[stage] = max(self.marks[stage] - previous, 0)
+                previous = self.marks[stage]
+        durations['total'] = max(previous - self.marks['created'], 0)
+        return durations
+
+    def to_dict(self):
+        return {'marks': dict(self.marks), 'subject-did': self.subject_did}
+
+    @classmethod
+    def from_dict(cls, data):
+        trace = cls(data['marks']['created'], subject_did=data.get('subject-did'))
+        trace.marks = dict(data['marks'])
+        return trace
+
+# Creation times as the streams give them.
+def commit_time(value):
+    try:
+        return datetime.datetime.fromisoformat(value).timestamp()
+    except (TypeError, ValueError):
+        return time.time()
+
+def jetstream_time(time_us):
+    return time_us / 1_000_000 if time_us else time.time()
+
+def bucket_for(seconds):
+    milliseconds = seconds * 1000
+    if milliseconds <= 1:
+        return 0
+    return min(math.ceil(math.log2(milliseconds) * BUCKETS_PER_DOUBLING), MAX_BUCKET)
+
+def bucket_limit(bucket):
+    return 2 ** (bucket / BUCKETS_PER_DOUBLING) / 1000
+
+_local = threading.local()
+
+def _connect():
+    conn = getattr(_local, 'conn', None)
+    # a connection inherited from the parent process (the firehose forks workers) can't be reused
+    if conn is None or _local.pid != os.getpid():
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        conn = sqlite3.connect(STORE_FILE, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("""CREATE TABLE IF NOT EXISTS histogram (
+            minute INTEGER NOT NULL,
+            stage TEXT NOT NULL,
+            bucket INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (minute, stage, bucket)) WITHOUT ROWID""")
+        _local.conn = conn
+        _local.pid = os.getpid()
+    return conn
+
+# The stage that took longest in a notification.
+def slowest_stage(durations):
+    return max(STAGES, key=lambda stage: durations.get(stage, 0))
+
+# Records a notification the chat API accepted. service and the DIDs only go into the slow log.
+def record(trace, service=None, receiver_did=None):
+    durations = trace.durations()
+    minute = int(time.time() // 60)
+    rows = [(minute, stage, bucket_for(seconds)) for stage, seconds in durations.items()]
+    slow = durations['total'] > SLOW_THRESHOLD
+    if slow:
+        # which stage made it slow, counted so reports can attribute a breach
+        rows.append((minute, 'slow:' + slowest_stage(durations), 0))
+    conn = _connect()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.executemany("""INSERT INTO histogram (minute, stage, bucket, count) VALUES (?, ?, ?, 1)
+            ON CONFLICT (minute, stage, bucket) DO UPDATE SET count = count + 1""", rows)
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    if slow:
+        entry = {'time': time.time(), 'service': service, 'receiver': receiver_did, 'subject': trace.subject_did,
+            'total': round(durations['total'], 3), 'slowest': slowest_stage(durations),
+            'stages': {stage: round(seconds, 3) for stage, seconds in durations.items() if stage != 'total'}}
+        os.makedirs(LOGS_DIR, exist_ok=True)
+        with open(SLOW_LOG_FILE, 'a') as f:
+            f.write(json.dumps(entry) + "\n")
+        if VERBOSE_PRINTING: print(f"Slow notification: {durations['total']:.1f}s, mostly {entry['slowest']}.")
+
+def _percentile(buckets, fraction):
+    total = sum(buckets.values())
+    if not total:
+        return None
+    needed = total * fraction
+    seen = 0
+    for bucket in sorted(buckets):
+        seen += buckets[bucket]
+        if seen >= needed:
+            return bucket_limit(bucket)
+    return bucket_limit(max(buckets))
+
+# Latency percentiles per stage over the last window seconds. Percentiles are the upper edges of the
+# histogram buckets, so they read up to 19% high.
+def latency_stats(window=REPORT_WINDOW):
+    since = int((time.time() - window) // 60)
+    histograms = {}
+    slow_stages = Counter()
+    for stage, bucket, count in _connect().execute("SELECT stage, bucket, SUM(count) FROM histogram WHERE minute >= ? GROUP BY stage, bucket", (since,)):
+        if stage.startswith('slow:'):
+            slow_stages[stage[5:]] += count
+        else:
+            histograms.setdefault(stage, Counter())[bucket] += count
+    stats = {}
+    for stage in ['total'] + STAGES:
+        buckets = histograms.get(stage, Counter())
+        stats[stage] = {'count': sum(buckets.values()), 'p50': _percentile(buckets, 0.50), 'p90': _percentile(buckets, 0.90), 'p99': _percentile(buckets, 0.99)}
+    return {'window': window, 'stages': stats, 'slow_stages': dict(slow_stages)}
+
+# The stage to blame for slow notifications: the one most often slowest among them, or failing that the
+# one with the highest p99.
+def attribute(stats):
+    if stats['slow_stages']:
+        return max(stats['slow_stages'], key=stats['slow_stages'].get)
+    candidates = [stage for stage in STAGES if stats['stages'][stage]['p99'] is not None]
+    return max(candidates, key=lambda stage: stats['stages'][stage]['p99']) if candidates else None
+
+def _format_seconds(seconds):
+    if seconds is None:
+        return "-"
+    return f"{seconds * 1000:.0f}ms" if seconds < 1 else f"{seconds:.1f}s"
+
+def report(window=REPORT_WINDOW):
+    stats = latency_stats(window)
+    total = stats['stages']['total']
+    if not total['count']:
+        return f"No notifications sent in the last {window // 60} minutes."
+    lines = [f"Notification latency, last {window // 60} minutes ({total['count']} DMs):"]
+    for stage in ['total'] + STAGES:
+        entry = stats['stages'][stage]
+        if entry['count']:
+            lines.append(f"{stage}: p50 {_format_seconds(entry['p50'])}, p90 {_format_seconds(entry['p90'])}, p99 {_format_seconds(entry['p99'])}")
+    if total['p99'] is not None and total['p99'] > SLO_P99:
+        lines.append(f"p99 is over the {SLO_P99:.0f}s SLO, mostly in {attribute(stats)}.")
+    if stats['slow_stages']:
+        slow = sum(stats['slow_stages'].values())
+        lines.append(f"{slow} slow notifications, slowest stage: " + ", ".join(f"{stage} {count}" for stage, count in Counter(stats['slow_stages']).most_common()))
+    return "\n".join(lines)
+
+# Returns (stage, p99) when the p99 of the window is over the SLO, else None. Also drops old histograms.
+def check_slo(window=15 * 60):
+    _connect().execute("DELETE FROM histogram WHERE minute < ?", (int((time.time() - RETENTION) // 60),))
+    stats = latency_stats(window)
+    p99 = stats['stages']['total']['p99']
+    if p99 is None or p99 <= SLO_P99:
+        return None
+    return attribute(stats), p99
@@ -0,0 +1,422 @@
+import os
+import json
+import time
+import random
+import sqlite3
+import threading
+import traceback
+import concurrent.futures
+from collections import deque
+from dataclasses import dataclass
+
+import atproto_client.exceptions
+
+import skyalert_latency
+
+# Durable outbound DMs. Every DM is written to data/cache/outbox.db before it is sent and deleted once the
+# chat API accepted it, so a crash, a restart (RuntimeMaxSec restarts the units daily) or a failed send
+# never loses it: failed sends are retried with exponential backoff, and whatever a stopped process was
+# sending is picked up again when a service of the same kind starts. DMs that can't be sent (the chat API
+# rejected them, or they kept failing for MAX_ATTEMPTS tries) go to data/logs/dead-letters.jsonl instead.
+#
+# Rows are claimed by setting next_attempt LEASE seconds ahead, so several processes (the firehose
+# workers) can retry from the same table without sending a DM twice. Each kind of service has its own
+# rows (service), since each formats its DMs its own way.
+#
+# The threaded services use an Outbox, with the function that actually sends; the Jetstream service
+# drives the same table from its event loop with record(), claim_due() and settle().
+#
+# Outboxes started with a Dispatcher hand their DMs to its sender threads instead of sending them on the
+# caller's thread. The dispatcher takes turns between receivers (see FairQueue), so someone watching
+# hundreds of busy accounts doesn't hold up everybody else's notifications; command replies skip ahead.
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+CACHE_DIR = os.path.join(DATA_DIR, 'cache')
+LOGS_DIR = os.path.join(DATA_DIR, 'logs')
+STORE_FILE = os.path.join(CACHE_DIR, 'outbox.db')
+DEAD_LETTER_FILE = os.path.join(LOGS_DIR, 'dead-letters.jsonl')
+VERBOSE_PRINTING = False
+
+MAX_ATTEMPTS = 8
+RETRY_BASE = 15 # seconds before the first retry, doubling each time (about an hour of retries in all)
+RETRY_MAX = 30 * 60
+LEASE = 15 * 60 # a claimed DM is retried by someone else after this; longer than a send can take with rate limit waits
+RETRY_POLL = 10 # seconds between looks for DMs due for a retry
+CLAIM_BATCH = 50
+SENDERS = 4 # threads of a Dispatcher
+MAX_QUEUED_PER_RECEIVER = 10 # DMs a receiver may have waiting in a dispatcher; more are folded into a digest
+MAX_MESSAGE_LENGTH = 1000 # chat messages are limited to 1000 characters
+
+# Sending again won't help with these: the chat API refused the DM itself (too long, the receiver doesn't
+# accept DMs, a handle that doesn't resolve) or it couldn't be built.
+PERMANENT_ERRORS = (atproto_client.exceptions.BadRequestError, atproto_client.exceptions.ModelError)
+
+@dataclass
+class Entry:
+    id: int
+    service: str
+    receiver: str
+    message: str
+    trace: skyalert_latency.Trace = None
+    attempts: int = 0
+    created: float = 0.0
+    claimed_until: float = 0.0
+
+_local = threading.local()
+
+def _connect():
+    conn = getattr(_local, 'conn', None)
+    # a connection inherited from the parent process (the firehose forks workers) can't be reused
+    if conn is None or _local.pid != os.getpid():
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        conn = sqlite3.connect(STORE_FILE, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=FULL") # an acknowledged write has to survive a power loss
+        conn.execute("""CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY,
+            service TEXT NOT NULL,
+            receiver TEXT NOT NULL,
+            message TEXT NOT NULL,
+            trace TEXT,
+            created REAL NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt REAL NOT NULL,
+            claimed_by INTEGER,
+            last_error TEXT)""")
+        conn.execute("CREATE INDEX IF NOT EXISTS outbox_due ON outbox (service, next_attempt)")
+        _local.conn = conn
+        _local.pid = os.getpid()
+    return conn
+
+def _entry(row, claimed_until):
+    id, service, receiver, message, trace, attempts, created = row
+    return Entry(id, service, receiver, message, skyalert_latency.Trace.from_dict(json.loads(trace)) if trace else None, attempts, created, claimed_until)
+
+# Writes a DM to the outbox, claimed by the caller, who is expected to send it and settle() it.
+def record(service, receiver, message, trace=None):
+    if trace is not None:
+        trace.mark('enqueue')
+    now = time.time()
+    cursor = _connect().execute("INSERT INTO outbox (service, receiver, message, trace, created, next_attempt, claimed_by) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (service, receiver, message, json.dumps(trace.to_dict()) if trace is not None else None, now, now + LEASE, os.getpid()))
+    return Entry(cursor.lastrowid, service, receiver, message, trace, 0, now, now + LEASE)
+
+# Claims up to limit DMs of service that are due for a retry (or were left behind by a stopped process).
+def claim_due(service, limit=CLAIM_BATCH):
+    conn = _connect()
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # oldest first, but taking turns between receivers, so a backlog of one receiver's DMs is replayed
+        # alongside everyone else's rather than before them
+        rows = conn.execute("""SELECT id, service, receiver, message, trace, attempts, created FROM (
+                SELECT *, ROW_NUMBER() OVER (PARTITION BY receiver ORDER BY next_attempt) AS turn
+                FROM outbox WHERE service = ? AND next_attempt <= ?)
+            ORDER BY turn, next_attempt LIMIT ?""", (service, now, limit)).fetchall()
+        conn.executemany("UPDATE outbox SET next_attempt = ?, claimed_by = ? WHERE id = ?", [(now + LEASE, os.getpid(), row[0]) for row in rows])
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    return [_entry(row, now + LEASE) for row in rows]
+
+# Renews the caller's claim on entry right before sending it. False if the claim ran out meanwhile and
+# someone else took the DM (their claim changed next_attempt), or it was settled already.
+def renew(entry):
+    claimed_until = time.time() + LEASE
+    if _connect().execute("UPDATE outbox SET next_attempt = ? WHERE id = ? AND next_attempt = ?", (claimed_until, entry.id, entry.claimed_until)).rowcount == 0:
+        return False
+    entry.claimed_until = claimed_until
+    return True
+
+# Makes DMs claimed by processes that are gone due right away, instead of when their lease runs out.
+def release_orphans(service):
+    conn = _connect()
+    for (pid,) in conn.execute("SELECT DISTINCT claimed_by FROM outbox WHERE service = ? AND claimed_by IS NOT NULL", (service,)).fetchall():
+        if pid == os.getpid():
+            continue
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            conn.execute("UPDATE outbox SET next_attempt = ?, claimed_by = NULL WHERE service = ? AND claimed_by = ?", (time.time(), service, pid))
+        except PermissionError:
+            pass # alive, just not ours to signal
+
+# Text of a digest: as many of the messages as fit in one DM, and how many more there were.
+def _digest_header(count, total):
+    if count == total:
+        return f"{total} notifications came in at once, so here they are in one message:"
+    return f"{total} notifications came in at once, so here are {count} of them in one message and the rest follow:"
+
+# The digest of as many of messages as fit in one DM, in order, and how many that is. The first one always
+# goes in, cut short if it is too long by itself.
+def digest_message(messages):
+    length = len(_digest_header(len(messages) - 1, len(messages))) # the longer header, whichever is used
+    count = 0
+    for message in messages:
+        if count and length + 2 + len(message) > MAX_MESSAGE_LENGTH:
+            break
+        length += 2 + len(message)
+        count += 1
+    text = "\n\n".join([_digest_header(count, len(messages))] + messages[:count])
+    return (text if len(text) <= MAX_MESSAGE_LENGTH else text[:MAX_MESSAGE_LENGTH - 1] + "…"), count
+
+# Replaces claimed entries of one receiver with a single digest DM, claimed by the caller like record()
+# does. Entries whose claim ran out meanwhile are left to whoever took them. The digest carries the
+# oldest trace, so the latency histograms still see how long the wait was. Only the entries that fit in
+# one DM are folded; the others stay in the outbox, still claimed, and are returned for another digest.
+# Returns (digest entry or None if nothing was left, entries still to send).
+def fold(service, receiver, entries):
+    conn = _connect()
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        live = [entry for entry in entries if conn.execute("SELECT 1 FROM outbox WHERE id = ? AND next_attempt = ?", (entry.id, entry.claimed_until)).fetchone()]
+        if not live:
+            conn.execute("COMMIT")
+            return None, []
+        message, count = digest_message([entry.message for entry in live])
+        kept, rest = live[:count], live[count:]
+        conn.executemany("DELETE FROM outbox WHERE id = ?", [(entry.id,) for entry in kept])
+        trace = next((entry.trace for entry in kept if entry.trace is not None), None)
+        cursor = conn.execute("INSERT INTO outbox (service, receiver, message, trace, created, next_attempt, claimed_by) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (service, receiver, message, json.dumps(trace.to_dict()) if trace is not None else None, kept[0].created, now + LEASE, os.getpid()))
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    if VERBOSE_PRINTING: print(f"Folded {len(kept)} DMs to {receiver} into a digest, {len(rest)} left for the next one.")
+    return Entry(cursor.lastrowid, service, receiver, message, trace, 0, kept[0].created, now + LEASE), rest
+
+def acknowledge(entry):
+    _connect().execute("DELETE FROM outbox WHERE id = ?", (entry.id,))
+    if entry.trace is not None:
+        entry.trace.mark('send')
+        skyalert_latency.record(entry.trace, entry.service, entry.receiver)
+
+def retry_later(entry, error):
+    entry.attempts += 1
+    delay = min(RETRY_BASE * 2 ** (entry.attempts - 1), RETRY_MAX) * random.uniform(0.8, 1.2)
+    _connect().execute("UPDATE outbox SET attempts = ?, next_attempt = ?, claimed_by = NULL, last_error = ? WHERE id = ?",
+        (entry.attempts, time.time() + delay, str(error)[:500], entry.id))
+    if VERBOSE_PRINTING: print(f"DM to {entry.receiver} failed ({error}), retrying in {delay:.0f}s.")
+
+def dead_letter(entry, error):
+    letter = {'time': time.time(), 'service': entry.service, 'receiver': entry.receiver, 'message': entry.message,
+        'created': entry.created, 'attempts': entry.attempts + 1, 'error': f"{type(error).__name__}: {error}"}
+    os.makedirs(LOGS_DIR, exist_ok=True)
+    with open(DEAD_LETTER_FILE, 'a') as f:
+        f.write(json.dumps(letter) + "\n")
+    _connect().execute("DELETE FROM outbox WHERE id = ?", (entry.id,))
+    print(f"Gave up on a DM to {entry.receiver} after {letter['attempts']} attempts: {letter['error']}")
+
+# Records how sending went: acknowledged, retried later, or dead-lettered. Returns whether it was sent.
+def settle(entry, error=None):
+    if error is None:
+        acknowledge(entry)
+        return True
+    if isinstance(error, PERMANENT_ERRORS) or entry.attempts + 1 >= MAX_ATTEMPTS:
+        dead_letter(entry, error)
+    else:
+        retry_later(entry, error)
+    return False
+
+def pending_count(service=None):
+    if service is None:
+        return _connect().execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+    return _connect().execute("SELECT COUNT(*) FROM outbox WHERE service = ?", (service,)).fetchone()[0]
+
+# The outbox of one kind of service, sending with deliver(receiver, message). urgent outboxes (command
+# replies) go ahead of the others in a shared Dispatcher.
+class Outbox:
+    def __init__(self, service, deliver, urgent=False):
+        self.service = service
+        self.deliver = deliver
+        self.urgent = urgent
+        self.dispatcher = None
+        self.thread = None
+        self.stopped = threading.Event()
+
+    # Records the DM, then tries to send it right away, or leaves it to the dispatcher. Failures are kept
+    # for retry and don't raise, unless raise_permanent is set and the DM can never be sent (the caller may
+    # want to send something else instead, such as a shorter message); the caller then waits for the
+    # dispatcher. Returns whether it was sent, or None when it was left to the dispatcher.
+    def send(self, receiver, message, trace=None, raise_permanent=False):
+        entry = self.record(receiver, message, trace)
+        if self.dispatcher is None:
+            return self.attempt(entry, raise_permanent)
+        return self.dispatcher.submit(self, entry, raise_permanent)
+
+    def record(self, receiver, message, trace=None):
+        return record(self.service, receiver, message, trace)
+
+    def attempt(self, entry, raise_permanent=False):
+        if not renew(entry):
+            return False
+        try:
+            self.deliver(entry.receiver, entry.message)
+        except Exception as e:
+            settle(entry, e)
+            if raise_permanent and isinstance(e, PERMANENT_ERRORS):
+                raise
+            return False
+        return settle(entry)
+
+    def retry_pending(self):
+        entries = claim_due(self.service)
+        for entry in entries:
+            if self.dispatcher is None:
+                self.attempt(entry)
+            else:
+                self.dispatcher.submit(self, entry)
+        return len(entries)
+
+    def _run(self):
+        release_orphans(self.service)
+        while True:
+            try:
+                # DMs left over from before a restart are due right away, so the first pass replays them
+                while self.retry_pending() == CLAIM_BATCH:
+                    pass
+            except Exception:
+                print(f"Retrying {self.service} DMs failed:")
+                traceback.print_exc()
+            if self.stopped.wait(RETRY_POLL):
+                return
+
+    # Starts retrying in the background, and sending through dispatcher from now on if given; call once
+    # per process.
+    def start(self, dispatcher=None):
+        self.dispatcher = dispatcher
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name=f"skyalert-outbox-{self.service}", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+@dataclass
+class Delivery:
+    outbox: Outbox
+    entry: Entry
+    raise_permanent: bool = False
+    future: concurrent.futures.Future = None # set when the caller waits for the outcome
+
+# DMs of one receiver that didn't fit in its queue, sent as digests when its queue has drained.
+@dataclass
+class Digest:
+    receiver: str
+    deliveries: list
+
+# Who sends next, when DMs wait for senders. Every receiver has a queue of its own and the receivers with
+# something queued take turns, one DM each: deficit round robin where every DM costs the same (one chat
+# send), so a receiver with hundreds of DMs waiting delays someone else's by one DM per turn at most,
+# rather than by all of them. A receiver's queue holds up to cap DMs; the rest wait aside and go out as
+# a Digest after the queue. Urgent DMs skip the turns and are never folded. Not thread safe.
+class FairQueue:
+    def __init__(self, cap=MAX_QUEUED_PER_RECEIVER):
+        self.cap = cap
+        self.urgent = deque()
+        self.queues = {}
+        self.overflow = {}
+        self.turns = deque()
+
+    def put(self, receiver, item, urgent=False):
+        if urgent:
+            self.urgent.append(item)
+            return
+        queue = self.queues.get(receiver)
+        if queue is None:
+            queue = self.queues[receiver] = deque()
+            self.turns.append(receiver)
+        # once some wait aside, the rest do too, or a steady stream would keep the queue from draining
+        if receiver in self.overflow or (self.cap is not None and len(queue) >= self.cap):
+            self.overflow.setdefault(receiver, []).append(item)
+        else:
+            queue.append(item)
+
+    # the next item to send, or None when nothing waits
+    def pop(self):
+        if self.urgent:
+            return self.urgent.popleft()
+        if not self.turns:
+            return None
+        receiver = self.turns.popleft()
+        queue = self.queues[receiver]
+        item = queue.popleft()
+        if not queue and receiver in self.overflow:
+            queue.append(Digest(receiver, self.overflow.pop(receiver)))
+        if queue:
+            self.turns.append(receiver)
+        else:
+            del self.queues[receiver]
+        return item
+
+    # Puts back what did not fit in a Digest, ahead of anything that waits aside for the receiver since, so
+    # it goes out as the receiver's next digest, on the receiver's next turn.
+    def put_back(self, receiver, items):
+        self.overflow[receiver] = items + self.overflow.get(receiver, [])
+        if receiver not in self.queues:
+            self.queues[receiver] = deque([Digest(receiver, self.overflow.pop(receiver))])
+            self.turns.append(receiver)
+
+# Sender threads for the outboxes of a process, taking DMs in FairQueue order. A Digest is folded into a
+# single DM (fold()) right before it is sent; what doesn't fit in it is put back as the receiver's next Digest.
+class Dispatcher:
+    def __init__(self, senders=SENDERS, cap=MAX_QUEUED_PER_RECEIVER):
+        self.senders = senders
+        self.queue = FairQueue(cap)
+        self.ready = threading.Condition()
+        self.threads = []
+
+    # Queues entry for sending. A caller that needs the outcome (raise_permanent) waits for it, and goes
+    # ahead of the turns rather than into a digest.
+    def submit(self, outbox, entry, raise_permanent=False):
+        delivery = Delivery(outbox, entry, raise_permanent, concurrent.futures.Future() if raise_permanent else None)
+        with self.ready:
+            self.queue.put(entry.receiver, delivery, outbox.urgent or raise_permanent)
+            self.ready.notify()
+        if delivery.future is not None:
+            return delivery.future.result()
+        return None
+
+    def _run(self):
+        while True:
+            with self.ready:
+                item = self.queue.pop()
+                while item is None:
+                    self.ready.wait()
+                    item = self.queue.pop()
+            try:
+                if isinstance(item, Digest):
+                    # a digest holds the DMs of one outbox (post notifications, or follow notices); the
+                    # others waiting aside for the receiver go out in its next digest
+                    outbox = item.deliveries[0].outbox
+                    entry, rest = fold(outbox.service, item.receiver, [delivery.entry for delivery in item.deliveries if delivery.outbox is outbox])
+                    unsent = {left.id for left in rest}
+                    left_over = [delivery for delivery in item.deliveries if delivery.outbox is not outbox or delivery.entry.id in unsent]
+                    if left_over:
+                        with self.ready:
+                            self.queue.put_back(item.receiver, left_over)
+                            self.ready.notify()
+                    if entry is None:
+                        continue
+                    item = Delivery(outbox, entry)
+                result = item.outbox.attempt(item.entry, item.raise_permanent)
+            except Exception as e:
+                if isinstance(item, Delivery) and item.future is not None:
+                    item.future.set_exception(e)
+                else:
+                    print("Sending a DM failed:")
+                    traceback.print_exc()
+                continue
+            if item.future is not None:
+                item.future.set_result(result)
+
+    def start(self):
+        if not self.threads:
+            for index in range(self.senders):
+                thread = threading.Thread(target=self._run, name=f"skyalert-dm-{index}", daemon=True)
+                thread.start()
+                self.threads.append(thread)
+        return self
@@ -0,0 +1,93 @@
+import threading
+import atproto_client.exceptions
+import skyalert_identity
+
+# Batched profile lookups for the hourly jobs. A ProfileLookup lives for one run: every DID is fetched at
+# most once, in groups of PROFILES_BATCH_SIZE through app.bsky.actor.getProfiles, and accounts the AppView
+# doesn't return (deleted, deactivated, suspended) are remembered as MISSING instead of raising. A lookup is
+# shared by the sweep's threads: the lock only guards the bookkeeping, the requests run outside it, and a
+# DID another thread is already fetching is waited for rather than fetched twice.
+
+VERBOSE_PRINTING = False
+PROFILES_BATCH_SIZE = 25 # maximum number of actors accepted by getProfiles
+
+MISSING = None
+
+class ProfileLookup:
+    def __init__(self, client):
+        self.client = client
+        self.profiles = {} # did -> ProfileViewDetailed, or MISSING
+        self.fetching = {} # did -> Event set once the thread fetching it is done
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def prefetch(self, dids):
+        wanted = []
+        claimed = set()
+        waiting = {}
+        with self.lock:
+            for did in dids:
+                if not did or did in self.profiles or did in waiting or did in claimed:
+                    continue
+                if did in self.fetching:
+                    waiting[did] = self.fetching[did]
+                else:
+                    self.fetching[did] = threading.Event()
+                    claimed.add(did)
+                    wanted.append(did)
+        try:
+            for start in range(0, len(wanted), PROFILES_BATCH_SIZE):
+                batch = wanted[start:start + PROFILES_BATCH_SIZE]
+                found = self._fetch_batch(batch)
+                with self.lock:
+                    self.profiles.update(found)
+                    for did in batch:
+                        self.fetching.pop(did).set()
+        finally:
+            # whatever a failed request left unfetched is free for the next caller to try
+            with self.lock:
+                for did in wanted:
+                    if did not in self.profiles and did in self.fetching:
+                        self.fetching.pop(did).set()
+        for event in waiting.values():
+            event.wait()
+        missed = [did for did in waiting if did not in self.profiles]
+        if missed:
+            self.prefetch(missed)
+
+    # Returns did -> profile (or MISSING) for one batch.
+    def _fetch_batch(self, dids):
+        with self.lock:
+            self.calls += 1
+        try:
+            response = self.client.get_profiles(dids)
+        except atproto_client.exceptions.BadRequestError as e:
+            # one malformed actor fails the whole batch, so fall back to single lookups for these DIDs
+            if VERBOSE_PRINTING: print(f"getProfiles batch failed ({e}), looking up {len(dids)} profiles one by one.")
+            return {did: self._fetch_single(did) for did in dids}
+        found = dict.fromkeys(dids, MISSING)
+        for profile in response.profiles:
+            found[profile.did] = profile
+            skyalert_identity.remember_identity(profile.did, profile.handle)
+        return found
+
+    def _fetch_single(self, did):
+        with self.lock:
+            self.calls += 1
+        try:
+            profile = self.client.get_profile(did)
+        except atproto_client.exceptions.BadRequestError:
+            return MISSING
+        skyalert_identity.remember_identity(profile.did, profile.handle)
+        return profile
+
+    # Returns the profile, or MISSING if the account can't be loaded. DIDs that weren't prefetched are
+    # fetched on their own.
+    def get(self, did):
+        if did not in self.profiles:
+            self.prefetch([did])
+        return self.profiles.get(did, MISSING)
+
+    def get_handle(self, did):
+        profile = self.get(did)
+        return profile.handle if profile is not MISSING else None
@@ -0,0 +1,212 @@
+import os
+import sys
+import json
+import time
+import signal
+import threading
+import tracemalloc
+from collections import Counter
+
+# Opt-in profiling for the SkyAlert services. Off by default and free when off. Turn it on with the
+# SKYALERT_PROFILE environment variable (any value but 0), or at runtime by sending SIGUSR2, which toggles
+# it: "systemctl kill -s USR2 skyalert-firehose" reaches the firehose workers too.
+#
+# While on, a sampler thread records the stack of every other thread SAMPLE_INTERVAL seconds apart (wall
+# clock, so threads waiting on the network show up too), and
+# tracemalloc follows allocations. Every WRITE_INTERVAL seconds (and when profiling is turned off) the
+# process writes to data/profiles/, labelled by service and pid:
+#   <service>-<pid>-<time>.folded   stack samples in folded form, for flamegraph.pl or speedscope
+#   <service>-<pid>-<time>.memory   top allocation sites, and the growth since the previous write
+#   <service>-<pid>.json            latest top-N summary, read by summary() for the !profile command
+# A process keeps its newest MAX_FILES_PER_PROCESS .folded and .memory files, and files of any process older
+# than MAX_FILE_AGE are removed, so a service left running with profiling on doesn't fill the disk.
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+PROFILES_DIR = os.path.join(DATA_DIR, 'profiles')
+VERBOSE_PRINTING = False
+
+SAMPLE_INTERVAL = 0.01
+WRITE_INTERVAL = 60
+MAX_DEPTH = 64
+TRACEMALLOC_FRAMES = 10
+TOP_COUNT = 10
+MEMORY_LINES = 50
+SUMMARY_MAX_AGE = 15 * 60 # summaries older than this are from stopped processes or earlier sessions
+SUMMARY_FUNCTIONS = 5
+MAX_FILES_PER_PROCESS = 60 # of each kind; an hour of writes
+MAX_FILE_AGE = 24 * 3600
+MAX_SUMMARY_LENGTH = 1000 # chat messages are limited to 1000 characters
+
+_service = None
+_lock = threading.Lock()
+_sampler = None
+_stop = threading.Event()
+
+def _frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def _stack(frame):
+    labels = []
+    while frame is not None and len(labels) < MAX_DEPTH:
+        labels.append(_frame_label(frame.f_code))
+        frame = frame.f_back
+    labels.reverse()
+    return ';'.join(labels)
+
+class Sampler(threading.Thread):
+    def __init__(self, service):
+        super().__init__(name="skyalert-profiler", daemon=True)
+        self.service = service
+        self.samples = Counter()
+        self.previous_memory = None
+
+    def run(self):
+        last_write = time.monotonic()
+        while not _stop.wait(SAMPLE_INTERVAL):
+            own = threading.get_ident()
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own:
+                    self.samples[_stack(frame)] += 1
+            if time.monotonic() - last_write >= WRITE_INTERVAL:
+                self.write()
+                last_write = time.monotonic()
+        self.write()
+
+    def write(self):
+        os.makedirs(PROFILES_DIR, exist_ok=True)
+        samples, self.samples = self.samples, Counter()
+        prefix = os.path.join(PROFILES_DIR, f"{self.service}-{os.getpid()}")
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        with open(f"{prefix}-{stamp}.folded", 'w') as f:
+            for stack, count in samples.most_common():
+                f.write(f"{stack} {count}\n")
+
+        memory = tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),)) if tracemalloc.is_tracing() else None
+        memory_top = []
+        memory_growth = []
+        if memory is not None:
+            memory_top = memory.statistics('lineno')[:MEMORY_LINES]
+            if self.previous_memory is not None:
+                memory_growth = [stat for stat in memory.compare_to(self.previous_memory, 'lineno') if stat.size_diff > 0][:MEMORY_LINES]
+            self.previous_memory = memory
+            with open(f"{prefix}-{stamp}.memory", 'w') as f:
+                current, peak = tracemalloc.get_traced_memory()
+                f.write(f"traced: {current / 1024:.1f} KiB, peak {peak / 1024:.1f} KiB\n\ntop allocation sites:\n")
+                f.writelines(f"{stat}\n" for stat in memory_top)
+                f.write("\ngrowth since the previous write:\n")
+                f.writelines(f"{stat}\n" for stat in memory_growth)
+
+        total = sum(samples.values())
+        self_time = Counter()
+        for stack, count in samples.items():
+            self_time[stack.rsplit(';', 1)[-1]] += count
+        summary = {
+            'service': self.service,
+            'pid': os.getpid(),
+            'written': time.time(),
+            'samples': total,
+            'top_functions': [{'function': function, 'share': round(count / total, 3)} for function, count in self_time.most_common(TOP_COUNT)] if total else [],
+            'traced_kib': round(tracemalloc.get_traced_memory()[0] / 1024, 1) if memory is not None else None,
+            'top_allocations': [{'site': str(stat.traceback), 'kib': round(stat.size / 1024, 1)} for stat in memory_top[:TOP_COUNT]],
+            'top_growth': [{'site': str(stat.traceback), 'kib': round(stat.size_diff / 1024, 1)} for stat in memory_growth[:TOP_COUNT]],
+        }
+        with open(f"{prefix}.json.tmp", 'w') as f:
+            json.dump(summary, f)
+        os.replace(f"{prefix}.json.tmp", f"{prefix}.json")
+        prune(f"{self.service}-{os.getpid()}-")
+        if VERBOSE_PRINTING: print(f"Profile written to {prefix}-{stamp}.folded ({total} samples).")
+
+# Removes the oldest .folded and .memory files of the process whose files start with process_prefix
+# beyond MAX_FILES_PER_PROCESS, and every profile file older than MAX_FILE_AGE.
+def prune(process_prefix):
+    cutoff = time.time() - MAX_FILE_AGE
+    own = {'.folded': [], '.memory': []}
+    for name in os.listdir(PROFILES_DIR):
+        path = os.path.join(PROFILES_DIR, name)
+        extension = os.path.splitext(name)[1]
+        try:
+            if os.path.getmtime(path) < cutoff and extension in ('.folded', '.memory', '.json'):
+                os.remove(path)
+                continue
+        except FileNotFoundError:
+            continue # removed by another process pruning at the same time
+        if name.startswith(process_prefix) and extension in own:
+            own[extension].append(name)
+    for names in own.values():
+        names.sort() # the timestamp in the name sorts by time
+        for name in names[:-MAX_FILES_PER_PROCESS]:
+            try:
+                os.remove(os.path.join(PROFILES_DIR, name))
+            except FileNotFoundError:
+                pass
+
+def is_running():
+    return _sampler is not None and _sampler.is_alive()
+
+def start():
+    global _sampler
+    with _lock:
+        if is_running():
+            return
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        _stop.clear()
+        _sampler = Sampler(_service or os.path.basename(sys.argv[0]))
+        _sampler.start()
+    if VERBOSE_PRINTING: print(f"Profiling started for {_sampler.service} (pid {os.getpid()}).")
+
+def stop():
+    global _sampler
+    with _lock:
+        if not is_running():
+            return
+        _stop.set()
+        _sampler.join()
+        _sampler = None
+        tracemalloc.stop()
+    if VERBOSE_PRINTING: print("Profiling stopped.")
+
+def _toggle(signum, frame):
+    # the sampler is joined on stop, which must not happen inside a signal handler
+    threading.Thread(target=stop if is_running() else start, daemon=True).start()
+
+# Call once per process (each firehose worker too), from the main thread. Starts profiling right away if
+# SKYALERT_PROFILE is set, and lets SIGUSR2 toggle it.
+def install(service):
+    global _service
+    _service = service
+    signal.signal(signal.SIGUSR2, _toggle)
+    if os.environ.get('SKYALERT_PROFILE', '0') not in ('', '0'):
+        start()
+
+# Top-N summary over every process that wrote a profile recently (only those of one service if given),
+# for the !profile command.
+def summary(service=None, max_age=SUMMARY_MAX_AGE):
+    if not os.path.isdir(PROFILES_DIR):
+        return "No profiles yet. Start one with SKYALERT_PROFILE=1 or by sending SIGUSR2 to a service."
+    lines = []
+    for name in sorted(os.listdir(PROFILES_DIR)):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(PROFILES_DIR, name), 'r') as f:
+                profile = json.load(f)
+        except (OSError, ValueError):
+            continue
+        age = time.time() - profile['written']
+        if age > max_age or (service and profile['service'] != service):
+            continue
+        header = f"{profile['service']} (pid {profile['pid']}, {age:.0f}s ago): {profile['samples']} samples"
+        if profile['traced_kib'] is not None:
+            header += f", {profile['traced_kib']:.0f} KiB traced"
+        lines.append(header)
+        for entry in profile['top_functions'][:SUMMARY_FUNCTIONS]:
+            lines.append(f"  {entry['share'] * 100:5.1f}% {entry['function']}")
+        for entry in profile['top_growth'][:3]:
+            lines.append(f"  +{entry['kib']:.0f} KiB {entry['site']}")
+    if not lines:
+        return f"No profiles{f' from {service}' if service else ''} written in the last {max_age // 60} minutes."
+    text = "\n".join(lines)
+    if len(text) > MAX_SUMMARY_LENGTH:
+        text = text[:MAX_SUMMARY_LENGTH - 1] + "…"
+    return text
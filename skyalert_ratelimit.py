@@ -0,0 +1,268 @@
+import os
+import time
+import asyncio
+import sqlite3
+import threading
+from urllib.parse import urlparse
+
+import httpx
+from atproto_client.request import Request, AsyncRequest
+import atproto_client.exceptions
+
+# Client-side rate limiting shared by all SkyAlert services. Every XRPC call takes a token from the bucket
+# of its endpoint class before it is sent, so calls are spaced out ahead of time instead of being retried
+# after a 429. Buckets live in a small SQLite file, so the firehose, command and jetstream processes that
+# share one account also share one budget. The ratelimit-* headers the server sends back are fed into the
+# buckets: when the server says the window is nearly spent, the class waits for the reset.
+#
+# Use it by handing a RateLimitedRequest to the client: Client(request=skyalert_ratelimit.RateLimitedRequest()).
+# Clients made with with_bsky_chat_proxy() clone the request, so the chat client is limited too.
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+CACHE_DIR = os.path.join(DATA_DIR, 'cache')
+STORE_FILE = os.path.join(CACHE_DIR, 'ratelimits.db')
+VERBOSE_PRINTING = False
+
+# endpoint class -> (bucket size, tokens refilled per second). Kept under the published limits (3000 requests
+# per 5 minutes for most endpoints, 30 per 5 minutes for createSession) so a burst from one service can't
+# starve the others.
+BUCKETS = {
+    'profile': (300, 2400 / 300),
+    'followers': (100, 1200 / 300),
+    'chat-send': (20, 1.0),
+    'chat-read': (60, 5.0),
+    'session': (5, 20 / 300),
+    'default': (300, 2400 / 300),
+}
+SERVER_RESERVE = 25 # once the server reports this few calls left, wait for its window to reset
+RATE_LIMITED_BACKOFF = 60 # wait after a 429 that didn't say when the window resets
+MAX_WAIT = 300 # a single call never waits longer than this for a token
+
+def endpoint_class(url):
+    nsid = urlparse(url).path.rsplit('/', 1)[-1]
+    if nsid in ('app.bsky.actor.getProfile', 'app.bsky.actor.getProfiles'):
+        return 'profile'
+    if nsid == 'app.bsky.graph.getFollowers':
+        return 'followers'
+    if nsid in ('chat.bsky.convo.sendMessage', 'chat.bsky.convo.sendMessageBatch'):
+        return 'chat-send'
+    if nsid.startswith('chat.bsky.'):
+        return 'chat-read'
+    if nsid in ('com.atproto.server.createSession', 'com.atproto.server.refreshSession'):
+        return 'session'
+    return 'default'
+
+class BucketStore:
+    def __init__(self, path=STORE_FILE, buckets=BUCKETS):
+        self.path = path
+        self.buckets = buckets
+        self.local = threading.local()
+
+    def _connect(self):
+        conn = getattr(self.local, 'conn', None)
+        # a connection inherited from the parent process (the firehose forks workers) can't be reused
+        if conn is None or self.local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS buckets (
+                name TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated REAL NOT NULL,
+                blocked_until REAL NOT NULL DEFAULT 0,
+                server_limit INTEGER,
+                server_remaining INTEGER,
+                server_reset REAL,
+                calls INTEGER NOT NULL DEFAULT 0,
+                waited REAL NOT NULL DEFAULT 0,
+                rate_limited INTEGER NOT NULL DEFAULT 0,
+                since REAL NOT NULL)""")
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def _load(self, conn, name, now):
+        row = conn.execute("SELECT tokens, updated, blocked_until FROM buckets WHERE name = ?", (name,)).fetchone()
+        capacity, rate = self.buckets.get(name, self.buckets['default'])
+        if row is None:
+            conn.execute("INSERT INTO buckets (name, tokens, updated, since) VALUES (?, ?, ?, ?)", (name, capacity, now, now))
+            return capacity, 0
+        tokens, updated, blocked_until = row
+        return min(capacity, tokens + max(now - updated, 0) * rate), blocked_until
+
+    # Takes a token from the bucket, or returns how long to wait before trying again. The check and the
+    # take happen in one write transaction, so processes sharing the store can't both take the last token.
+    def try_acquire(self, name):
+        conn = self._connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            tokens, blocked_until = self._load(conn, name, now)
+            if blocked_until > now:
+                wait = blocked_until - now
+            elif tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (1 - tokens) / self.buckets.get(name, self.buckets['default'])[1]
+            conn.execute("UPDATE buckets SET tokens = ?, updated = ?, calls = calls + ? WHERE name = ?", (tokens, now, 1 if wait == 0 else 0, name))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return wait
+
+    def record_wait(self, name, seconds):
+        conn = self._connect()
+        conn.execute("UPDATE buckets SET waited = waited + ? WHERE name = ?", (seconds, name))
+
+    # Feeds the server's view of the window into the bucket. headers is the lowercase header dict of the
+    # response (or of the 429 error).
+    def observe(self, name, headers, rate_limited=False):
+        limit = _int_header(headers, 'ratelimit-limit')
+        remaining = _int_header(headers, 'ratelimit-remaining')
+        reset = _int_header(headers, 'ratelimit-reset')
+        if not rate_limited and remaining is None:
+            return
+        now = time.time()
+        blocked_until = 0
+        if rate_limited:
+            blocked_until = reset if reset and reset > now else now + RATE_LIMITED_BACKOFF
+        elif remaining <= SERVER_RESERVE and reset and reset > now:
+            blocked_until = reset
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            tokens, _ = self._load(conn, name, now)
+            if remaining is not None:
+                tokens = min(tokens, max(remaining - SERVER_RESERVE, 0))
+            conn.execute("""UPDATE buckets SET tokens = ?, updated = ?, blocked_until = MAX(blocked_until, ?),
+                server_limit = COALESCE(?, server_limit), server_remaining = COALESCE(?, server_remaining),
+                server_reset = COALESCE(?, server_reset), rate_limited = rate_limited + ? WHERE name = ?""",
+                (tokens, now, blocked_until, limit, remaining, reset, 1 if rate_limited else 0, name))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        if blocked_until and VERBOSE_PRINTING:
+            print(f"Rate limit for {name} calls nearly used up, pausing them for {blocked_until - now:.0f}s.")
+
+    def usage(self):
+        conn = self._connect()
+        rows = conn.execute("""SELECT name, tokens, updated, blocked_until, server_limit, server_remaining, server_reset,
+            calls, waited, rate_limited, since FROM buckets ORDER BY name""").fetchall()
+        now = time.time()
+        report = {}
+        for name, tokens, updated, blocked_until, server_limit, server_remaining, server_reset, calls, waited, rate_limited, since in rows:
+            capacity, rate = self.buckets.get(name, self.buckets['default'])
+            report[name] = {
+                'tokens': min(capacity, tokens + max(now - updated, 0) * rate),
+                'capacity': capacity,
+                'blocked_for': max(blocked_until - now, 0),
+                'server_limit': server_limit,
+                'server_remaining': server_remaining if server_reset is None or server_reset > now else None,
+                'calls': calls,
+                'waited': waited,
+                'rate_limited': rate_limited,
+                'since': since,
+            }
+        return report
+
+def _int_header(headers, name):
+    try:
+        return int(headers.get(name))
+    except (TypeError, ValueError):
+        return None
+
+store = BucketStore()
+
+_thread_calls = threading.local()
+
+# XRPC calls sent from the calling thread so far, for callers that account for what a piece of work cost
+# (the follow sweep's call budget).
+def calls_on_this_thread():
+    return getattr(_thread_calls, 'count', 0)
+
+def _count_call():
+    _thread_calls.count = calls_on_this_thread() + 1
+
+def _response_headers(e):
+    if isinstance(e, atproto_client.exceptions.RequestErrorBase) and e.response is not None:
+        return e.response.headers or {}
+    return {}
+
+class RateLimitedRequest(Request):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._pid = os.getpid()
+
+    def _send_request(self, method, url, **kwargs):
+        # connections inherited from the parent process (the firehose forks workers after logging in) would
+        # be shared with it and the other workers, mixing up their responses; each process opens its own
+        if self._pid != os.getpid():
+            self._client = httpx.Client(follow_redirects=True, **self._client_kwargs)
+            self._pid = os.getpid()
+        name = endpoint_class(url)
+        waited = 0
+        while (wait := store.try_acquire(name)) > 0:
+            wait = min(wait, MAX_WAIT - waited)
+            if wait <= 0:
+                break
+            time.sleep(wait)
+            waited += wait
+        if waited:
+            store.record_wait(name, waited)
+        _count_call()
+        try:
+            response = super()._send_request(method, url, **kwargs)
+        except atproto_client.exceptions.RateLimitExceededError as e:
+            store.observe(name, _response_headers(e), rate_limited=True)
+            raise
+        except atproto_client.exceptions.RequestErrorBase as e:
+            store.observe(name, _response_headers(e))
+            raise
+        store.observe(name, response.headers)
+        return response
+
+# Same limiter for AsyncClient (the jetstream service). The store calls are SQLite write transactions that
+# can wait up to 30s for another process holding the database, so they run on threads, like the outbox
+# writes; the waiting for tokens is done with asyncio.sleep.
+class RateLimitedAsyncRequest(AsyncRequest):
+    async def _send_request(self, method, url, **kwargs):
+        name = endpoint_class(url)
+        waited = 0
+        while (wait := await asyncio.to_thread(store.try_acquire, name)) > 0:
+            wait = min(wait, MAX_WAIT - waited)
+            if wait <= 0:
+                break
+            await asyncio.sleep(wait)
+            waited += wait
+        if waited:
+            await asyncio.to_thread(store.record_wait, name, waited)
+        _count_call()
+        try:
+            response = await super()._send_request(method, url, **kwargs)
+        except atproto_client.exceptions.RateLimitExceededError as e:
+            await asyncio.to_thread(store.observe, name, _response_headers(e), rate_limited=True)
+            raise
+        except atproto_client.exceptions.RequestErrorBase as e:
+            await asyncio.to_thread(store.observe, name, _response_headers(e))
+            raise
+        await asyncio.to_thread(store.observe, name, response.headers)
+        return response
+
+# One line per endpoint class, for logs and the !ratelimits maintainer command.
+def usage_report():
+    lines = []
+    for name, entry in store.usage().items():
+        line = f"{name}: {entry['calls']} calls, {entry['tokens']:.0f}/{entry['capacity']} tokens left"
+        if entry['server_remaining'] is not None:
+            line += f", server allows {entry['server_remaining']}/{entry['server_limit']} more"
+        if entry['waited']:
+            line += f", waited {entry['waited']:.0f}s"
+        if entry['rate_limited']:
+            line += f", {entry['rate_limited']} rate limited"
+        if entry['blocked_for']:
+            line += f", paused for {entry['blocked_for']:.0f}s"
+        lines.append(line)
+    return "\n".join(lines) if lines else "No API calls recorded yet."
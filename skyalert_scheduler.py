@@ -0,0 +1,118 @@
+import heapq
+import random
+import threading
+import time
+import traceback
+from dataclasses import dataclass, field
+
+# Timed task scheduler for the command services, replacing the sleep(1) polling loop. Tasks sit in a heap
+# ordered by their next run time and the loop sleeps until the earliest one is due. Foreground tasks run
+# on the scheduler thread; background tasks (the hourly jobs) get their own thread so command intake keeps
+# running while they work.
+
+VERBOSE_PRINTING = False
+
+MISSED_SKIP = "skip" # a run that is late by more than one interval is dropped, the schedule moves on
+MISSED_CATCH_UP = "catch_up" # late runs collapse into a single run as soon as possible
+
+@dataclass
+class Task:
+    name: str
+    func: callable
+    interval: float
+    jitter: float = 0.0
+    background: bool = False
+    missed: str = MISSED_SKIP
+    budget: float = None # seconds a run is expected to take; longer runs are reported
+    next_run: float = 0.0
+    planned_run: float = 0.0 # next_run without the jitter; the grid the following runs are planned on
+    thread: threading.Thread = field(default=None, repr=False)
+    runs: int = 0
+    overruns: int = 0
+    skipped: int = 0
+
+class Scheduler:
+    def __init__(self):
+        self.heap = []
+        self.counter = 0
+        self.wakeup = threading.Event()
+        self.stopped = False
+
+    def add(self, name, func, interval, jitter=0.0, background=False, missed=MISSED_SKIP, budget=None, delay=0.0):
+        task = Task(name, func, interval, jitter, background, missed, budget)
+        self._push(task, time.monotonic() + delay)
+        return task
+
+    def _push(self, task, run_at, jitter=0.0):
+        task.planned_run = run_at
+        run_at += jitter
+        task.next_run = run_at
+        self.counter += 1
+        heapq.heappush(self.heap, (run_at, self.counter, task))
+        self.wakeup.set()
+
+    # Runs are planned on a fixed grid from the previous planned time, so run time doesn't make the
+    # schedule drift; jitter is added to each run on its own and never carried over to the next. A task
+    # function may return a number to choose its next delay itself.
+    def _reschedule(self, task, result, now):
+        if isinstance(result, (int, float)) and not isinstance(result, bool):
+            self._push(task, now + result)
+            return
+        next_run = task.planned_run + task.interval
+        if next_run < now:
+            missed_runs = int((now - next_run) // task.interval) + 1
+            if task.missed == MISSED_CATCH_UP:
+                next_run = now
+            else:
+                task.skipped += missed_runs
+                next_run += missed_runs * task.interval
+                if VERBOSE_PRINTING: print(f"Task {task.name} missed {missed_runs} runs, skipping ahead.")
+        self._push(task, next_run, random.uniform(0, task.jitter) if task.jitter else 0.0)
+
+    def _run(self, task):
+        started = time.monotonic()
+        try:
+            return task.func()
+        finally:
+            duration = time.monotonic() - started
+            task.runs += 1
+            if task.budget is not None and duration > task.budget:
+                task.overruns += 1
+                print(f"Task {task.name} took {duration:.0f}s, over its {task.budget:.0f}s budget.")
+
+    def _run_background(self, task):
+        try:
+            self._run(task)
+        except Exception:
+            print(f"Task {task.name} failed:")
+            traceback.print_exc()
+
+    def run_pending(self):
+        now = time.monotonic()
+        while self.heap and self.heap[0][0] <= now:
+            _, _, task = heapq.heappop(self.heap)
+            if task.background:
+                if task.thread is not None and task.thread.is_alive():
+                    # the previous run is still going; don't stack another one behind it
+                    task.skipped += 1
+                    if VERBOSE_PRINTING: print(f"Task {task.name} is still running, skipping this run.")
+                else:
+                    task.thread = threading.Thread(target=self._run_background, args=(task,), name=task.name, daemon=True)
+                    task.thread.start()
+                self._reschedule(task, None, now)
+            else:
+                result = self._run(task)
+                now = time.monotonic()
+                self._reschedule(task, result, now)
+
+    def run_forever(self):
+        while not self.stopped:
+            self.run_pending()
+            if not self.heap:
+                break
+            self.wakeup.clear()
+            self.wakeup.wait(max(self.heap[0][0] - time.monotonic(), 0))
+
+    def stop(self):
+        self.stopped = True
+        self.wakeup.set()
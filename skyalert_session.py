@@ -0,0 +1,249 @@
+import os
+import time
+import fcntl
+import asyncio
+import threading
+from contextlib import contextmanager, asynccontextmanager
+
+import yaml
+from urllib.parse import urlparse
+from atproto import Client, AsyncClient, Session, SessionEvent
+import atproto_client.exceptions
+
+import skyalert_endpoints
+
+# One login shared by every SkyAlert service. The current session lives in data/cache/session.txt,
+# guarded by an flock, and every process takes its tokens from there instead of logging in on its own.
+# Refreshes go through the same lock: a process whose token is due first looks at the stored session,
+# and only refreshes itself if no other process already did. Since refresh tokens rotate, this keeps the
+# services from invalidating each other's tokens and falling back to createSession, which is heavily
+# rate limited. Password logins only happen when the stored session can't be used at all.
+#
+# Use SharedSessionClient / SharedSessionAsyncClient in place of Client / AsyncClient and log in with
+# login(client) / await login_async(client). The clients call the service in skyalert_endpoints; a session
+# for anything but the live network is stored in its own file, so it never gets sent to the other.
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+CACHE_DIR = os.path.join(DATA_DIR, 'cache')
+LOGIN_INFO_FILE = os.path.join(DATA_DIR, 'login-info.yaml')
+if skyalert_endpoints.is_live():
+    SESSION_FILE = os.path.join(CACHE_DIR, 'session.txt')
+else:
+    SESSION_FILE = os.path.join(CACHE_DIR, f"session-{urlparse(skyalert_endpoints.SERVICE_URL).netloc.replace(':', '-')}.txt")
+LOCK_FILE = os.path.join(CACHE_DIR, 'session.lock')
+VERBOSE_PRINTING = False
+
+REFRESH_MARGIN = 15 * 60 # same margin atproto uses before refreshing on its own
+
+_thread_lock = threading.RLock()
+_local = threading.local()
+_task_lock = None # asyncio.Lock, made on first use so it belongs to the running loop
+_task_owner = None
+_task_depth = 0
+
+def _lock_file():
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    lock_file = open(LOCK_FILE, 'a')
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    return lock_file
+
+def _unlock_file(lock_file):
+    fcntl.flock(lock_file, fcntl.LOCK_UN)
+    lock_file.close()
+
+# Exclusive across processes and threads; re-entrant within a thread, since a refresh can happen while
+# login() holds the lock (login fetches the bot's profile, which checks the session first).
+@contextmanager
+def _locked():
+    with _thread_lock:
+        depth = getattr(_local, 'depth', 0)
+        if depth == 0:
+            _local.lock_file = _lock_file()
+        _local.depth = depth + 1
+        try:
+            yield
+        finally:
+            _local.depth = depth
+            if depth == 0:
+                _unlock_file(_local.lock_file)
+
+# The same lock for coroutines: exclusive across processes and tasks, re-entrant within a task. Waiting
+# for the flock happens on a thread, so the event loop keeps running while another service refreshes.
+@asynccontextmanager
+async def _locked_async():
+    global _task_lock, _task_owner, _task_depth
+    task = asyncio.current_task()
+    if _task_owner is task:
+        _task_depth += 1
+        try:
+            yield
+        finally:
+            _task_depth -= 1
+        return
+    if _task_lock is None:
+        _task_lock = asyncio.Lock()
+    async with _task_lock:
+        acquiring = asyncio.ensure_future(asyncio.to_thread(_lock_file))
+        try:
+            lock_file = await asyncio.shield(acquiring)
+        except asyncio.CancelledError:
+            # the thread still gets the flock; give it back as soon as it does
+            acquiring.add_done_callback(lambda done: done.cancelled() or done.exception() or _unlock_file(done.result()))
+            raise
+        _task_owner, _task_depth = task, 1
+        try:
+            yield
+        finally:
+            _task_owner, _task_depth = None, 0
+            _unlock_file(lock_file)
+
+def _read_stored():
+    if os.path.exists(SESSION_FILE):
+        with open(SESSION_FILE, 'r') as f:
+            session_string = f.read().strip()
+        if session_string:
+            return session_string
+    if not skyalert_endpoints.is_live():
+        return None
+    # sessions used to be kept in login-info.yaml
+    login_info = get_login_info()
+    return login_info.get('session-key-firehose') or None
+
+def _write_stored(session_string):
+    temp_path = SESSION_FILE + '.tmp'
+    with open(temp_path, 'w') as f:
+        f.write(session_string)
+    os.replace(temp_path, SESSION_FILE)
+
+def get_login_info():
+    with open(LOGIN_INFO_FILE, 'r') as f:
+        return yaml.safe_load(f) or {}
+
+def _expires_in(jwt_payload):
+    if jwt_payload is None or not jwt_payload.exp:
+        return 0
+    return jwt_payload.exp - time.time()
+
+def _decode(session_string):
+    try:
+        return Session.decode(session_string)
+    except Exception:
+        return None
+
+# The stored session if another process refreshed it since this one last looked, else None.
+def _newer_stored(current):
+    session_string = _read_stored()
+    stored = _decode(session_string) if session_string else None
+    if stored is None or _expires_in(stored.access_jwt_payload) <= REFRESH_MARGIN:
+        return None
+    if current is not None and stored.access_jwt == current.access_jwt:
+        return None
+    return stored
+
+class SharedSessionClient(Client):
+    def __init__(self, base_url=None, request=None):
+        super().__init__(base_url or skyalert_endpoints.SERVICE_URL, request)
+        self._chat_client = None
+        self._chat_lock = threading.Lock()
+
+    # with_bsky_chat_proxy() clones the client, and each clone opens its own connection pool; the clone
+    # is made once and reused. It keeps up with the shared session like any other client.
+    def with_bsky_chat_proxy(self):
+        with self._chat_lock:
+            if self._chat_client is None:
+                self._chat_client = super().with_bsky_chat_proxy()
+            return self._chat_client
+
+    def _set_session(self, event, session):
+        super()._set_session(event, session)
+        if event in (SessionEvent.CREATE, SessionEvent.REFRESH):
+            with _locked():
+                _write_stored(self.export_session_string())
+
+    def _refresh_and_set_session(self):
+        with _locked():
+            stored = _newer_stored(self._session)
+            if stored is not None:
+                if VERBOSE_PRINTING: print("Using the session refreshed by another service.")
+                self._set_session(SessionEvent.IMPORT, stored)
+                return stored
+            if VERBOSE_PRINTING: print("Refreshing the shared session...")
+            try:
+                return super()._refresh_and_set_session()
+            except (atproto_client.exceptions.UnauthorizedError, atproto_client.exceptions.BadRequestError) as e:
+                # the refresh token expired or was revoked; nothing left to do but log in again
+                if VERBOSE_PRINTING: print(f"Session refresh failed ({e}), logging in with password...")
+                login_info = get_login_info()
+                return self._get_and_set_session(login_info['username'], login_info['password'])
+
+class SharedSessionAsyncClient(AsyncClient):
+    def __init__(self, base_url=None, request=None):
+        super().__init__(base_url or skyalert_endpoints.SERVICE_URL, request)
+        self._chat_client = None
+        self._chat_lock = threading.Lock()
+
+    # with_bsky_chat_proxy() clones the client, and each clone opens its own connection pool; the clone
+    # is made once and reused. It keeps up with the shared session like any other client.
+    def with_bsky_chat_proxy(self):
+        with self._chat_lock:
+            if self._chat_client is None:
+                self._chat_client = super().with_bsky_chat_proxy()
+            return self._chat_client
+
+    async def _set_session(self, event, session):
+        await super()._set_session(event, session)
+        if event in (SessionEvent.CREATE, SessionEvent.REFRESH):
+            async with _locked_async():
+                _write_stored(self.export_session_string())
+
+    async def _refresh_and_set_session(self):
+        async with _locked_async():
+            stored = _newer_stored(self._session)
+            if stored is not None:
+                if VERBOSE_PRINTING: print("Using the session refreshed by another service.")
+                await self._set_session(SessionEvent.IMPORT, stored)
+                return stored
+            if VERBOSE_PRINTING: print("Refreshing the shared session...")
+            try:
+                return await super()._refresh_and_set_session()
+            except (atproto_client.exceptions.UnauthorizedError, atproto_client.exceptions.BadRequestError) as e:
+                if VERBOSE_PRINTING: print(f"Session refresh failed ({e}), logging in with password...")
+                login_info = get_login_info()
+                return await self._get_and_set_session(login_info['username'], login_info['password'])
+
+# Starts the client from the stored session; logs in with the password only if there is none, or its
+# refresh token no longer works.
+def login(client):
+    with _locked():
+        session_string = _read_stored()
+        stored = _decode(session_string) if session_string else None
+        if stored is not None and _expires_in(stored.refresh_jwt_payload) > 0:
+            try:
+                return client.login(session_string=session_string)
+            except (atproto_client.exceptions.UnauthorizedError, atproto_client.exceptions.BadRequestError) as e:
+                if VERBOSE_PRINTING: print(f"Stored session was rejected ({e}), logging in again.")
+        login_info = get_login_info()
+        if VERBOSE_PRINTING: print("Logging in with password...")
+        return client.login(login=login_info['username'], password=login_info['password'])
+
+async def login_async(client):
+    async with _locked_async():
+        session_string = _read_stored()
+        stored = _decode(session_string) if session_string else None
+        if stored is not None and _expires_in(stored.refresh_jwt_payload) > 0:
+            try:
+                return await client.login(session_string=session_string)
+            except (atproto_client.exceptions.UnauthorizedError, atproto_client.exceptions.BadRequestError) as e:
+                if VERBOSE_PRINTING: print(f"Stored session was rejected ({e}), logging in again.")
+        login_info = get_login_info()
+        if VERBOSE_PRINTING: print("Logging in with password...")
+        return await client.login(login=login_info['username'], password=login_info['password'])
+
+# Refreshes ahead of time, so a refresh never lands in the middle of handling a request. Meant to run on
+# a timer; cheap when nothing is due.
+def keep_fresh(client):
+    session = client._session
+    if session is None or _expires_in(session.access_jwt_payload) > REFRESH_MARGIN:
+        return
+    with client._refresh_lock:
+        client._refresh_and_set_session()
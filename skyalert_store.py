@@ -0,0 +1,303 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+import yaml
+
+# SQLite storage for watches, per-user settings and the command ledger, replacing data/config.yaml. The
+# database runs in WAL mode, so the firehose workers keep reading while the command service writes, and
+# every change is a single-row transaction instead of a rewrite of the whole config. Watches are indexed
+# by subject (the firehose lookup) and by receiver (the command lookups), settings by DID.
+#
+# Rows come back as dicts with the same keys config.yaml used ('subject-did', 'receiver-handle', ...).
+# Every write transaction that changes something bumps a generation number; the event readers use it
+# through snapshot() to keep a compiled in-memory view of the watches until the data actually changes.
+# An existing config.yaml is imported once, the first time the store is opened, and renamed to
+# config.yaml.migrated.
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+STORE_FILE = os.path.join(DATA_DIR, 'skyalert.db')
+CONFIG_FILE = os.path.join(DATA_DIR, 'config.yaml')
+VERBOSE_PRINTING = False
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_watches (
+    receiver_did TEXT NOT NULL,
+    subject_did TEXT NOT NULL,
+    receiver_handle TEXT,
+    subject_handle TEXT,
+    reposts_allowed INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (receiver_did, subject_did)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS user_watches_subject ON user_watches (subject_did);
+CREATE TABLE IF NOT EXISTS follow_watches (
+    did TEXT PRIMARY KEY,
+    handle TEXT
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS repost_defaults (
+    did TEXT PRIMARY KEY,
+    reposts_allowed INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS reply_settings (
+    did TEXT PRIMARY KEY,
+    replies_allowed INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS processed_messages (
+    convo_id TEXT PRIMARY KEY,
+    message_id TEXT NOT NULL,
+    rev TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+) WITHOUT ROWID;
+INSERT OR IGNORE INTO meta (key, value) VALUES ('generation', 0);
+"""
+
+_local = threading.local()
+_migrated_pid = None # the YAML import is checked once per process, not on every thread's connection
+_migrate_lock = threading.Lock()
+
+def _connect():
+    conn = getattr(_local, 'conn', None)
+    # a connection inherited from the parent process (the firehose forks workers) can't be reused
+    if conn is None or _local.pid != os.getpid():
+        os.makedirs(os.path.dirname(STORE_FILE), exist_ok=True)
+        conn = sqlite3.connect(STORE_FILE, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(SCHEMA)
+        _local.conn = conn
+        _local.pid = os.getpid()
+        _local.snapshot = None
+        _migrate_once(conn)
+    return conn
+
+def _migrate_once(conn):
+    global _migrated_pid
+    with _migrate_lock:
+        if _migrated_pid != os.getpid():
+            migrate_from_yaml(conn)
+            _migrated_pid = os.getpid()
+
+# Groups several statements into one write transaction. Nested uses join the outer transaction.
+@contextmanager
+def transaction():
+    conn = _connect()
+    if conn.in_transaction:
+        yield conn
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    changes = conn.total_changes
+    try:
+        yield conn
+        if conn.total_changes != changes:
+            _bump_generation(conn)
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+def _bump_generation(conn):
+    conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'generation'")
+    # commits on this connection don't move its own PRAGMA data_version, so drop its snapshot directly
+    _local.snapshot = None
+
+def get_generation():
+    return int(_connect().execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()[0])
+
+def _watch(row):
+    receiver_did, subject_did, receiver_handle, subject_handle, reposts_allowed = row
+    return {'subject-handle': subject_handle, 'receiver-handle': receiver_handle, 'reposts-allowed': bool(reposts_allowed), 'subject-did': subject_did, 'receiver-did': receiver_did}
+
+WATCH_COLUMNS = "receiver_did, subject_did, receiver_handle, subject_handle, reposts_allowed"
+
+def migrate_from_yaml(conn=None, path=None):
+    conn = conn or _connect()
+    path = path or CONFIG_FILE
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        migrated = conn.execute("SELECT value FROM meta WHERE key = 'migrated-from-yaml'").fetchone()
+        if migrated is not None or not os.path.exists(path):
+            conn.execute("COMMIT")
+            return False
+        with open(path, 'r') as f:
+            config = yaml.safe_load(f) or {}
+        for watch in config.get('user_watches') or []:
+            if not watch.get('receiver-did') or not watch.get('subject-did'):
+                continue
+            conn.execute(f"INSERT OR REPLACE INTO user_watches ({WATCH_COLUMNS}) VALUES (?, ?, ?, ?, ?)",
+                (watch['receiver-did'], watch['subject-did'], watch.get('receiver-handle'), watch.get('subject-handle'), bool(watch.get('reposts-allowed'))))
+        for watch in config.get('follow_watches') or []:
+            if watch.get('did'):
+                conn.execute("INSERT OR REPLACE INTO follow_watches (did, handle) VALUES (?, ?)", (watch['did'], watch.get('handle')))
+        for entry in config.get('repost_defaults') or []:
+            conn.execute("INSERT OR REPLACE INTO repost_defaults (did, reposts_allowed) VALUES (?, ?)", (entry['did'], bool(entry['reposts-allowed'])))
+        for entry in config.get('reply_settings') or []:
+            conn.execute("INSERT OR REPLACE INTO reply_settings (did, replies_allowed) VALUES (?, ?)", (entry['did'], bool(entry['replies-allowed'])))
+        conn.execute("INSERT INTO meta (key, value) VALUES ('migrated-from-yaml', ?)", (path,))
+        _bump_generation(conn)
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    os.replace(path, path + '.migrated')
+    if VERBOSE_PRINTING: print(f"Imported {path} into {STORE_FILE}.")
+    return True
+
+# user watches
+
+def watches_for_subject(subject_did):
+    rows = _connect().execute(f"SELECT {WATCH_COLUMNS} FROM user_watches WHERE subject_did = ?", (subject_did,))
+    return [_watch(row) for row in rows]
+
+def watches_for_receiver(receiver_did):
+    rows = _connect().execute(f"SELECT {WATCH_COLUMNS} FROM user_watches WHERE receiver_did = ?", (receiver_did,))
+    return [_watch(row) for row in rows]
+
+def iter_user_watches():
+    for row in _connect().execute(f"SELECT {WATCH_COLUMNS} FROM user_watches"):
+        yield _watch(row)
+
+# Adds a watch, or updates it if the receiver already watches this subject.
+def add_user_watch(watch):
+    with transaction() as conn:
+        conn.execute(f"INSERT OR REPLACE INTO user_watches ({WATCH_COLUMNS}) VALUES (?, ?, ?, ?, ?)",
+            (watch['receiver-did'], watch['subject-did'], watch.get('receiver-handle'), watch.get('subject-handle'), bool(watch.get('reposts-allowed'))))
+
+def remove_user_watch(receiver_did, subject_did):
+    with transaction() as conn:
+        return conn.execute("DELETE FROM user_watches WHERE receiver_did = ? AND subject_did = ?", (receiver_did, subject_did)).rowcount > 0
+
+def remove_watches_for_subject(subject_did):
+    with transaction() as conn:
+        return conn.execute("DELETE FROM user_watches WHERE subject_did = ?", (subject_did,)).rowcount
+
+def remove_watches_for_receiver(receiver_did):
+    with transaction() as conn:
+        return conn.execute("DELETE FROM user_watches WHERE receiver_did = ?", (receiver_did,)).rowcount
+
+# Watches saved without a subject or receiver DID by older versions.
+def remove_incomplete_watches():
+    with transaction() as conn:
+        return conn.execute("DELETE FROM user_watches WHERE receiver_did = '' OR subject_did = ''").rowcount
+
+# Updates the stored handle of an account everywhere it appears.
+def update_handle(did, handle):
+    with transaction() as conn:
+        conn.execute("UPDATE user_watches SET subject_handle = ? WHERE subject_did = ?", (handle, did))
+        conn.execute("UPDATE user_watches SET receiver_handle = ? WHERE receiver_did = ?", (handle, did))
+        conn.execute("UPDATE follow_watches SET handle = ? WHERE did = ?", (handle, did))
+
+# follow watches
+
+def get_follow_watches():
+    return [{'did': did, 'handle': handle} for did, handle in _connect().execute("SELECT did, handle FROM follow_watches")]
+
+def has_follow_watch(did):
+    return _connect().execute("SELECT 1 FROM follow_watches WHERE did = ?", (did,)).fetchone() is not None
+
+# Returns False if the watch already existed.
+def add_follow_watch(did, handle):
+    with transaction() as conn:
+        return conn.execute("INSERT OR IGNORE INTO follow_watches (did, handle) VALUES (?, ?)", (did, handle)).rowcount > 0
+
+def remove_follow_watch(did):
+    with transaction() as conn:
+        return conn.execute("DELETE FROM follow_watches WHERE did = ?", (did,)).rowcount > 0
+
+# settings; None means the user never chose
+
+def get_repost_default(did):
+    row = _connect().execute("SELECT reposts_allowed FROM repost_defaults WHERE did = ?", (did,)).fetchone()
+    return bool(row[0]) if row is not None else None
+
+def set_repost_default(did, reposts_allowed):
+    with transaction() as conn:
+        conn.execute("INSERT OR REPLACE INTO repost_defaults (did, reposts_allowed) VALUES (?, ?)", (did, bool(reposts_allowed)))
+
+def get_reply_setting(did):
+    row = _connect().execute("SELECT replies_allowed FROM reply_settings WHERE did = ?", (did,)).fetchone()
+    return bool(row[0]) if row is not None else None
+
+def iter_reply_settings():
+    for did, replies_allowed in _connect().execute("SELECT did, replies_allowed FROM reply_settings"):
+        yield did, bool(replies_allowed)
+
+def set_reply_setting(did, replies_allowed):
+    with transaction() as conn:
+        conn.execute("INSERT OR REPLACE INTO reply_settings (did, replies_allowed) VALUES (?, ?)", (did, bool(replies_allowed)))
+
+# Removes everything stored for a user (the !reset command).
+def delete_user(did):
+    with transaction() as conn:
+        conn.execute("DELETE FROM user_watches WHERE receiver_did = ?", (did,))
+        conn.execute("DELETE FROM follow_watches WHERE did = ?", (did,))
+        conn.execute("DELETE FROM repost_defaults WHERE did = ?", (did,))
+        conn.execute("DELETE FROM reply_settings WHERE did = ?", (did,))
+
+# the command services' ledger of handled DMs (see skyalert_chatlog). These single-row writes skip
+# transaction(): they don't change any watch, so the generation and the readers' snapshots stay as they are.
+
+def get_processed_messages():
+    return {convo_id: {'id': message_id, 'rev': rev} for convo_id, message_id, rev in _connect().execute("SELECT convo_id, message_id, rev FROM processed_messages")}
+
+def mark_message_processed(convo_id, message_id, rev):
+    _connect().execute("INSERT OR REPLACE INTO processed_messages (convo_id, message_id, rev) VALUES (?, ?, ?)", (convo_id, message_id, rev))
+
+# Forgets convos whose last handled message the saved log cursor has passed.
+def prune_processed_messages(through_rev):
+    return _connect().execute("DELETE FROM processed_messages WHERE rev <= ?", (through_rev,)).rowcount
+
+# Read-only view of the store for the event handlers, compiled from one consistent read. It holds the
+# set of watched subjects, so the common case (an event from an account nobody watches) is a set lookup;
+# the watch lists of subjects that do post are loaded on first use and kept for the snapshot's lifetime.
+# They are only loaded while the store is still at the snapshot's generation; after a change, the lookup
+# is answered by the current snapshot instead, so one answer never mixes two generations.
+class Snapshot:
+    def __init__(self, conn):
+        conn.execute("BEGIN")
+        try:
+            self.generation = int(conn.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()[0])
+            self.subjects = frozenset(row[0] for row in conn.execute("SELECT DISTINCT subject_did FROM user_watches"))
+            self.reply_settings = {did: bool(allowed) for did, allowed in conn.execute("SELECT did, replies_allowed FROM reply_settings")}
+        finally:
+            conn.execute("COMMIT")
+        self.watches = {}
+        self.data_version = None
+
+    def watches_for_subject(self, subject_did):
+        if subject_did not in self.subjects:
+            return []
+        watches = self.watches.get(subject_did)
+        if watches is None:
+            conn = _connect()
+            conn.execute("BEGIN")
+            try:
+                generation = int(conn.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()[0])
+                rows = conn.execute(f"SELECT {WATCH_COLUMNS} FROM user_watches WHERE subject_did = ?", (subject_did,)).fetchall() if generation == self.generation else None
+            finally:
+                conn.execute("COMMIT")
+            if rows is None:
+                return snapshot().watches_for_subject(subject_did)
+            watches = self.watches[subject_did] = [_watch(row) for row in rows]
+        return watches
+
+    def get_reply_setting(self, did):
+        return self.reply_settings.get(did)
+
+# Returns the current snapshot, rebuilding it only when the generation changed. PRAGMA data_version only
+# changes when another connection committed, so the usual check touches no table at all.
+def snapshot():
+    conn = _connect()
+    current = _local.snapshot
+    data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+    if current is not None and current.data_version == data_version:
+        return current
+    if current is None or current.generation != get_generation():
+        current = Snapshot(conn)
+        if VERBOSE_PRINTING: print(f"Loaded store generation {current.generation} ({len(current.subjects)} watched subjects).")
+    current.data_version = data_version
+    _local.snapshot = current
+    return current
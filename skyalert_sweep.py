@@ -0,0 +1,179 @@
+import os
+import json
+import math
+import time
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import skyalert_followers
+import skyalert_ratelimit
+
+# Scheduling for the follow-watch sweep. Every user gets their own check interval: big accounts whose
+# followers rarely change are checked less often, accounts that keep losing followers more often. Due users
+# are checked on a small thread pool, and a global hourly budget caps how many API calls sweeps may spend.
+# The budget lives in ratelimits.db next to the rate limit buckets, so a restart or another command
+# process doesn't start it over, and it is charged with the calls the checks actually made.
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+CACHE_DIR = os.path.join(DATA_DIR, 'cache')
+SCHEDULE_FILE = os.path.join(CACHE_DIR, 'follow-schedule.json')
+VERBOSE_PRINTING = False
+
+SWEEP_WORKERS = 8
+MIN_INTERVAL = 15 * 60
+BASE_INTERVAL = 3600
+MAX_INTERVAL = 6 * 3600
+API_CALLS_PER_HOUR = 3000
+
+def get_schedule():
+    if not os.path.exists(SCHEDULE_FILE):
+        return {}
+    with open(SCHEDULE_FILE, 'r') as f:
+        return json.load(f)
+
+def save_schedule(schedule):
+    temp_path = SCHEDULE_FILE + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(schedule, f)
+    os.replace(temp_path, SCHEDULE_FILE)
+
+# Longest interval a user may drift to: 1h up to 1k followers, one more hour per 10x followers after that.
+def max_interval_for(followers_count):
+    followers_count = max(followers_count or 0, 1000)
+    return min(BASE_INTERVAL * (1 + math.log10(followers_count / 1000)), MAX_INTERVAL)
+
+def next_interval(entry, followers_count, changed):
+    interval = entry.get('interval', BASE_INTERVAL)
+    if changed:
+        return max(interval / 2, MIN_INTERVAL)
+    return min(interval * 1.5, max_interval_for(followers_count))
+
+# API calls a check is expected to make, reserved from the hourly budget until the check is done: every
+# page of the follower list for a full fetch (no snapshot yet, or the periodic reconciliation), a page or
+# two for the new-follower check. followers_count is the profile's, read before the check; without it the
+# count from the last check is used.
+def estimated_calls(did, entry, followers_count=None):
+    if followers_count is None:
+        followers_count = entry.get('followers_count', 0)
+    pages = max(1, math.ceil(followers_count / skyalert_followers.FOLLOWERS_PAGE_SIZE))
+    if skyalert_followers.snapshot_count(did) is None or skyalert_followers.is_full_sync_due(did):
+        return pages
+    return min(pages, 2)
+
+class CallBudget:
+    def __init__(self, calls_per_hour=API_CALLS_PER_HOUR, path=None):
+        self.calls_per_hour = calls_per_hour
+        self.path = path or skyalert_ratelimit.STORE_FILE
+        self.local = threading.local()
+
+    def _connect(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS sweep_calls (id INTEGER PRIMARY KEY, spent_at REAL NOT NULL, calls INTEGER NOT NULL)")
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def used(self):
+        return self._connect().execute("SELECT COALESCE(SUM(calls), 0) FROM sweep_calls WHERE spent_at >= ?", (time.time() - 3600,)).fetchone()[0]
+
+    # Reserves calls if they fit in the last hour's budget. Returns the reservation, to settle() with the
+    # calls actually made, or None.
+    def try_spend(self, calls):
+        conn = self._connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM sweep_calls WHERE spent_at < ?", (now - 3600,))
+            used, entries = conn.execute("SELECT COALESCE(SUM(calls), 0), COUNT(*) FROM sweep_calls").fetchone()
+            # a single check bigger than the whole budget still runs once the window is empty
+            if entries and used + calls > self.calls_per_hour:
+                conn.execute("COMMIT")
+                return None
+            reservation = conn.execute("INSERT INTO sweep_calls (spent_at, calls) VALUES (?, ?)", (now, calls)).lastrowid
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return reservation
+
+    def settle(self, reservation, calls):
+        self._connect().execute("UPDATE sweep_calls SET calls = ? WHERE id = ?", (calls, reservation))
+
+    # Records calls that were made without a reservation.
+    def charge(self, calls):
+        if calls:
+            self._connect().execute("INSERT INTO sweep_calls (spent_at, calls) VALUES (?, ?)", (time.time(), calls))
+
+budget = CallBudget()
+
+def due_users(follow_watches, schedule, now=None):
+    now = now or time.time()
+    due = [user for user in follow_watches if schedule.get(user['did'], {}).get('next_check', 0) <= now]
+    due.sort(key=lambda user: schedule.get(user['did'], {}).get('next_check', 0))
+    return due
+
+# Runs check_user(user) and charges the budget with the API calls it made on this thread, in place of the
+# estimate reserved for it.
+def _checked(check_user, user, reservation):
+    calls_before = skyalert_ratelimit.calls_on_this_thread()
+    try:
+        return check_user(user)
+    finally:
+        budget.settle(reservation, skyalert_ratelimit.calls_on_this_thread() - calls_before)
+
+# Checks every due user with check_user(user), which returns (followers_count, changed) or None if the
+# user was dropped. Users that don't fit in the hourly budget stay due and are picked up next sweep.
+# prepare(users), if given, is called with the due users first (e.g. to batch profile reads), and
+# followers_count(user), if given, then tells how big each one's follower list is for the estimate.
+def run_sweep(follow_watches, check_user, prepare=None, followers_count=None, max_workers=SWEEP_WORKERS):
+    schedule = get_schedule()
+    users = due_users(follow_watches, schedule)
+    if VERBOSE_PRINTING: print(f"{len(users)} of {len(follow_watches)} follow watches are due.")
+
+    if prepare is not None and users and budget.used() < budget.calls_per_hour:
+        calls_before = skyalert_ratelimit.calls_on_this_thread()
+        prepare(users)
+        budget.charge(skyalert_ratelimit.calls_on_this_thread() - calls_before)
+
+    scheduled = []
+    for user in users:
+        count = followers_count(user) if followers_count is not None else None
+        reservation = budget.try_spend(estimated_calls(user['did'], schedule.get(user['did'], {}), count))
+        if reservation is None:
+            if VERBOSE_PRINTING: print(f"API budget used up, deferring {len(users) - len(scheduled)} follow watches.")
+            break
+        scheduled.append((user, reservation))
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {user['did']: executor.submit(_checked, check_user, user, reservation) for user, reservation in scheduled}
+    errors = []
+    for did, future in futures.items():
+        if future.exception() is not None:
+            print(f"Follow watch check for {did} failed: {future.exception()}")
+            errors.append(future.exception())
+        else:
+            results[did] = future.result()
+
+    now = time.time()
+    for did, result in results.items():
+        if result is None:
+            schedule.pop(did, None)
+            continue
+        followers_count, changed = result
+        entry = schedule.get(did, {})
+        interval = next_interval(entry, followers_count, changed)
+        schedule[did] = {'interval': interval, 'next_check': now + interval, 'followers_count': followers_count or 0}
+    active_dids = {user['did'] for user in follow_watches}
+    for did in [did for did in schedule if did not in active_dids]:
+        del schedule[did]
+    save_schedule(schedule)
+
+    if VERBOSE_PRINTING: print(f"Follow sweep checked {len(results)} users, {budget.used()} API calls spent in the last hour.")
+    if errors:
+        raise errors[0]
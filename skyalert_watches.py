@@ -0,0 +1,77 @@
+from dataclasses import dataclass, field
+import skyalert_profiles
+import skyalert_store
+
+# Validation of user watches for the hourly job. plan_validation() looks at every watch once against the
+# batched profile results and decides what to change without touching the store; apply_validation()
+# writes that plan in one transaction, so the caller can send the notifications afterwards.
+
+VERBOSE_PRINTING = False
+
+@dataclass
+class WatchValidation:
+    handle_updates: dict = field(default_factory=dict) # did -> current handle
+    dropped_subjects: set = field(default_factory=set)
+    dropped_receivers: set = field(default_factory=set)
+    drop_incomplete: bool = False # some watches are missing a subject or receiver DID
+    notifications: list = field(default_factory=list) # (receiver did, message)
+
+    @property
+    def changed(self):
+        return bool(self.handle_updates or self.dropped_subjects or self.dropped_receivers or self.drop_incomplete)
+
+def plan_validation(user_watches, profiles):
+    plan = WatchValidation()
+    notified = set()
+
+    def notify(receiver_did, subject_key, message):
+        if (receiver_did, subject_key) not in notified:
+            notified.add((receiver_did, subject_key))
+            plan.notifications.append((receiver_did, message))
+
+    for watch in user_watches:
+        receiver_did = watch.get('receiver-did')
+        subject_did = watch.get('subject-did')
+        subject_handle = watch.get('subject-handle')
+
+        if not receiver_did:
+            if VERBOSE_PRINTING: print(f"Watch for {subject_handle} has no receiver and will be removed.")
+            plan.drop_incomplete = True
+            continue
+
+        receiver_profile = profiles.get(receiver_did)
+        if receiver_profile is skyalert_profiles.MISSING:
+            if VERBOSE_PRINTING: print(f"Could not load profile for receiver {receiver_did}, their watches will be removed.")
+            plan.dropped_receivers.add(receiver_did)
+            continue
+        if receiver_profile.handle != watch.get('receiver-handle'):
+            plan.handle_updates[receiver_did] = receiver_profile.handle
+
+        if not subject_did:
+            if VERBOSE_PRINTING: print(f"Watch for {subject_handle} has no subject DID and will be removed.")
+            plan.drop_incomplete = True
+            notify(receiver_did, subject_handle, f"You're no longer watching {subject_handle} because the handle is invalid.")
+            continue
+
+        subject_profile = profiles.get(subject_did)
+        if subject_profile is skyalert_profiles.MISSING:
+            if VERBOSE_PRINTING: print(f"Could not load profile for subject {subject_did}, watches for it will be removed.")
+            plan.dropped_subjects.add(subject_did)
+            notify(receiver_did, subject_did, f"You are no longer watching {subject_handle} because the handle could not be verified. This usually happens when an account is deleted/deactivated by its user or suspended by Bluesky.")
+            continue
+        if subject_profile.handle != subject_handle:
+            plan.handle_updates[subject_did] = subject_profile.handle
+
+    return plan
+
+# Applies the plan with targeted updates, so watches added while the plan was being made are kept.
+def apply_validation(plan):
+    with skyalert_store.transaction():
+        for did, handle in plan.handle_updates.items():
+            skyalert_store.update_handle(did, handle)
+        for did in plan.dropped_receivers:
+            skyalert_store.remove_watches_for_receiver(did)
+        for did in plan.dropped_subjects:
+            skyalert_store.remove_watches_for_subject(did)
+        if plan.drop_incomplete:
+            skyalert_store.remove_incomplete_watches()
@@ -0,0 +1,122 @@
+import json
+
+import httpx
+import pytest
+from atproto import Client
+from atproto_client.request import Request
+
+import skyalert_chatlog
+import skyalert_identity
+import skyalert_store
+
+# The chat namespace of a real Client, talking to an httpx transport that serves canned responses, so the
+# calls go through the same signatures and query building as against the chat service.
+
+BOT_DID = "did:plc:bot"
+USER_DID = "did:plc:user"
+NOW = "2026-10-19T12:00:00.000Z"
+
+def message_view(id, rev, sender, text):
+    return {'$type': 'chat.bsky.convo.defs#messageView', 'id': id, 'rev': rev, 'text': text, 'sender': {'did': sender}, 'sentAt': NOW}
+
+def profile(did, handle):
+    return {'did': did, 'handle': handle}
+
+@pytest.fixture(autouse=True)
+def data_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(skyalert_chatlog, 'CHAT_LOG_CURSOR_FILE', str(tmp_path / 'chat_log_cursor.txt'))
+    monkeypatch.setattr(skyalert_chatlog, 'PROCESSED_LEDGER_FILE', str(tmp_path / 'processed_messages.json'))
+    monkeypatch.setattr(skyalert_store, 'STORE_FILE', str(tmp_path / 'skyalert.db'))
+    monkeypatch.setattr(skyalert_store, 'CONFIG_FILE', str(tmp_path / 'config.yaml'))
+    monkeypatch.setattr(skyalert_store, '_migrated_pid', None)
+    skyalert_store._local.conn = None
+    monkeypatch.setattr(skyalert_identity, 'CACHE_DIR', str(tmp_path))
+    monkeypatch.setattr(skyalert_identity, 'IDENTITY_CACHE_FILE', str(tmp_path / 'identities.json'))
+    monkeypatch.setattr(skyalert_identity, 'LOCK_FILE', str(tmp_path / 'identities.lock'))
+
+def chat_namespace(responses, requests):
+    def handler(request):
+        requests.append(request)
+        nsid = request.url.path.rsplit('/', 1)[-1]
+        return httpx.Response(200, json=responses[nsid](dict(request.url.params)))
+    client = Client(request=Request(transport=httpx.MockTransport(handler)))
+    return client.chat.bsky.convo
+
+def test_bootstrap_passes_cursor_as_query_parameter():
+    pages = {
+        None: {'cursor': 'page2', 'convos': [{'id': 'convo1', 'rev': '0001', 'members': [profile(USER_DID, 'user.test'), profile(BOT_DID, 'bot.test')],
+            'muted': False, 'unreadCount': 1, 'lastMessage': message_view('m1', '0001', USER_DID, '!help')}]},
+        'page2': {'convos': [{'id': 'convo2', 'rev': '0002', 'members': [profile(BOT_DID, 'bot.test')], 'muted': False, 'unreadCount': 0}]},
+    }
+    requests = []
+    dm = chat_namespace({'chat.bsky.convo.listConvos': lambda params: pages[params.get('cursor')]}, requests)
+
+    messages, cursor = skyalert_chatlog.fetch_new_messages(dm, BOT_DID, {})
+
+    assert [request.url.params.get('cursor') for request in requests] == [None, 'page2']
+    assert [message['text'] for message in messages] == ['!help']
+    assert messages[0]['convo_id'] == 'convo1'
+    assert cursor == '0002'
+
+def test_log_passes_cursor_as_query_parameter():
+    skyalert_chatlog.save_chat_log_cursor('0001')
+    logs = {
+        '0001': {'cursor': '0003', 'logs': [
+            {'$type': 'chat.bsky.convo.defs#logCreateMessage', 'rev': '0002', 'convoId': 'convo1', 'message': message_view('m2', '0002', USER_DID, '!list')},
+            {'$type': 'chat.bsky.convo.defs#logCreateMessage', 'rev': '0003', 'convoId': 'convo1', 'message': message_view('m3', '0003', BOT_DID, 'reply')},
+        ]},
+        '0003': {'cursor': '0003', 'logs': []},
+    }
+    requests = []
+    dm = chat_namespace({'chat.bsky.convo.getLog': lambda params: logs[params['cursor']]}, requests)
+
+    messages, cursor = skyalert_chatlog.fetch_new_messages(dm, BOT_DID, {})
+
+    assert [request.url.params.get('cursor') for request in requests] == ['0001', '0003']
+    assert [message['text'] for message in messages] == ['!list']
+    assert cursor == '0003'
+
+def test_log_skips_processed_messages():
+    skyalert_chatlog.save_chat_log_cursor('0001')
+    log = {'cursor': '0002', 'logs': [{'$type': 'chat.bsky.convo.defs#logCreateMessage', 'rev': '0002', 'convoId': 'convo1', 'message': message_view('m2', '0002', USER_DID, '!list')}]}
+    dm = chat_namespace({'chat.bsky.convo.getLog': lambda params: log if params['cursor'] == '0001' else {'logs': []}}, [])
+
+    messages, _ = skyalert_chatlog.fetch_new_messages(dm, BOT_DID, {'convo1': {'id': 'm2', 'rev': '0002'}})
+
+    assert messages == []
+
+def test_ledger_is_pruned_once_the_cursor_passes_it():
+    ledger = skyalert_chatlog.get_processed_ledger()
+    skyalert_chatlog.mark_processed(ledger, {'convo_id': 'convo1', 'id': 'm2', 'rev': '0002'})
+    skyalert_chatlog.mark_processed(ledger, {'convo_id': 'convo2', 'id': 'm5', 'rev': '0005'})
+    generation = skyalert_store.get_generation()
+    assert skyalert_chatlog.get_processed_ledger() == {'convo1': {'id': 'm2', 'rev': '0002'}, 'convo2': {'id': 'm5', 'rev': '0005'}}
+
+    skyalert_chatlog.save_chat_log_cursor('0003')
+
+    assert skyalert_chatlog.get_processed_ledger() == {'convo2': {'id': 'm5', 'rev': '0005'}}
+    assert skyalert_store.get_generation() == generation
+
+def test_ledger_file_is_imported(tmp_path):
+    (tmp_path / 'processed_messages.json').write_text(json.dumps({'convo1': {'id': 'm2', 'rev': '0002'}}))
+
+    assert skyalert_chatlog.get_processed_ledger() == {'convo1': {'id': 'm2', 'rev': '0002'}}
+    assert not (tmp_path / 'processed_messages.json').exists()
+    assert skyalert_chatlog.get_processed_ledger() == {'convo1': {'id': 'm2', 'rev': '0002'}}
+
+def test_rejected_cursor_skips_messages_it_passed():
+    skyalert_chatlog.save_chat_log_cursor('0003')
+    convos = {'convos': [
+        {'id': 'convo1', 'rev': '0002', 'members': [], 'muted': False, 'unreadCount': 0, 'lastMessage': message_view('m2', '0002', USER_DID, '!reset')},
+        {'id': 'convo2', 'rev': '0004', 'members': [], 'muted': False, 'unreadCount': 1, 'lastMessage': message_view('m4', '0004', USER_DID, '!list')},
+    ]}
+    def handler(request):
+        if request.url.path.endswith('getLog'):
+            return httpx.Response(400, json={'error': 'InvalidRequest', 'message': 'bad cursor'})
+        return httpx.Response(200, json=convos)
+    dm = Client(request=Request(transport=httpx.MockTransport(handler))).chat.bsky.convo
+
+    messages, cursor = skyalert_chatlog.fetch_new_messages(dm, BOT_DID, {})
+
+    assert [message['text'] for message in messages] == ['!list']
+    assert cursor == '0004'
@@ -0,0 +1,69 @@
+from types import SimpleNamespace
+
+import pytest
+
+import skyalert_followers
+
+# A follower list served newest first in pages, like app.bsky.graph.getFollowers.
+
+class Followers:
+    def __init__(self, dids):
+        self.dids = dids
+        self.pages = 0
+
+    def get_followers(self, did, cursor=None, limit=100):
+        start = int(cursor or 0)
+        page = self.dids[start:start + limit]
+        self.pages += 1
+        next_cursor = str(start + limit) if start + limit < len(self.dids) else None
+        return SimpleNamespace(followers=[SimpleNamespace(did=did) for did in page], cursor=next_cursor)
+
+@pytest.fixture(autouse=True)
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(skyalert_followers, 'CACHE_DIR', str(tmp_path))
+    monkeypatch.setattr(skyalert_followers, 'SYNC_STATE_FILE', str(tmp_path / 'follower-sync-state.json'))
+
+@pytest.fixture
+def scans(monkeypatch):
+    counter = []
+    iter_snapshot = skyalert_followers.iter_snapshot
+    def counting(did):
+        counter.append(did)
+        return iter_snapshot(did)
+    monkeypatch.setattr(skyalert_followers, 'iter_snapshot', counting)
+    return counter
+
+def followers(count, prefix="old"):
+    return [f"did:plc:{prefix}{index:06d}" for index in range(count)]
+
+def sync(client, did="did:plc:user"):
+    unfollowed, commit = skyalert_followers.sync_followers(client, did, len(client.dids))
+    commit()
+    return unfollowed
+
+def test_new_followers_are_found_from_the_head_without_scanning_the_snapshot(scans):
+    client = Followers(followers(1000))
+    assert sync(client) == []
+    scans.clear()
+
+    client.dids = followers(150, "new") + client.dids
+    client.pages = 0
+    new_dids, _ = skyalert_followers.fetch_new_followers(client, "did:plc:user")
+    assert new_dids == followers(150, "new")
+    assert scans == []
+    assert client.pages == 2
+
+    assert sync(client) == []
+    assert skyalert_followers.load_head("did:plc:user") == followers(100, "new")
+    assert skyalert_followers.snapshot_count("did:plc:user") == 1150
+
+def test_snapshot_is_scanned_once_when_the_head_left(scans):
+    client = Followers(followers(1000))
+    sync(client)
+    scans.clear()
+
+    client.dids = followers(5, "new") + client.dids[200:]
+    new_dids, _ = skyalert_followers.fetch_new_followers(client, "did:plc:user")
+
+    assert new_dids == followers(5, "new")
+    assert len(scans) == 1
@@ -0,0 +1,90 @@
+import json
+import multiprocessing
+
+import dns.exception
+import dns.resolver
+import httpx
+import pytest
+
+import skyalert_endpoints
+import skyalert_identity
+
+# Several services save the shared cache file; each save merges what the others wrote.
+
+SERVICES = 4
+ENTRIES = 50
+
+def save_entries(cache_dir, service):
+    skyalert_identity.CACHE_DIR = cache_dir
+    skyalert_identity.IDENTITY_CACHE_FILE = f"{cache_dir}/identities.json"
+    skyalert_identity.LOCK_FILE = f"{cache_dir}/identities.lock"
+    for index in range(ENTRIES):
+        skyalert_identity.remember_identity(f"did:plc:{service}-{index}", f"user{service}-{index}.test")
+        skyalert_identity.save_identity_cache(force=True)
+
+def test_concurrent_saves_keep_every_entry(tmp_path):
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(target=save_entries, args=(str(tmp_path), service)) for service in range(SERVICES)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+
+    with open(tmp_path / "identities.json") as f:
+        identities = json.load(f)['identities']
+    assert len(identities) == SERVICES * ENTRIES
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(skyalert_identity, 'CACHE_DIR', str(tmp_path))
+    monkeypatch.setattr(skyalert_identity, 'IDENTITY_CACHE_FILE', str(tmp_path / 'identities.json'))
+    monkeypatch.setattr(skyalert_identity, 'LOCK_FILE', str(tmp_path / 'identities.lock'))
+    monkeypatch.setattr(skyalert_identity, '_unresolvable', {})
+
+def resolver_service(monkeypatch, statuses):
+    calls = []
+    def get(url, params, timeout):
+        calls.append(params['handle'])
+        status = statuses.pop(0)
+        return httpx.Response(status, json={'error': 'InvalidHandle'} if status == 400 else {}, request=httpx.Request('GET', url))
+    monkeypatch.setattr(skyalert_endpoints, 'HANDLE_RESOLVER_URL', "https://resolver.test/xrpc")
+    monkeypatch.setattr(httpx, 'get', get)
+    return calls
+
+def test_service_outage_is_not_cached_as_unresolvable(cache, monkeypatch):
+    calls = resolver_service(monkeypatch, [503, 429, 400])
+
+    for _ in range(2):
+        with pytest.raises(httpx.HTTPStatusError):
+            skyalert_identity.resolve_handle("someone.test")
+    assert skyalert_identity.resolve_handle("someone.test") is None
+    assert skyalert_identity.resolve_handle("someone.test") is None
+    assert calls == ["someone.test"] * 3
+
+def test_dns_timeout_raises_and_missing_handle_is_cached(cache, monkeypatch):
+    monkeypatch.setattr(skyalert_endpoints, 'HANDLE_RESOLVER_URL', None)
+    def timeout(*args, **kwargs):
+        raise dns.exception.Timeout()
+    monkeypatch.setattr(dns.resolver, 'resolve', timeout)
+    with pytest.raises(dns.exception.Timeout):
+        skyalert_identity.resolve_handle("someone.test")
+    assert "someone.test" not in skyalert_identity._unresolvable
+
+    def nxdomain(*args, **kwargs):
+        raise dns.resolver.NXDOMAIN()
+    def no_host(url, timeout):
+        raise httpx.ConnectError("Name or service not known")
+    monkeypatch.setattr(dns.resolver, 'resolve', nxdomain)
+    monkeypatch.setattr(httpx, 'get', no_host)
+    assert skyalert_identity.resolve_handle("someone.test") is None
+    assert "someone.test" in skyalert_identity._unresolvable
+
+def test_lookups_only_mark_the_cache_dirty(cache, tmp_path):
+    skyalert_identity.remember_identity("did:plc:someone", "someone.test")
+    assert not (tmp_path / "identities.json").exists()
+
+    skyalert_identity.save_identity_cache(force=True)
+
+    with open(tmp_path / "identities.json") as f:
+        assert json.load(f)['identities']["did:plc:someone"]['handle'] == "someone.test"
@@ -0,0 +1,57 @@
+import time
+
+import pytest
+
+import skyalert_outbox
+
+@pytest.fixture(autouse=True)
+def outbox(tmp_path, monkeypatch):
+    monkeypatch.setattr(skyalert_outbox, 'CACHE_DIR', str(tmp_path))
+    monkeypatch.setattr(skyalert_outbox, 'STORE_FILE', str(tmp_path / 'outbox.db'))
+    skyalert_outbox._local.conn = None
+
+def test_digest_holds_what_fits():
+    messages = [f"notification {index}: " + "x" * 80 for index in range(30)]
+    text, count = skyalert_outbox.digest_message(messages)
+    assert 0 < count < len(messages)
+    assert len(text) <= skyalert_outbox.MAX_MESSAGE_LENGTH
+    assert all(message in text for message in messages[:count])
+    assert messages[count] not in text
+
+def test_dispatcher_sends_every_folded_notification():
+    sent = []
+    outbox = skyalert_outbox.Outbox('test', lambda receiver, message: sent.append(message))
+    dispatcher = skyalert_outbox.Dispatcher(senders=1, cap=1)
+    outbox.dispatcher = dispatcher
+    messages = [f"notification {index}: " + "x" * 80 for index in range(30)]
+    for message in messages:
+        outbox.send("did:plc:r", message)
+
+    dispatcher.start()
+    deadline = time.time() + 10
+    while skyalert_outbox.pending_count('test') and time.time() < deadline:
+        time.sleep(0.01)
+
+    assert skyalert_outbox.pending_count('test') == 0
+    assert len(sent) > 2
+    assert all(any(message in text for text in sent) for message in messages)
+
+def test_digests_keep_outboxes_apart():
+    sent = {'test': [], 'notices': []}
+    notifications = skyalert_outbox.Outbox('test', lambda receiver, message: sent['test'].append(message))
+    notices = skyalert_outbox.Outbox('notices', lambda receiver, message: sent['notices'].append(message))
+    dispatcher = skyalert_outbox.Dispatcher(senders=1, cap=1)
+    notifications.dispatcher = notices.dispatcher = dispatcher
+    for index in range(4):
+        notifications.send("did:plc:r", f"post {index}")
+        notices.send("did:plc:r", f"unfollow {index}")
+
+    dispatcher.start()
+    deadline = time.time() + 10
+    while skyalert_outbox.pending_count() and time.time() < deadline:
+        time.sleep(0.01)
+
+    assert skyalert_outbox.pending_count() == 0
+    assert all("unfollow" not in text for text in sent['test'])
+    assert all("post" not in text for text in sent['notices'])
+    assert all(any(f"unfollow {index}" in text for text in sent['notices']) for index in range(4))
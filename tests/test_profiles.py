@@ -0,0 +1,53 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import skyalert_identity
+import skyalert_profiles
+
+REQUEST_TIME = 0.2
+
+class SlowClient:
+    def __init__(self):
+        self.requested = []
+
+    def get_profiles(self, dids):
+        self.requested.extend(dids)
+        time.sleep(REQUEST_TIME)
+        return SimpleNamespace(profiles=[SimpleNamespace(did=did, handle=f"{did[8:]}.test", followers_count=1) for did in dids])
+
+@pytest.fixture(autouse=True)
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(skyalert_identity, 'CACHE_DIR', str(tmp_path))
+    monkeypatch.setattr(skyalert_identity, 'IDENTITY_CACHE_FILE', str(tmp_path / 'identities.json'))
+    monkeypatch.setattr(skyalert_identity, 'LOCK_FILE', str(tmp_path / 'identities.lock'))
+
+def in_threads(*calls):
+    threads = [threading.Thread(target=func, args=args) for func, *args in calls]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start
+
+def test_threads_fetch_at_the_same_time():
+    client = SlowClient()
+    profiles = skyalert_profiles.ProfileLookup(client)
+
+    elapsed = in_threads((profiles.prefetch, ["did:plc:a"]), (profiles.prefetch, ["did:plc:b"]), (profiles.prefetch, ["did:plc:c"]))
+
+    assert elapsed < 2 * REQUEST_TIME
+    assert profiles.get_handle("did:plc:b") == "b.test"
+
+def test_a_did_being_fetched_is_waited_for():
+    client = SlowClient()
+    profiles = skyalert_profiles.ProfileLookup(client)
+    handles = []
+
+    in_threads((profiles.prefetch, ["did:plc:a"]), (lambda: handles.append(profiles.get_handle("did:plc:a")),))
+
+    assert client.requested == ["did:plc:a"]
+    assert handles == ["a.test"]
@@ -0,0 +1,25 @@
+import os
+import time
+
+import skyalert_profiling
+
+def test_old_and_surplus_profiles_are_removed(tmp_path, monkeypatch):
+    monkeypatch.setattr(skyalert_profiling, 'PROFILES_DIR', str(tmp_path))
+    monkeypatch.setattr(skyalert_profiling, 'MAX_FILES_PER_PROCESS', 3)
+    for minute in range(5):
+        for extension in ('folded', 'memory'):
+            (tmp_path / f"firehose-100-20261019-1200{minute:02d}.{extension}").write_text("")
+    (tmp_path / "firehose-1000-20261019-120000.folded").write_text("")
+    stale = tmp_path / "jetstream-7-20261001-120000.folded"
+    stale.write_text("")
+    old = time.time() - skyalert_profiling.MAX_FILE_AGE - 60
+    os.utime(stale, (old, old))
+
+    skyalert_profiling.prune("firehose-100-")
+
+    assert sorted(os.listdir(tmp_path)) == [
+        "firehose-100-20261019-120002.folded", "firehose-100-20261019-120002.memory",
+        "firehose-100-20261019-120003.folded", "firehose-100-20261019-120003.memory",
+        "firehose-100-20261019-120004.folded", "firehose-100-20261019-120004.memory",
+        "firehose-1000-20261019-120000.folded",
+    ]
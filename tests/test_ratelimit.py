@@ -0,0 +1,33 @@
+import asyncio
+import threading
+
+import httpx
+import pytest
+from atproto import AsyncClient
+
+import skyalert_ratelimit
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = skyalert_ratelimit.BucketStore(str(tmp_path / 'ratelimits.db'))
+    monkeypatch.setattr(skyalert_ratelimit, 'store', store)
+    return store
+
+# the store's write transactions may wait on other processes, so the async limiter keeps them off the loop
+def test_async_limiter_uses_the_store_from_threads(store, monkeypatch):
+    threads = []
+    for method in ('try_acquire', 'observe'):
+        original = getattr(store, method)
+        def spy(*args, original=original, **kwargs):
+            threads.append(threading.current_thread())
+            return original(*args, **kwargs)
+        monkeypatch.setattr(store, method, spy)
+    handler = lambda request: httpx.Response(200, json={'did': "did:plc:someone"}, headers={'ratelimit-remaining': '2999'})
+    client = AsyncClient(request=skyalert_ratelimit.RateLimitedAsyncRequest(transport=httpx.MockTransport(handler)))
+
+    response = asyncio.run(client.com.atproto.identity.resolve_handle({'handle': "someone.test"}))
+
+    assert response.did == "did:plc:someone"
+    assert len(threads) == 2
+    assert threading.main_thread() not in threads
+    assert store.usage()['default']['calls'] == 1
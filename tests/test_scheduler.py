@@ -0,0 +1,16 @@
+import skyalert_scheduler
+
+def test_jitter_does_not_accumulate():
+    scheduler = skyalert_scheduler.Scheduler()
+    task = scheduler.add("jittered", lambda: None, 10, jitter=5)
+    start = task.planned_run
+    for _ in range(1000):
+        scheduler._reschedule(task, None, 0)
+    assert task.planned_run == start + 1000 * 10
+    assert 0 <= task.next_run - task.planned_run <= 5
+
+def test_returned_delay_sets_next_run():
+    scheduler = skyalert_scheduler.Scheduler()
+    task = scheduler.add("adaptive", lambda: None, 10)
+    scheduler._reschedule(task, 3, 100)
+    assert task.next_run == task.planned_run == 103
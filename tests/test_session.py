@@ -0,0 +1,57 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import skyalert_session
+
+@pytest.fixture(autouse=True)
+def lock_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(skyalert_session, 'CACHE_DIR', str(tmp_path))
+    monkeypatch.setattr(skyalert_session, 'LOCK_FILE', str(tmp_path / 'session.lock'))
+    monkeypatch.setattr(skyalert_session, '_task_lock', None)
+
+def test_waiting_for_the_lock_keeps_the_loop_running():
+    held = threading.Event()
+    def hold():
+        with skyalert_session._locked():
+            held.set()
+            time.sleep(0.3)
+    holder = threading.Thread(target=hold)
+    holder.start()
+    held.wait()
+
+    async def main():
+        ticks = 0
+        async def tick():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+        ticker = asyncio.create_task(tick())
+        async with skyalert_session._locked_async():
+            pass
+        ticker.cancel()
+        return ticks
+
+    assert asyncio.run(main()) >= 10
+    holder.join()
+
+def test_reentrant_within_a_task_exclusive_between_tasks():
+    async def main():
+        order = []
+        async def first():
+            async with skyalert_session._locked_async():
+                async with skyalert_session._locked_async(): # a refresh during login
+                    order.append("first in")
+                    await asyncio.sleep(0.05)
+                order.append("first out")
+        async def second():
+            await asyncio.sleep(0.01)
+            async with skyalert_session._locked_async():
+                order.append("second in")
+        await asyncio.gather(first(), second())
+        return order
+
+    assert asyncio.run(main()) == ["first in", "first out", "second in"]
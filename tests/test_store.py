@@ -0,0 +1,48 @@
+import threading
+
+import pytest
+
+import skyalert_store
+
+@pytest.fixture(autouse=True)
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(skyalert_store, 'STORE_FILE', str(tmp_path / 'skyalert.db'))
+    monkeypatch.setattr(skyalert_store, 'CONFIG_FILE', str(tmp_path / 'config.yaml'))
+    monkeypatch.setattr(skyalert_store, '_migrated_pid', None)
+    skyalert_store._local.conn = None
+
+def watch(receiver, subject):
+    return {'receiver-did': receiver, 'subject-did': subject, 'receiver-handle': None, 'subject-handle': None, 'reposts-allowed': False}
+
+def in_other_thread(func, *args):
+    thread = threading.Thread(target=func, args=args)
+    thread.start()
+    thread.join()
+
+def test_lazy_lookup_does_not_mix_generations():
+    skyalert_store.add_user_watch(watch("did:plc:r1", "did:plc:s"))
+    old = skyalert_store.snapshot()
+    in_other_thread(skyalert_store.remove_user_watch, "did:plc:r1", "did:plc:s")
+    in_other_thread(skyalert_store.add_user_watch, watch("did:plc:r2", "did:plc:s"))
+
+    watches = old.watches_for_subject("did:plc:s")
+
+    current = skyalert_store.snapshot()
+    assert current.generation > old.generation
+    assert [w['receiver-did'] for w in watches] == ["did:plc:r2"]
+    assert "did:plc:s" not in old.watches
+
+def test_lookup_is_cached_while_generation_holds():
+    skyalert_store.add_user_watch(watch("did:plc:r1", "did:plc:s"))
+    current = skyalert_store.snapshot()
+    assert [w['receiver-did'] for w in current.watches_for_subject("did:plc:s")] == ["did:plc:r1"]
+    assert current.watches_for_subject("did:plc:s") is current.watches["did:plc:s"]
+    assert current.watches_for_subject("did:plc:nobody") == []
+
+def test_yaml_migration_checked_once_per_process(monkeypatch):
+    calls = []
+    monkeypatch.setattr(skyalert_store, 'migrate_from_yaml', lambda conn: calls.append(conn))
+    skyalert_store.get_generation()
+    in_other_thread(skyalert_store.get_generation)
+    in_other_thread(skyalert_store.get_generation)
+    assert len(calls) == 1
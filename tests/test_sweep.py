@@ -0,0 +1,54 @@
+import httpx
+import pytest
+from atproto import Client
+
+import skyalert_followers
+import skyalert_ratelimit
+import skyalert_sweep
+
+FOLLOWERS = 250 # three pages of getFollowers
+
+@pytest.fixture(autouse=True)
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(skyalert_followers, 'CACHE_DIR', str(tmp_path))
+    monkeypatch.setattr(skyalert_followers, 'SYNC_STATE_FILE', str(tmp_path / 'follower-sync-state.json'))
+    monkeypatch.setattr(skyalert_sweep, 'SCHEDULE_FILE', str(tmp_path / 'follow-schedule.json'))
+    monkeypatch.setattr(skyalert_ratelimit, 'store', skyalert_ratelimit.BucketStore(str(tmp_path / 'ratelimits.db')))
+    monkeypatch.setattr(skyalert_sweep, 'budget', skyalert_sweep.CallBudget(path=str(tmp_path / 'ratelimits.db')))
+
+def rate_limited_client():
+    def handler(request):
+        start = int(request.url.params.get('cursor') or 0)
+        followers = [{'did': f"did:plc:f{index:04d}", 'handle': f"f{index}.test"} for index in range(start, min(start + 100, FOLLOWERS))]
+        body = {'subject': {'did': "did:plc:user", 'handle': "user.test"}, 'followers': followers}
+        if start + 100 < FOLLOWERS:
+            body['cursor'] = str(start + 100)
+        return httpx.Response(200, json=body)
+    return Client(request=skyalert_ratelimit.RateLimitedRequest(transport=httpx.MockTransport(handler)))
+
+def test_first_sync_is_estimated_from_the_profile():
+    assert skyalert_sweep.estimated_calls("did:plc:user", {}, 1_000_000) == 10_000
+    assert skyalert_sweep.estimated_calls("did:plc:user", {}) == 1
+
+def test_sweep_charges_the_calls_the_check_made(tmp_path):
+    client = rate_limited_client()
+    def check_user(user):
+        unfollowed, commit = skyalert_followers.sync_followers(client, user['did'], FOLLOWERS)
+        commit()
+        return FOLLOWERS, bool(unfollowed)
+
+    # the schedule knows nothing about the user, and the profile count isn't passed: the estimate is one page
+    skyalert_sweep.run_sweep([{'did': "did:plc:user"}], check_user)
+
+    assert skyalert_sweep.budget.used() == 3
+    assert skyalert_sweep.CallBudget(path=str(tmp_path / 'ratelimits.db')).used() == 3
+
+def test_budget_is_shared_through_the_store(tmp_path):
+    first = skyalert_sweep.CallBudget(calls_per_hour=10, path=str(tmp_path / 'budget.db'))
+    second = skyalert_sweep.CallBudget(calls_per_hour=10, path=str(tmp_path / 'budget.db'))
+
+    reservation = first.try_spend(8)
+    assert second.try_spend(5) is None
+    first.settle(reservation, 2)
+    assert second.try_spend(5) is not None
+    assert first.used() == 7
@@ -0,0 +1,50 @@
+import os
+import sys
+import time
+import signal
+import importlib.util
+import multiprocessing
+import concurrent.futures
+
+import libipld
+from atproto import models
+from atproto_subscription.frames import Frame
+
+import skyalert_commits
+import skyalert_profiling
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+from bench_commits import car_file, cid_for
+
+spec = importlib.util.spec_from_file_location("skyalert_unified", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "skyalert-unified.py"))
+skyalert_unified = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(skyalert_unified)
+
+def commit_frame(seq):
+    record = libipld.encode_dag_cbor({'$type': models.ids.AppBskyFeedPost, 'text': "hello", 'createdAt': "2026-10-19T12:00:00.000Z"})
+    cid = cid_for(record)
+    body = {
+        'seq': seq, 'rebase': False, 'tooBig': False, 'repo': "did:plc:author", 'commit': cid, 'rev': "3k2a", 'since': None,
+        'blocks': car_file([(cid, record)]), 'blobs': [], 'time': "2026-10-19T12:00:00.000Z",
+        'ops': [{'action': 'create', 'path': f"{models.ids.AppBskyFeedPost}/3k2a", 'cid': cid}],
+    }
+    return Frame.from_bytes(libipld.encode_dag_cbor({'op': 1, 't': '#commit'}) + libipld.encode_dag_cbor(body))
+
+# the worker initializer, with profiles kept out of the repository
+def init_worker(profiles_dir):
+    skyalert_profiling.PROFILES_DIR = profiles_dir
+    skyalert_unified.init_decode_worker()
+
+def test_decode_pool_survives_sigusr2(tmp_path, monkeypatch):
+    monkeypatch.delenv('SKYALERT_PROFILE', raising=False)
+    pool = concurrent.futures.ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn'), initializer=init_worker, initargs=(str(tmp_path),))
+    try:
+        assert pool.submit(skyalert_commits.decode_message, commit_frame(1)).result(timeout=60)[0] == 1
+        for pid in list(pool._processes):
+            os.kill(pid, signal.SIGUSR2)
+        time.sleep(0.5)
+        seq, _, ops = pool.submit(skyalert_commits.decode_message, commit_frame(2)).result(timeout=60)
+        assert seq == 2
+        assert [post['author'] for post in ops[models.ids.AppBskyFeedPost]['created']] == ["did:plc:author"]
+    finally:
+        pool.shutdown()